@@ -0,0 +1,176 @@
+from array import array
+from collections import deque
+
+# Aho-Corasick multi-pattern matcher used by the signature engine.
+# All the patterns are compiled into a single DFA, so a payload is scanned
+# once no matter how many signatures are loaded.
+#
+# Memory layout (all flat arrays, no per-state python objects after build):
+#   classes   - 256 byte translate table, byte -> byte class. Bytes that don't
+#               show up in any pattern share one class, which keeps the table narrow.
+#   delta     - array('I') of n_states * n_classes transitions. Entries are stored
+#               pre-multiplied by n_classes so the scan loop is just delta[s + c].
+#   out_start - array('I'), out_ids[out_start[i]:out_start[i + 1]] are the pattern
+#               ids that end in state i (failure-link outputs already merged).
+# States are renumbered so that every state with an output comes last, then the
+# scan loop only needs one compare per byte to know if something matched.
+
+
+class AhoCorasick:
+    def __init__(self, patterns, nocase=False):
+        """
+        Args:
+            patterns (list[bytes]): the literals to look for, the pattern id
+                reported by the scan is the index in this list.
+            nocase (bool): ASCII case-insensitive matching. Upper and lower case
+                letters simply share a byte class, so the scan costs the same.
+        """
+        self.nocase = nocase
+        self.patterns = [bytes(p).lower() if nocase else bytes(p) for p in patterns]
+        self.pattern_count = len(self.patterns)
+        self.max_pattern_len = max((len(p) for p in self.patterns), default=0)
+        self._build()
+
+    def _build(self):
+        # 1. byte classes
+        used = sorted({b for p in self.patterns for b in p})
+        first_class = 1 if len(used) < 256 else 0 # class 0 = "any other byte"
+        class_of = [0] * 256
+        for i, b in enumerate(used):
+            class_of[b] = first_class + i
+        if self.nocase:
+            for b in range(ord('A'), ord('Z') + 1):
+                class_of[b] = class_of[b + 32]
+        n_classes = first_class + len(used)
+        self.n_classes = n_classes
+        self.classes = bytes(class_of)
+
+        # 2. plain trie (temporary dicts, thrown away at the end of the build)
+        goto = [{}]
+        outputs = [[]]
+        for pattern_id, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue # an empty pattern would match everything, ignore it.
+            state = 0
+            for b in pattern:
+                c = class_of[b]
+                nxt = goto[state].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][c] = nxt
+                    goto.append({})
+                    outputs.append([])
+                state = nxt
+            outputs[state].append(pattern_id)
+
+        n_states = len(goto)
+
+        # 3. failure links (BFS) folded directly into a full DFA table
+        fail = [0] * n_states
+        dfa = [0] * (n_states * n_classes)
+        for c, nxt in goto[0].items():
+            dfa[c] = nxt
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            f = fail[state]
+            outputs[state].extend(outputs[f])
+            row = state * n_classes
+            frow = f * n_classes
+            for c in range(n_classes):
+                nxt = goto[state].get(c)
+                if nxt is None:
+                    dfa[row + c] = dfa[frow + c]
+                else:
+                    fail[nxt] = dfa[frow + c]
+                    dfa[row + c] = nxt
+                    queue.append(nxt)
+
+        # 4. renumber: states without output first (root stays 0), output states last
+        order = [s for s in range(n_states) if not outputs[s]] + [s for s in range(n_states) if outputs[s]]
+        new_id = [0] * n_states
+        for new, old in enumerate(order):
+            new_id[old] = new
+        self._out_limit = (n_states - sum(1 for s in range(n_states) if outputs[s])) * n_classes
+
+        delta = array('I', bytes(4 * n_states * n_classes))
+        for old in range(n_states):
+            row_old = old * n_classes
+            row_new = new_id[old] * n_classes
+            for c in range(n_classes):
+                delta[row_new + c] = new_id[dfa[row_old + c]] * n_classes
+
+        out_start = array('I', [0])
+        out_ids = array('I')
+        for old in order:
+            out_ids.extend(sorted(set(outputs[old])))
+            out_start.append(len(out_ids))
+
+        self.n_states = n_states
+        self._delta = delta
+        self._out_start = out_start
+        self._out_ids = out_ids
+
+    def tables(self):
+        """The compiled tables, enough to rebuild this matcher with from_tables() (rule cache)."""
+        return {"nocase": self.nocase, "patterns": self.patterns, "n_states": self.n_states,
+                "n_classes": self.n_classes, "out_limit": self._out_limit, "classes": self.classes,
+                "delta": self._delta, "out_start": self._out_start, "out_ids": self._out_ids}
+
+    @classmethod
+    def from_tables(cls, nocase, patterns, n_states, n_classes, out_limit, classes, delta, out_start, out_ids):
+        """
+        Matcher from the tables() of an earlier build, without building anything.
+        Raises ValueError if the tables don't fit together (the scan loop would
+        index out of them).
+        """
+        n_cells = n_states * n_classes
+        if (len(classes) != 256 or max(classes) >= n_classes or len(delta) != n_cells
+                or (delta and max(delta) >= n_cells) or not 0 <= out_limit <= n_cells
+                or len(out_start) != n_states + 1 or out_start[-1] != len(out_ids) or max(out_start) > len(out_ids)
+                or (out_ids and max(out_ids) >= len(patterns))):
+            raise ValueError("the automaton tables don't fit together")
+        matcher = cls.__new__(cls)
+        matcher.nocase = nocase
+        matcher.patterns = [bytes(p) for p in patterns]
+        matcher.pattern_count = len(matcher.patterns)
+        matcher.max_pattern_len = max((len(p) for p in matcher.patterns), default=0)
+        matcher.n_states = n_states
+        matcher.n_classes = n_classes
+        matcher._out_limit = out_limit
+        matcher.classes = bytes(classes)
+        matcher._delta = delta
+        matcher._out_start = out_start
+        matcher._out_ids = out_ids
+        return matcher
+
+    @property
+    def table_bytes(self):
+        """Approximate memory used by the compiled tables."""
+        return (self._delta.itemsize * len(self._delta)
+                + self._out_start.itemsize * len(self._out_start)
+                + self._out_ids.itemsize * len(self._out_ids) + len(self.classes))
+
+    def findall(self, data):
+        """
+        Scan `data` once and return every match as (pattern_id, end_offset),
+        end_offset being the index right after the last byte of the match.
+        """
+        if not self.pattern_count:
+            return []
+
+        delta = self._delta
+        limit = self._out_limit
+        out_start = self._out_start
+        out_ids = self._out_ids
+        n_classes = self.n_classes
+        matches = []
+
+        state = 0
+        for i, c in enumerate(bytes(data).translate(self.classes)):
+            state = delta[state + c]
+            if state >= limit:
+                idx = state // n_classes
+                for k in range(out_start[idx], out_start[idx + 1]):
+                    matches.append((out_ids[k], i + 1))
+        return matches
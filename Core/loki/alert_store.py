@@ -0,0 +1,284 @@
+"""
+Indexed alert store for Loki IDS.
+
+The alert writer thread also inserts every record into a SQLite database
+(WAL mode, one transaction per batch), indexed on time, source, destination
+and type, so "everything from 10.0.0.5 in the last hour" is an index lookup
+instead of a scan of loki_alerts.jsonl. Addresses are also stored as
+integers so CIDR ranges are index range scans too.
+
+Usage (from Core/loki):
+    python3 alert_store.py query --src 10.0.0.5 --since 1h
+    python3 alert_store.py query --dst 192.168.1.0/24 --type SIGNATURE --limit 20
+    python3 alert_store.py count --by src_ip --since 24h
+    python3 alert_store.py count --by hour --type BEHAVIOR
+    python3 alert_store.py import ../../logs/loki_alerts.jsonl   # backfill from the JSONL file
+"""
+import argparse
+import ipaddress
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+from log_segments import parse_since
+
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id       INTEGER PRIMARY KEY,
+    ts       REAL NOT NULL,      -- unix time
+    status   TEXT,               -- STARTED / ONGOING / ENDED, NULL for system events
+    type     TEXT NOT NULL,      -- SIGNATURE / BEHAVIOR / BLACKLIST / SYSTEM
+    src_ip   TEXT,
+    src_int  INTEGER,            -- src_ip as an integer, NULL if it isn't an IPv4 address
+    dst_ip   TEXT,
+    dst_int  INTEGER,
+    src_port INTEGER,
+    dst_port INTEGER,
+    message  TEXT,
+    record   TEXT NOT NULL       -- the full JSON record, as in loki_alerts.jsonl
+);
+CREATE INDEX IF NOT EXISTS alerts_ts ON alerts (ts);
+CREATE INDEX IF NOT EXISTS alerts_src ON alerts (src_int, ts);
+CREATE INDEX IF NOT EXISTS alerts_dst ON alerts (dst_int, ts);
+CREATE INDEX IF NOT EXISTS alerts_type ON alerts (type, ts);
+"""
+
+# count --by: name -> SQL expression
+GROUPS = {
+    "src_ip": "src_ip",
+    "dst_ip": "dst_ip",
+    "type": "type",
+    "message": "message",
+    "status": "status",
+    "dst_port": "dst_port",
+    "hour": "CAST(ts / 3600 AS INTEGER) * 3600",
+    "day": "CAST(ts / 86400 AS INTEGER) * 86400",
+}
+
+
+def _ip_int(address):
+    try:
+        return int(ipaddress.IPv4Address(address))
+    except (ipaddress.AddressValueError, ValueError, TypeError):
+        return None
+
+
+def _timestamp(value):
+    # the records carry a naive UTC ISO string
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+
+def _row(record):
+    src_ip = record.get("src_ip")
+    dst_ip = record.get("dst_ip")
+    return (_timestamp(record.get("timestamp")), record.get("status"), record.get("type", "UNKNOWN"),
+            src_ip, _ip_int(src_ip), dst_ip, _ip_int(dst_ip), record.get("src_port"), record.get("dst_port"),
+            record.get("message"), json.dumps(record))
+
+
+def _connect(path, readonly=False):
+    import sqlite3 # on first use, it's not free at startup
+    if readonly:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    else:
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL") # readers never block the writer
+        connection.execute("PRAGMA synchronous=NORMAL") # WAL stays consistent, a crash may lose the last batch
+        connection.executescript(_SCHEMA)
+        connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        connection.commit()
+    return connection
+
+
+class AlertStoreSink:
+    """
+    Second sink of the AlertWriter. Only ever used from the writer thread: the
+    connection is opened on the first batch, each batch is one transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+
+        # Statistics
+        self.inserted = 0
+
+    def write_batch(self, records):
+        if self._connection is None:
+            self._connection = _connect(self.path)
+        with self._connection: # one transaction, rolled back if anything fails
+            self._connection.executemany(
+                "INSERT INTO alerts (ts, status, type, src_ip, src_int, dst_ip, dst_int, src_port, dst_port, "
+                "message, record) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [_row(record) for record in records])
+        self.inserted += len(records)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def _address_filter(column, value):
+    """'10.0.0.5' or '10.0.0.0/24' -> SQL condition on the integer column + params"""
+    network = ipaddress.IPv4Network(value, strict=False)
+    first, last = int(network.network_address), int(network.broadcast_address)
+    if first == last:
+        return f"{column} = ?", [first]
+    return f"{column} BETWEEN ? AND ?", [first, last]
+
+
+class AlertStore:
+    """Read side: streaming queries and aggregates, on its own read-only connection."""
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"no alert store at {path}")
+        self.path = path
+        self.connection = _connect(path, readonly=True)
+
+    def _where(self, since=None, until=None, src=None, dst=None, alert_type=None, status=None, message=None):
+        conditions, params = [], []
+        if since is not None:
+            conditions.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("ts < ?")
+            params.append(until)
+        if src:
+            condition, values = _address_filter("src_int", src)
+            conditions.append(condition)
+            params.extend(values)
+        if dst:
+            condition, values = _address_filter("dst_int", dst)
+            conditions.append(condition)
+            params.extend(values)
+        if alert_type:
+            conditions.append("type = ?")
+            params.append(alert_type.upper())
+        if status:
+            conditions.append("status = ?")
+            params.append(status.upper())
+        if message:
+            conditions.append("message LIKE ?")
+            params.append(f"%{message}%")
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+    def query(self, limit=None, newest_first=False, **filters):
+        """
+        Yield the matching records (dicts, as written to loki_alerts.jsonl) one by one.
+        Filters: since / until (unix time), src / dst (address or CIDR), alert_type, status, message.
+        """
+        where, params = self._where(**filters)
+        sql = f"SELECT record FROM alerts{where} ORDER BY ts {'DESC' if newest_first else 'ASC'}"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        for (record,) in self.connection.execute(sql, params): # the cursor streams, nothing is loaded up front
+            yield json.loads(record)
+
+    def count(self, by="src_ip", limit=None, **filters):
+        """Yield (group, count) biggest first, grouped by one of GROUPS."""
+        if by not in GROUPS:
+            raise ValueError(f"can't group by {by!r}, use one of {', '.join(GROUPS)}")
+        expression = GROUPS[by]
+        where, params = self._where(**filters)
+        order = "grp ASC" if by in ("hour", "day") else "n DESC"
+        sql = f"SELECT {expression} AS grp, COUNT(*) AS n FROM alerts{where} GROUP BY grp ORDER BY {order}"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        yield from self.connection.execute(sql, params)
+
+    def close(self):
+        self.connection.close()
+
+
+def import_jsonl(store_path, jsonl_path, batch_size=1000):
+    """Load an existing loki_alerts.jsonl into the store, returns how many records went in."""
+    sink = AlertStoreSink(store_path)
+    batch, total = [], 0
+    try:
+        with open(jsonl_path, "r") as f:
+            for line in f:
+                try:
+                    batch.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue # torn last line
+                if len(batch) >= batch_size:
+                    sink.write_batch(batch)
+                    total += len(batch)
+                    batch = []
+        if batch:
+            sink.write_batch(batch)
+            total += len(batch)
+    finally:
+        sink.close()
+    return total
+
+
+def default_path():
+    from logger import logger
+    from config import config
+    return config["alert_store"]["path"] or os.path.join(logger.log_dir, "loki_alerts.db")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the Loki IDS alert store.")
+    parser.add_argument("--db", help="database file (default: the one in the config)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_filters(p):
+        p.add_argument("--since", help="1h, 30m, 2d... ago, or a unix time")
+        p.add_argument("--until", help="same format as --since")
+        p.add_argument("--src", help="source address or CIDR")
+        p.add_argument("--dst", help="destination address or CIDR")
+        p.add_argument("--type", dest="alert_type", help="SIGNATURE, BEHAVIOR, BLACKLIST, SYSTEM")
+        p.add_argument("--status", help="STARTED, ONGOING, ENDED")
+        p.add_argument("--message", help="substring of the message")
+        p.add_argument("--limit", type=int)
+
+    query = sub.add_parser("query", help="print the matching records as JSON lines")
+    add_filters(query)
+    query.add_argument("--newest-first", action="store_true")
+    count = sub.add_parser("count", help="count the matching records per group")
+    add_filters(count)
+    count.add_argument("--by", default="src_ip", choices=sorted(GROUPS))
+    backfill = sub.add_parser("import", help="load a loki_alerts.jsonl file into the store")
+    backfill.add_argument("jsonl")
+
+    args = parser.parse_args(argv)
+    path = args.db or default_path()
+
+    if args.command == "import":
+        print(f"[*] imported {import_jsonl(path, args.jsonl)} records into {path}")
+        return 0
+
+    filters = {"since": parse_since(args.since), "until": parse_since(args.until), "src": args.src, "dst": args.dst,
+               "alert_type": args.alert_type, "status": args.status, "message": args.message}
+    store = AlertStore(path)
+    try:
+        if args.command == "query":
+            for record in store.query(limit=args.limit, newest_first=args.newest_first, **filters):
+                sys.stdout.write(json.dumps(record) + "\n")
+        else:
+            for group, n in store.count(by=args.by, limit=args.limit, **filters):
+                if args.by in ("hour", "day") and group is not None:
+                    group = datetime.fromtimestamp(group).strftime("%Y-%m-%d %H:00")
+                print(f"{n:>10}  {group}")
+    except BrokenPipeError:
+        pass # | head
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,582 @@
+"""
+Vectorized batch detection for Loki IDS (forensic pcap analysis).
+
+Loads the headers of whole captures into NumPy columns (time, src, dst,
+proto, ports, TCP flags) and runs the behavior detectors of
+PortScanningDetector over all of them at once: packets are sorted by
+detector key, the sliding windows become `searchsorted` bounds and the
+window counts are differences of positions, so a day of traffic takes
+seconds instead of a Python call per packet.
+
+Same thresholds, windows and counting as the live detector (they are read
+from a PortScanningDetector), so it flags the same packets:
+  - port scan: distinct destination ports per (src, dst) over the last
+    port_scanning_window seconds, TCP SYN without ACK
+  - TCP flood: SYNs per (dst, dst port) that were not flagged as a scan
+  - UDP flood: packets per (dst, dst port); ICMP flood: echo requests per dst
+  - floods are counted with the time slice ring when counter_slices > 0,
+    the exact deque count when it's 0, like the live counters.
+Differences with the live path: the port scan is always counted exactly
+(port_scan_mode "hll" is not emulated), there is no max_keys cap on the
+state, and packets of one key are taken in time order (the live detector
+takes them in arrival order, the same thing unless the capture has
+timestamps going backwards).
+
+Usage (from Core/loki):
+    python3 batch_engine.py capture.pcap [more.pcap ...] [--chain input]
+    python3 batch_engine.py capture.pcap --cross-check        # also run the live detector, diff the results
+    python3 batch_engine.py capture.pcap --alerts ../../logs/forensic_alerts.jsonl
+"""
+import argparse
+import json
+import struct
+import sys
+import time
+from array import array
+from datetime import datetime
+
+import numpy as np
+
+from detectore_engine import PortScanningDetector
+from logger import logger
+from packet_parser import decode_packet
+from replay import (read_packets, LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_LINUX_SLL, LINKTYPE_IPV4,
+                    LINKTYPE_LINUX_SLL2, ETH_P_IP, ETH_P_8021Q, ETH_P_8021AD)
+
+# detection codes, one per alert message of process_packet
+PORT_SCAN = 1
+TCP_FLOOD = 2
+UDP_FLOOD = 3
+ICMP_FLOOD = 4
+
+MESSAGES = {
+    PORT_SCAN: "Port Scan Detected on {chain} chain",
+    TCP_FLOOD: "TCP Flood (DoS/DDoS) Detected on {chain} chain",
+    UDP_FLOOD: "UDP Flood (DoS/DDoS) Detected on {chain} chain",
+    ICMP_FLOOD: "ICMP Flood (DoS/DDoS) Detected on {chain} chain",
+}
+
+# longest IPv4 header (60 bytes) + the 14 bytes of TCP header we read
+HEADER_BYTES = 76
+
+LOOPBACK = 0x7F000001
+
+
+class PacketColumns:
+    """Header fields of every packet of the captures, one array per field (index = packet number)."""
+
+    def __init__(self, ts, src, dst, proto, sport, dport, flags, icmp_type, kind, load_time):
+        self.ts = ts               # float64 capture time
+        self.src = src             # uint32 addresses
+        self.dst = dst
+        self.proto = proto
+        self.sport = sport
+        self.dport = dport
+        self.flags = flags         # TCP flags (with NS as bit 8), 0 otherwise
+        self.icmp_type = icmp_type # -1 when not ICMP
+        self.kind = kind           # 0 / PROTO_TCP / PROTO_UDP / PROTO_ICMP when the transport header was decoded
+        self.load_time = load_time # stands in for the missing capture timestamps (0)
+
+    def __len__(self):
+        return len(self.ts)
+
+
+class _Packets:
+    """IPv4 packets in one byte buffer: packet i starts at ip[i], avail[i] of its length[i] bytes are there."""
+
+    def __init__(self, ts, raw, ip, avail, length):
+        self.ts = ts
+        self.raw = raw
+        self.ip = ip
+        self.avail = avail
+        self.length = length
+
+    def byte(self, offset):
+        """byte `offset` (array or int) of every packet, 0 past what was captured"""
+        ok = offset < self.avail
+        return np.where(ok, self.raw[self.ip + offset * ok], 0).astype(np.int64)
+
+    def be16(self, offset):
+        return (self.byte(offset) << 8) | self.byte(offset + 1)
+
+    def be32(self, offset):
+        return (self.be16(offset) << 16) | self.be16(offset + 2)
+
+
+def _pcap_packets(path):
+    """
+    Classic pcap: its IPv4 packets as a _Packets, the same packets
+    replay.read_packets yields. Only the walk over the record headers is a
+    Python loop, the link layer is stripped on whole arrays.
+    Returns None for pcapng (read_packets handles it).
+    """
+    with open(path, "rb") as f:
+        header = f.read(24)
+        if header[:4] not in (b"\xd4\xc3\xb2\xa1", b"\xa1\xb2\xc3\xd4", b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d"):
+            return None
+        data = f.read()
+    endian = "<" if header[:4] in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1") else ">"
+    divisor = 1e9 if header[:4] in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d") else 1e6
+    linktype = struct.unpack(endian + "I", header[20:24])[0] & 0x0FFFFFFF
+
+    # the records have to be walked one by one (each gives the length of the
+    # next hop), keep that loop as small as it gets: record offsets only.
+    incl_len = struct.Struct(endian + "I").unpack_from
+    offsets = array("q")
+    append = offsets.append
+    pos = 0
+    size = len(data)
+    while pos + 16 <= size:
+        append(pos)
+        pos += 16 + incl_len(data, pos + 8)[0]
+    if pos > size:
+        offsets.pop() # truncated last record, read_packets stops there too
+    record = np.frombuffer(offsets, dtype=np.int64)
+    raw = np.frombuffer(data, dtype=np.uint8)
+    words = raw[record[:, None] + np.arange(12)].view(endian + "u4").astype(np.int64)
+    ts = words[:, 0] + words[:, 1] / divisor
+    caplen = words[:, 2]
+    # from here on, offsets are relative to the frame
+    frames = _Packets(ts, raw, record + 16, caplen, caplen)
+
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        start = np.zeros(len(ts), dtype=np.int64)
+        keep = np.ones(len(ts), dtype=bool)
+    elif linktype == LINKTYPE_ETHERNET:
+        offset = np.full(len(ts), 12, dtype=np.int64)
+        keep = caplen >= 14
+        ethertype = frames.be16(offset)
+        while True:
+            tagged = keep & ((ethertype == ETH_P_8021Q) | (ethertype == ETH_P_8021AD)) & (caplen >= offset + 6)
+            if not tagged.any():
+                break
+            offset = offset + 4 * tagged
+            ethertype = np.where(tagged, frames.be16(offset), ethertype)
+        keep &= ethertype == ETH_P_IP
+        start = offset + 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        keep = (caplen >= 16) & (frames.be16(14) == ETH_P_IP)
+        start = np.full(len(ts), 16, dtype=np.int64)
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        keep = (caplen >= 20) & (frames.be16(0) == ETH_P_IP)
+        start = np.full(len(ts), 20, dtype=np.int64)
+    else:
+        keep = np.zeros(len(ts), dtype=bool)
+        start = np.zeros(len(ts), dtype=np.int64)
+    keep &= (start < caplen) & (frames.byte(start) >> 4 == 4)
+
+    length = (caplen - start)[keep]
+    return _Packets(ts[keep], raw, (record + 16 + start)[keep], length, length)
+
+
+def _read_packets(path):
+    """pcapng (or anything read_packets knows): packet by packet, only the first HEADER_BYTES are kept"""
+    stamps = array("d")
+    lengths = array("q")
+    headers = bytearray()
+    pad = bytes(HEADER_BYTES)
+    for timestamp, ip in read_packets(path):
+        stamps.append(timestamp)
+        lengths.append(len(ip))
+        head = ip[:HEADER_BYTES]
+        headers += head
+        if len(head) < HEADER_BYTES:
+            headers += pad[len(head):]
+    n = len(stamps)
+    length = np.frombuffer(lengths, dtype=np.int64)
+    return _Packets(np.frombuffer(stamps, dtype=np.float64), np.frombuffer(bytes(headers), dtype=np.uint8),
+                    np.arange(n, dtype=np.int64) * HEADER_BYTES, np.minimum(length, HEADER_BYTES), length)
+
+
+def load_columns(paths):
+    """
+    Read every IPv4 packet of `paths` into a PacketColumns, decoded like
+    packet_parser.decode_packet (same validity checks, first fragments only).
+    """
+    load_time = time.time()
+    columns = []
+    for path in paths:
+        packets = _pcap_packets(path)
+        if packets is None:
+            packets = _read_packets(path)
+        columns.append(_decode(packets))
+    ts, src, dst, proto, sport, dport, flags, icmp_type, kind = (
+        np.concatenate([part[i] for part in columns]) for i in range(9))
+    ts = ts.astype(np.float64)
+    ts[ts == 0] = load_time # like scan_packet: no timestamp = now
+    return PacketColumns(ts, src.astype(np.uint32), dst.astype(np.uint32), proto, sport, dport, flags,
+                         icmp_type, kind, load_time)
+
+
+def _decode(p):
+    """decode_packet on whole arrays: the columns of a _Packets"""
+    length = p.length
+    ihl = (p.byte(0) & 0x0F) << 2
+    total_len = p.be16(2)
+    frag = p.be16(6) & 0x1FFF
+    proto = p.byte(9)
+    src = p.be32(12)
+    dst = p.be32(16)
+
+    valid = (length >= 20) & (ihl >= 20) & (ihl <= length)
+    # the copy range may have truncated the packet, same rule as decode_packet
+    end = np.where((ihl <= total_len) & (total_len <= length), total_len, length)
+    room = end - ihl
+    first = valid & (frag == 0)
+    is_tcp = first & (proto == 6) & (room >= 20)
+    is_udp = first & (proto == 17) & (room >= 8)
+    is_icmp = first & (proto == 1) & (room >= 8)
+    ported = is_tcp | is_udp
+
+    sport = np.where(ported, p.be16(ihl), 0)
+    dport = np.where(ported, p.be16(ihl + 2), 0)
+    flags = np.where(is_tcp, ((p.byte(ihl + 12) & 0x01) << 8) | p.byte(ihl + 13), 0)
+    icmp_type = np.where(is_icmp, p.byte(ihl), -1)
+    kind = np.select([is_tcp, is_udp, is_icmp], [6, 17, 1], 0)
+    kind[~valid] = -1 # not a packet decode_packet would return
+    return p.ts, src, dst, proto, sport, dport, flags, icmp_type, kind
+
+
+def _group_starts(keys):
+    """keys sorted: position of the first element of each element's group"""
+    n = len(keys)
+    change = np.ones(n, dtype=bool)
+    change[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(change)
+    return starts[np.cumsum(change) - 1]
+
+
+def _window_starts(keys, ts, window):
+    """
+    keys / ts sorted by (key, time): first position j of each element's group
+    with ts[i] - ts[j] <= window, the same float comparison the live windows do.
+    """
+    n = len(ts)
+    positions = np.arange(n)
+    gstart = _group_starts(keys)
+    if not n:
+        return positions, gstart
+    # first guess with an integer search on (group, time), then fix the
+    # boundary with the exact comparison (rounding moves it by a few at most)
+    group = np.cumsum(np.r_[True, keys[1:] != keys[:-1]]) - 1
+    base = ts.min()
+    resolution = 1e6
+    span = (ts.max() - base + window) * resolution + 2
+    while (group[-1] + 1) * span > 2 ** 62:
+        resolution /= 10
+        span = (ts.max() - base + window) * resolution + 2
+    composite = group * np.int64(span) + np.round((ts - base) * resolution).astype(np.int64)
+    starts = np.searchsorted(composite, composite - np.int64(round(window * resolution)), side="left")
+    starts = np.clip(starts, gstart, positions)
+    while True:
+        back = (starts > gstart) & (ts - ts[np.maximum(starts - 1, 0)] <= window)
+        forward = ts - ts[starts] > window
+        if not back.any() and not forward.any():
+            return starts, gstart
+        starts = starts - back + forward
+
+
+def _window_counts(keys, ts, window, slices):
+    """
+    keys / ts sorted by (key, time): count of each packet's window, including
+    itself, as ExactWindowCounter (slices 0) or SlidingWindowCounter return it.
+    """
+    n = len(ts)
+    positions = np.arange(n)
+    if not n:
+        return np.zeros(0)
+    if not slices:
+        starts, _gstart = _window_starts(keys, ts, window)
+        return (positions - starts + 1).astype(np.float64)
+
+    width = window / slices
+    index = np.floor_divide(ts, width).astype(np.int64) # absolute slice, int(timestamp // width)
+    group = np.cumsum(np.r_[True, keys[1:] != keys[:-1]]) - 1
+    span = index.max() - index.min() + slices + 2
+    composite = group * span + (index - index.min())
+    # the ring holds the slices current - slices .. current, the oldest one only partly counts
+    oldest_start = np.searchsorted(composite, composite - slices, side="left")
+    oldest_end = np.searchsorted(composite, composite - slices + 1, side="left")
+    total = (positions - oldest_start + 1).astype(np.float64)
+    oldest = (oldest_end - oldest_start).astype(np.float64)
+    inside = np.clip(1.0 - (ts / width - index), 0.0, 1.0)
+    return np.where(oldest > 0, total - oldest + oldest * inside, total)
+
+
+def _distinct_ports(keys, ports, ts, window):
+    """
+    keys / ts sorted by (key, time): distinct ports in each packet's window, as
+    DistinctPortWindow returns it. A packet counts for the windows where it's
+    the first hit of its port, that's a range of windows (they only move
+    forward), so every packet adds 1 to a range of the output: difference
+    array + cumsum.
+    """
+    n = len(ts)
+    if not n:
+        return np.zeros(0, dtype=np.int64)
+    positions = np.arange(n)
+    starts, gstart = _window_starts(keys, ts, window)
+    # previous hit of the same port by the same key (or just before the group)
+    order = np.lexsort((positions, ports, keys))
+    same = np.zeros(n, dtype=bool)
+    same[1:] = (keys[order][1:] == keys[order][:-1]) & (ports[order][1:] == ports[order][:-1])
+    previous = np.empty(n, dtype=np.int64)
+    previous[order] = np.where(same, np.r_[-1, order[:-1]], gstart[order] - 1)
+    # windows i >= j with previous < starts[i] <= j
+    low = np.maximum(positions, np.searchsorted(starts, previous, side="right"))
+    high = np.searchsorted(starts, positions, side="right") - 1
+    counted = low <= high
+    diff = np.bincount(low[counted], minlength=n + 1) - np.bincount(high[counted] + 1, minlength=n + 1)
+    return np.cumsum(diff)[:n]
+
+
+def _sorted_by(keys, ts, selected):
+    """packet numbers of `selected`, sorted by (key, time, packet number)"""
+    picked = np.flatnonzero(selected)
+    order = np.lexsort((picked, ts[picked], keys[picked]))
+    return picked[order]
+
+
+class BatchResult:
+    """Packets flagged by the batch engine: packet numbers and detection codes, in packet order."""
+
+    def __init__(self, columns, packets, codes, chain_name, timings):
+        self.columns = columns
+        self.packets = packets
+        self.codes = codes
+        self.chain_name = chain_name
+        self.timings = timings
+
+    def hits(self):
+        """set of (packet number, code), what cross_check compares"""
+        return set(zip(self.packets.tolist(), self.codes.tolist()))
+
+    def counts(self):
+        """alert message -> flagged packets (what replay.py reports as alerts)"""
+        codes, counts = np.unique(self.codes, return_counts=True)
+        return {MESSAGES[code].format(chain=self.chain_name): int(count)
+                for code, count in zip(codes.tolist(), counts.tolist())}
+
+    def alerts(self, cooldown=None):
+        """
+        The alerts the live logger would have written: flagged packets grouped
+        by its aggregation key (a port scan is one alert whatever the port),
+        split when a key is quiet for longer than the alert cooldown.
+        Times are capture times. Returns a list of records, oldest first.
+        """
+        cooldown = logger.alert_cooldown if cooldown is None else cooldown
+        c = self.columns
+        packets, codes = self.packets, self.codes
+        if not len(packets):
+            return []
+        port = np.where(codes == PORT_SCAN, -1, c.dport[packets])
+        order = np.lexsort((packets, port, c.dst[packets], c.src[packets], codes))
+        packets, codes, port = packets[order], codes[order], port[order]
+        src, dst, ts = c.src[packets], c.dst[packets], c.ts[packets]
+        new_key = np.r_[True, (codes[1:] != codes[:-1]) | (src[1:] != src[:-1]) |
+                        (dst[1:] != dst[:-1]) | (port[1:] != port[:-1])]
+        new_alert = new_key | np.r_[True, ts[1:] - ts[:-1] > cooldown]
+        first = np.flatnonzero(new_alert)
+        last = np.r_[first[1:], len(packets)] - 1
+
+        records = []
+        for a, b in zip(first.tolist(), last.tolist()):
+            i = int(packets[a])
+            duration = float(ts[b] - ts[a])
+            total = b - a + 1
+            dst_ip = _ntoa(c.dst[i])
+            records.append({
+                "timestamp": datetime.utcfromtimestamp(float(ts[a])).isoformat(),
+                "status": "ENDED",
+                "type": "BEHAVIOR",
+                "src_ip": _ntoa(c.src[i]),
+                "src_port": int(c.sport[i]),
+                "dst_ip": dst_ip,
+                "dst_port": int(c.dport[i]),
+                "message": MESSAGES[int(codes[a])].format(chain=self.chain_name),
+                "total_duration_seconds": round(duration, 2),
+                "total_packets": total,
+                "average_rate_pps": round(total / duration, 1) if duration > 0 else 0,
+                "first_seen": datetime.utcfromtimestamp(float(ts[a])).isoformat(),
+                "last_seen": datetime.utcfromtimestamp(float(ts[b])).isoformat(),
+                "details": {"dst_ip": dst_ip, "dst_port": int(c.dport[i]), "chain": self.chain_name,
+                            "first_packet": i, "source": "batch"},
+            })
+        records.sort(key=lambda record: record["first_seen"])
+        return records
+
+
+def _ntoa(value):
+    value = int(value)
+    return f"{value >> 24}.{(value >> 16) & 0xFF}.{(value >> 8) & 0xFF}.{value & 0xFF}"
+
+
+class BatchDetector:
+    """
+    The behavior detectors of PortScanningDetector over whole columns.
+    Windows and thresholds come from `detector` (a fresh one when not given).
+    """
+
+    def __init__(self, detector=None, counter_slices=None):
+        if detector is None:
+            detector = PortScanningDetector(15, 10, counter_slices=counter_slices)
+        self.detector = detector
+        self.counter_slices = detector.counter_slices
+
+    def run(self, columns, is_input=True):
+        d = self.detector
+        c = columns
+        started = time.perf_counter()
+        usable = (c.kind >= 0) & ~((c.src == LOOPBACK) & (c.dst == LOOPBACK))
+        syn = usable & (c.kind == 6) & ((c.flags & 0x02) != 0) & ((c.flags & 0x10) == 0)
+        udp = usable & (c.kind == 17)
+        echo = usable & (c.kind == 1) & (c.icmp_type == 8)
+        packets, codes = [], []
+
+        # port scan: distinct destination ports per (src, dst)
+        pair = (c.src.astype(np.uint64) << np.uint64(32)) | c.dst.astype(np.uint64)
+        order = _sorted_by(pair, c.ts, syn)
+        distinct = _distinct_ports(pair[order], c.dport[order], c.ts[order], d.port_scanning_window)
+        scan = order[distinct > d.port_scanning_threshold]
+        packets.append(scan)
+        codes.append(np.full(len(scan), PORT_SCAN))
+
+        # floods: packets per (dst, dst port) / per dst. A SYN flagged as a
+        # scan never reaches the TCP flood counter (analyze_tcp returns first).
+        service = (c.dst.astype(np.uint64) << np.uint64(16)) | c.dport.astype(np.uint64)
+        not_scan = syn.copy()
+        not_scan[scan] = False
+        for selected, keys, window, threshold, code in (
+                (not_scan, service, d.tcp_flood_window, d.tcp_flood_threshold, TCP_FLOOD),
+                (udp, service, d.udp_flood_window, d.udp_flood_threshold, UDP_FLOOD),
+                (echo, c.dst.astype(np.uint64), d.icmp_flood_window, d.icmp_flood_threshold, ICMP_FLOOD)):
+            order = _sorted_by(keys, c.ts, selected)
+            counts = _window_counts(keys[order], c.ts[order], window, self.counter_slices)
+            flood = order[counts > threshold]
+            packets.append(flood)
+            codes.append(np.full(len(flood), code))
+
+        packets = np.concatenate(packets)
+        codes = np.concatenate(codes)
+        order = np.argsort(packets, kind="stable")
+        timings = {"detect_seconds": round(time.perf_counter() - started, 3)}
+        return BatchResult(columns, packets[order], codes[order], "INPUT" if is_input else "FORWARD", timings)
+
+
+def live_hits(paths, detector, load_time=None):
+    """
+    The per-packet path on the same captures: decode_packet + the detector
+    calls of process_packet (without blocklist, flow cache or signatures).
+    Returns the set of (packet number, code) it flags.
+    """
+    load_time = time.time() if load_time is None else load_time
+    hits = set()
+    index = -1
+    for path in paths:
+        for timestamp, ip in read_packets(path):
+            index += 1
+            info = decode_packet(ip, timestamp or load_time, index)
+            if info is None or (info.src_ip == "127.0.0.1" and info.dst_ip == "127.0.0.1"):
+                continue
+            port = info.port
+            if port == "TCP" and (info.tcp_flags & 0x02) and not (info.tcp_flags & 0x10):
+                result = detector.analyze_tcp(info.src_ip, info.dst_ip, info.rawts, info.dst_port)
+                if result:
+                    hits.add((index, PORT_SCAN if result == 1 else TCP_FLOOD))
+            elif port == "UDP":
+                if detector.analyze_udp(info.dst_ip, info.rawts, info.dst_port):
+                    hits.add((index, UDP_FLOOD))
+            elif port == "ICMP" and info.icmp_type == 8:
+                if detector.analyze_icmp(info.dst_ip, info.rawts):
+                    hits.add((index, ICMP_FLOOD))
+    return hits
+
+
+def cross_check(paths, result, counter_slices=None, examples=10):
+    """Run the live detector over the same captures and diff its hits with `result`."""
+    # the batch engine counts the distinct ports exactly, compare with the exact live window
+    detector = PortScanningDetector(15, 10, counter_slices=counter_slices, port_scan_mode="exact")
+    started = time.perf_counter()
+    live = live_hits(paths, detector, result.columns.load_time)
+    elapsed = time.perf_counter() - started
+    batch = result.hits()
+    only_batch = sorted(batch - live)
+    only_live = sorted(live - batch)
+    return {
+        "batch_hits": len(batch),
+        "live_hits": len(live),
+        "matching": len(batch & live),
+        "only_batch": len(only_batch),
+        "only_live": len(only_live),
+        "only_batch_examples": only_batch[:examples],
+        "only_live_examples": only_live[:examples],
+        "live_seconds": round(elapsed, 3),
+        "identical": not only_batch and not only_live,
+    }
+
+
+def analyze(paths, is_input=True, counter_slices=None):
+    """Load + detect, returns the BatchResult (with load/detect timings)."""
+    started = time.perf_counter()
+    columns = load_columns(paths)
+    loaded = time.perf_counter() - started
+    result = BatchDetector(counter_slices=counter_slices).run(columns, is_input)
+    result.timings["load_seconds"] = round(loaded, 3)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vectorized behavior detection over pcap captures.")
+    parser.add_argument("pcaps", nargs="+")
+    parser.add_argument("--chain", choices=("input", "forward"), default="input")
+    parser.add_argument("--counter-slices", type=int,
+                        help="flood counter resolution, 0 = exact deques (default: detector_state.counter_slices)")
+    parser.add_argument("--cross-check", action="store_true",
+                        help="also run the per-packet detector and diff the flagged packets")
+    parser.add_argument("--alerts", help="write the alerts (capture times) to this JSONL file")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    result = analyze(args.pcaps, is_input=(args.chain == "input"), counter_slices=args.counter_slices)
+    alerts = result.alerts()
+    report = {
+        "files": args.pcaps,
+        "packets": len(result.columns),
+        "timings": result.timings,
+        "flagged_by_message": result.counts(),
+        "alerts": len(alerts),
+    }
+    if args.cross_check:
+        report["cross_check"] = cross_check(args.pcaps, result, counter_slices=args.counter_slices)
+    if args.alerts:
+        with open(args.alerts, "w") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in alerts))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    timings = result.timings
+    print(f"[*] packets: {report['packets']}, loaded in {timings['load_seconds']}s, "
+          f"detectors {timings['detect_seconds']}s")
+    for message, count in sorted(report["flagged_by_message"].items()):
+        print(f"      {count:>8}  {message}")
+    print(f"[*] alerts: {report['alerts']}" + (f" (written to {args.alerts})" if args.alerts else ""))
+    for record in alerts[:10]:
+        print(f"      {record['first_seen']}  {record['src_ip']} -> {record['dst_ip']}:{record['dst_port']}  "
+              f"{record['message']} ({record['total_packets']} packets)")
+    if args.cross_check:
+        check = report["cross_check"]
+        verdict = "identical" if check["identical"] else \
+            f"{check['only_batch']} only in batch, {check['only_live']} only live"
+        print(f"[*] cross-check: {check['matching']}/{check['live_hits']} live hits matched, {verdict}; "
+              f"live detector {check['live_seconds']}s vs batch "
+              f"{timings['load_seconds'] + timings['detect_seconds']:.3f}s")
+        for packet, code in check["only_batch_examples"]:
+            print(f"      only batch: packet {packet} {MESSAGES[code].format(chain=result.chain_name)}")
+        for packet, code in check["only_live_examples"]:
+            print(f"      only live:  packet {packet} {MESSAGES[code].format(chain=result.chain_name)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+import ipaddress
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+
+from config import config
+from logger import logger
+
+# IP blocklist, checked on the raw IPv4 header before anything else is decoded.
+#
+# Single addresses live in a dict (int -> entry), CIDR ranges are flattened
+# into a sorted table of disjoint [start, end] integer intervals searched with
+# bisect, so a lookup is one dict probe plus one O(log n) bisect whatever the
+# size of the list. Entries can expire (TTL) and the list is saved to
+# logs/blocklist.json so blocks survive a restart.
+#
+# The detectors add temporary blocks on their own, only for what the source
+# itself did (signature drop after a verified TCP handshake, port scan), so the
+# next packets of a known attacker are dropped for the price of the lookup
+# instead of going through the whole analysis again. Floods are never blocked
+# by source: they're counted per victim and their sources can be spoofed.
+
+FOREVER = 0.0 # expires value of a permanent entry
+
+
+class BlockEntry:
+    __slots__ = ("expires", "reason")
+
+    def __init__(self, expires, reason):
+        self.expires = expires  # wall clock time, FOREVER = never
+        self.reason = reason
+
+    def alive(self, now):
+        return self.expires == FOREVER or self.expires > now
+
+
+def _parse(address):
+    """'1.2.3.4' or '10.0.0.0/8' -> (first, last) as integers."""
+    network = ipaddress.IPv4Network(str(address).strip(), strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+
+def _network_str(first, last):
+    if first == last:
+        return str(ipaddress.IPv4Address(first))
+    prefix = 32 - (last - first + 1).bit_length() + 1
+    return f"{ipaddress.IPv4Address(first)}/{prefix}"
+
+
+class IPBlocklist:
+    def __init__(self, max_entries=100000, persist_path=None, never_block=()):
+        """
+        Args:
+            max_entries (int): cap on the number of entries, automatic blocks are refused past it.
+            persist_path (str): JSON file the list is saved to / loaded from (None = memory only).
+            never_block (list): CIDRs the automatic blocks must never cover (ourselves, the gateway..).
+        """
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self.never_block = [_parse(network) for network in never_block]
+
+        self.hosts = {}    # ip int -> BlockEntry
+        self.networks = {} # (first, last) -> BlockEntry
+        # flattened ranges: disjoint sorted intervals, swapped in as one tuple so
+        # the packet threads never see a half built table.
+        self._ranges = ((), (), ())
+        self._lock = threading.Lock() # writers only, lookups don't take it
+        self._dirty = False
+
+        # Statistics
+        self.hits = 0
+        self.refused = 0
+
+    def __len__(self):
+        return len(self.hosts) + len(self.networks)
+
+    # ------------------------------------------------------------ hot path
+
+    def lookup(self, ip, now):
+        """BlockEntry covering the integer address `ip`, or None."""
+        entry = self.hosts.get(ip)
+        if entry is not None and (entry.expires == FOREVER or entry.expires > now):
+            self.hits += 1
+            return entry
+        starts, ends, entries = self._ranges
+        if not starts:
+            return None
+        i = bisect_right(starts, ip) - 1
+        if i < 0 or ip > ends[i]:
+            return None
+        entry = entries[i]
+        if entry.expires != FOREVER and entry.expires <= now:
+            return None # expired, the maintenance sweep takes it out
+        self.hits += 1
+        return entry
+
+    def check_header(self, raw, now, match_destination=False):
+        """
+        Look the source (and destination) address of a raw IPv4 packet up,
+        without decoding anything else. Returns the BlockEntry or None.
+        """
+        if len(raw) < 20 or raw[0] >> 4 != 4:
+            return None
+        entry = self.lookup(int.from_bytes(raw[12:16], "big"), now)
+        if entry is None and match_destination:
+            entry = self.lookup(int.from_bytes(raw[16:20], "big"), now)
+        return entry
+
+    # ------------------------------------------------------------ changes
+
+    def block(self, address, ttl=None, reason="", automatic=False):
+        """
+        Block an address or CIDR for `ttl` seconds (None/0 = forever).
+        An existing entry is only extended, never shortened. Returns False if
+        the block was refused (never_block list, or full for automatic blocks).
+        """
+        first, last = _parse(address)
+        if automatic:
+            for low, high in self.never_block:
+                if first <= high and last >= low:
+                    self.refused += 1
+                    return False
+        expires = time.time() + ttl if ttl else FOREVER
+
+        with self._lock:
+            table = self.hosts if first == last else self.networks
+            key = first if first == last else (first, last)
+            entry = table.get(key)
+            if entry is not None:
+                if entry.expires != FOREVER and (expires == FOREVER or expires > entry.expires):
+                    entry.expires = expires
+                    entry.reason = reason or entry.reason
+                    if table is self.networks:
+                        self._rebuild()
+                    self._dirty = True
+                return True
+            if len(self) >= self.max_entries:
+                self.refused += 1
+                if automatic:
+                    return False
+                logger.log_system_event(f"Blocklist is over its {self.max_entries} entries cap", "WARNING")
+            table[key] = BlockEntry(expires, reason)
+            if table is self.networks:
+                self._rebuild()
+            self._dirty = True
+        return True
+
+    def unblock(self, address):
+        first, last = _parse(address)
+        with self._lock:
+            if first == last:
+                removed = self.hosts.pop(first, None)
+            else:
+                removed = self.networks.pop((first, last), None)
+                self._rebuild()
+            if removed is not None:
+                self._dirty = True
+        return removed is not None
+
+    def _rebuild(self):
+        """
+        Flatten the CIDR entries into disjoint intervals (lock held).
+        Two CIDR blocks are either nested or disjoint, so going through them
+        parents first, a block only has to split the piece it falls into, and
+        only when it outlives the block(s) around it.
+        """
+        now = time.time()
+        points = [(first, last, entry) for (first, last), entry in self.networks.items() if entry.alive(now)]
+        points.sort(key=lambda item: (item[0], -item[1]))
+
+        starts, ends, entries = [], [], []
+        for first, last, entry in points:
+            i = bisect_right(starts, first) - 1
+            if i < 0 or first > ends[i]:
+                starts.insert(i + 1, first)
+                ends.insert(i + 1, last)
+                entries.insert(i + 1, entry)
+                continue
+            cover = entries[i]
+            if cover.expires == FOREVER or (entry.expires != FOREVER and entry.expires <= cover.expires):
+                continue # the enclosing block lasts longer anyway
+            pieces = []
+            if starts[i] < first:
+                pieces.append((starts[i], first - 1, cover))
+            pieces.append((first, last, entry))
+            if last < ends[i]:
+                pieces.append((last + 1, ends[i], cover))
+            starts[i:i + 1] = [piece[0] for piece in pieces]
+            ends[i:i + 1] = [piece[1] for piece in pieces]
+            entries[i:i + 1] = [piece[2] for piece in pieces]
+        self._ranges = (tuple(starts), tuple(ends), tuple(entries))
+
+    def sweep(self):
+        """Drop expired entries (maintenance thread), returns how many went."""
+        now = time.time()
+        with self._lock:
+            expired = [ip for ip, entry in self.hosts.items() if not entry.alive(now)]
+            for ip in expired:
+                del self.hosts[ip]
+            expired_networks = [key for key, entry in self.networks.items() if not entry.alive(now)]
+            for key in expired_networks:
+                del self.networks[key]
+            if expired_networks:
+                self._rebuild()
+            count = len(expired) + len(expired_networks)
+            if count:
+                self._dirty = True
+        return count
+
+    # ------------------------------------------------------------ persistence
+
+    def save(self, force=False):
+        if not self.persist_path or not (self._dirty or force):
+            return
+        now = time.time()
+        with self._lock:
+            records = []
+            for ip, entry in self.hosts.items():
+                if entry.alive(now):
+                    records.append({"address": _network_str(ip, ip), "expires": entry.expires or None,
+                                    "reason": entry.reason})
+            for (first, last), entry in self.networks.items():
+                if entry.alive(now):
+                    records.append({"address": _network_str(first, last), "expires": entry.expires or None,
+                                    "reason": entry.reason})
+            self._dirty = False
+        tmp_path = self.persist_path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(records, f, indent=1)
+            os.replace(tmp_path, self.persist_path)
+        except Exception as e:
+            logger.log_system_event(f"Failed to save the blocklist to {self.persist_path}: {e}", "ERROR")
+
+    def load(self, path=None):
+        """Merge the entries saved in `path` (default: the persist file), expired ones are skipped."""
+        path = path or self.persist_path
+        if not path or not os.path.exists(path):
+            return 0
+        try:
+            with open(path, 'r') as f:
+                records = json.load(f)
+        except Exception as e:
+            logger.log_system_event(f"Failed to load the blocklist {path}: {e}", "ERROR")
+            return 0
+        now = time.time()
+        loaded = 0
+        for record in records:
+            expires = record.get("expires") or FOREVER
+            if expires != FOREVER and expires <= now:
+                continue
+            try:
+                self.block(record["address"], ttl=(expires - now) if expires else None,
+                           reason=record.get("reason", ""))
+                loaded += 1
+            except (KeyError, ValueError) as e:
+                logger.log_system_event(f"Skipping bad blocklist entry {record}: {e}", "WARNING")
+        return loaded
+
+    def stats(self):
+        return {
+            "hosts": len(self.hosts),
+            "networks": len(self.networks),
+            "ranges": len(self._ranges[0]),
+            "hits": self.hits,
+            "refused": self.refused,
+        }
+
+
+blocklist_config = config["blocklist"]
+
+# one blocklist per process, like the logger
+blocklist = None
+if blocklist_config["enabled"]:
+    blocklist = IPBlocklist(
+        max_entries=blocklist_config["max_entries"],
+        persist_path=os.path.join(logger.log_dir, "blocklist.json") if blocklist_config["persist"] else None,
+        never_block=blocklist_config["never_block"],
+    )
+    for address in blocklist_config["static"]:
+        try:
+            blocklist.block(address, reason="static")
+        except ValueError as e:
+            logger.log_system_event(f"Bad blocklist entry in the config: {address} ({e})", "ERROR")
+    blocklist.load()
@@ -0,0 +1,244 @@
+"""
+Cross-sensor collector for Loki IDS.
+
+Receives the heavy hitter summaries the nodes export (summary_export.py),
+adds up the summaries of the same window from every node and queue, and
+applies global thresholds: an attack spread over several gateways shows up
+here even when every node stays under its own thresholds.
+
+Usage (from Core/loki):
+    python3 collector.py --spool ../../logs/summaries          # watch a spool directory
+    python3 collector.py --socket ../../logs/collector.sock    # unix datagram socket
+    python3 collector.py --spool DIR --once                    # merge what's there, print, exit
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import time
+
+from config import config
+from logger import logger, AlertKind
+from sketches import CountMinSketch
+from summary_export import decode_summary, spool_files, SummaryFormatError
+
+collector_config = config["collector"]
+
+
+class MergedWindow:
+    """Everything received for one window."""
+
+    def __init__(self, window_start, window):
+        self.window_start = window_start
+        self.window = window
+        self.senders = set()  # (node, chain, queue) already merged, a resent summary is ignored
+        self.counts = {}      # table name -> CountMinSketch, sum of every sender
+        self.candidates = {}  # table name -> set of keys in somebody's top list
+
+
+class Collector:
+    def __init__(self, thresholds=None, grace=5.0, top_k=20):
+        """
+        Args:
+            thresholds (dict): table name ("src", "dst", "dst_port") -> packets per window
+                over all the nodes before an alert, 0 = none.
+            grace (float): seconds after the end of a window we wait for late nodes.
+        """
+        self.thresholds = thresholds or {}
+        self.grace = grace
+        self.top_k = top_k
+        self.windows = {} # window_start -> MergedWindow
+        self.finished_until = None # windows starting before this are done, their summaries come too late
+
+        # Statistics
+        self.received = 0
+        self.duplicates = 0
+        self.late = 0
+        self.rejected = 0
+
+    def add(self, data):
+        """Merge one encoded summary. Returns the NodeSummary, or None if it was ignored."""
+        try:
+            summary = decode_summary(data)
+        except SummaryFormatError as e:
+            self.rejected += 1
+            logger.log_system_event(f"Rejected a summary: {e}", "WARNING")
+            return None
+        if self.finished_until is not None and summary.window_start < self.finished_until:
+            self.late += 1
+            return None
+        merged = self.windows.get(summary.window_start)
+        if merged is None:
+            merged = self.windows[summary.window_start] = MergedWindow(summary.window_start, summary.window)
+        sender = (summary.node, summary.chain, summary.queue)
+        if sender in merged.senders:
+            self.duplicates += 1
+            return None
+        merged.senders.add(sender)
+        self.received += 1
+
+        for name, table in summary.tables.items():
+            counts = merged.counts.get(name)
+            if counts is None:
+                counts = merged.counts[name] = CountMinSketch(table.counts.width, table.counts.depth)
+            try:
+                counts.merge(table.counts)
+            except ValueError as e:
+                self.rejected += 1
+                logger.log_system_event(f"Summary of {summary.node} q{summary.queue} not merged: {e}", "WARNING")
+                continue
+            merged.candidates.setdefault(name, set()).update(key for key, _count, _error in table.top)
+        return summary
+
+    def due(self, now):
+        """Windows whose grace period is over."""
+        return sorted(start for start, merged in self.windows.items()
+                      if start + merged.window + self.grace <= now)
+
+    def finish(self, window_start):
+        """
+        Close a window: global top lists (the keys some node had in its top list,
+        ranked by the merged counters) and the alerts. Returns a report dict.
+        """
+        merged = self.windows.pop(window_start)
+        self.finished_until = max(self.finished_until or 0, window_start + merged.window)
+        report = {"window_start": window_start, "window": merged.window,
+                  "senders": sorted(f"{node}/{chain}/q{queue}" for node, chain, queue in merged.senders),
+                  "tables": {}, "alerts": []}
+        for name, counts in merged.counts.items():
+            ranked = sorted(((key, counts.estimate(key)) for key in merged.candidates.get(name, ())),
+                            key=lambda item: item[1], reverse=True)[:self.top_k]
+            report["tables"][name] = {"packets": counts.total, "top": ranked}
+            threshold = self.thresholds.get(name, 0)
+            for key, estimate in ranked:
+                if threshold and estimate > threshold:
+                    report["alerts"].append((name, key, estimate))
+                    self._alert(merged, name, key, estimate)
+        return report
+
+    def finish_due(self, now=None):
+        return [self.finish(start) for start in self.due(time.time() if now is None else now)]
+
+    def finish_all(self):
+        return [self.finish(start) for start in sorted(self.windows)]
+
+    def _alert(self, merged, name, key, estimate):
+        src_ip = dst_ip = "*"
+        dst_port = 0
+        if name == "src":
+            src_ip = key
+        elif name == "dst":
+            dst_ip = key
+        else:
+            port = key.rsplit("/", 1)[-1] # "UDP/53"
+            dst_port = int(port) if port.isdigit() else 0
+        logger.log_alert(
+            alert_type=AlertKind.BEHAVIOR,
+            src_ip=src_ip,
+            dst_ip=dst_ip,
+            src_port=0,
+            dst_port=dst_port,
+            message=f"Global Heavy Hitter ({name}) across sensors",
+            details={
+                "key": key,
+                "packets": estimate,
+                "window_start": merged.window_start,
+                "window_seconds": merged.window,
+                "senders": len(merged.senders),
+            },
+        )
+
+    def stats(self):
+        return {"received": self.received, "duplicates": self.duplicates, "late": self.late,
+                "rejected": self.rejected, "open_windows": len(self.windows)}
+
+
+def _print_report(report):
+    start = time.strftime("%H:%M:%S", time.localtime(report["window_start"]))
+    logger.console_logger.info(f"[*] window {start} (+{report['window']:g}s) from {len(report['senders'])} "
+                               f"senders: {', '.join(report['senders'])}")
+    for name, table in report["tables"].items():
+        top = ", ".join(f"{key} ({count})" for key, count in table["top"][:5])
+        logger.console_logger.info(f"      {name:<8} {table['packets']} packets, top: {top}")
+
+
+def _read_spool(collector, spool_dir):
+    for path in spool_files(spool_dir):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.remove(path)
+        except OSError as e:
+            logger.log_system_event(f"Failed to read summary {path}: {e}", "ERROR")
+            continue
+        collector.add(data)
+
+
+def run(collector, spool_dir=None, socket_path=None, once=False, as_json=False):
+    sock = None
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path) # left over by a previous run
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(socket_path)
+        sock.settimeout(1.0)
+    try:
+        while True:
+            if spool_dir:
+                _read_spool(collector, spool_dir)
+            if sock is not None:
+                try:
+                    while True:
+                        collector.add(sock.recv(1 << 20))
+                        sock.settimeout(0.0) # drain what's queued, then back to waiting
+                except (socket.timeout, BlockingIOError):
+                    sock.settimeout(1.0)
+            elif not once:
+                time.sleep(1.0)
+            reports = collector.finish_all() if once else collector.finish_due()
+            for report in reports:
+                if as_json:
+                    print(json.dumps(report))
+                else:
+                    _print_report(report)
+            if once:
+                return 0
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        if sock is not None:
+            sock.close()
+            os.remove(socket_path)
+        logger.log_system_event(f"Collector stats: {collector.stats()}", "INFO")
+        logger.close()
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt # SIGTERM takes the Ctrl+C path (socket removed, stats logged)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge the heavy hitter summaries of several Loki nodes.")
+    parser.add_argument("--spool", help="spool directory the nodes write their summaries to")
+    parser.add_argument("--socket", help="unix datagram socket to receive the summaries on")
+    parser.add_argument("--once", action="store_true", help="merge the spooled summaries, report and exit")
+    parser.add_argument("--grace", type=float, default=collector_config["grace"],
+                        help="seconds to wait for late nodes after a window ends")
+    parser.add_argument("--json", action="store_true", help="print the window reports as JSON lines")
+    args = parser.parse_args(argv)
+    if not args.spool and not args.socket:
+        parser.error("give --spool and/or --socket")
+    if args.once and not args.spool:
+        parser.error("--once reads a spool directory")
+
+    signal.signal(signal.SIGTERM, _stop)
+    logger.set_log_file("loki_collector_alerts.jsonl",
+                        "loki_collector_system.jsonl" if logger.system_filepath else None)
+    collector = Collector(thresholds=collector_config["thresholds"], grace=args.grace,
+                          top_k=collector_config["top_k"])
+    return run(collector, args.spool, args.socket, once=args.once, as_json=args.json)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,215 @@
+import copy
+import os
+
+import yaml
+
+# Runtime settings for Loki IDS.
+# Every option has a default here, Configs/loki_config.yaml (or the file in
+# $LOKI_CONFIG) only needs to list the values you want to change.
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(os.path.dirname(current_dir))
+
+DEFAULT_CONFIG_PATH = os.path.join(project_root, "Configs", "loki_config.yaml")
+
+DEFAULTS = {
+    # queue numbers and multi-process sharding (see Scripts/iptables_up.sh)
+    "sharding": {
+        "shards": 1,               # queues per chain, >1 starts one worker process per queue
+        "input_queue": 100,        # first queue of the INPUT chain (100, 101, ...)
+        "forward_queue": 200,      # first queue of the FORWARD chain (200, 201, ...)
+    },
+
+    # how the queues are bound (netfilterqueue bind() options)
+    "nfqueue": {
+        "max_len": 4096,           # packets the kernel queues for us, past it they are dropped (or bypassed with --queue-bypass)
+        "copy_range": 65535,       # bytes of each packet copied to userspace
+        "headers_only": [],        # chains ("INPUT", "FORWARD") without signature scan, only header_bytes are copied
+        "header_bytes": 128,       # enough for the IPv4 + TCP headers with options
+        "sock_rcvbuf": 0,          # netlink socket receive buffer in bytes, 0 = library default
+        "drain": True,             # poll the socket and handle every queued packet per wakeup (False = nfq.run())
+    },
+
+    # per-key windows of the behavior detectors
+    "detector_state": {
+        "ttl": 60,                 # seconds a key may stay idle before it is evicted
+        "max_keys": 50000,         # hard cap per table, the least recently used key goes first
+        "sweep_batch": 8,          # idle keys checked per packet (amortized eviction)
+        "counter_slices": 0,       # 0 = exact per-packet deque, N = N time slices per flood window
+                                   # (constant memory but approximate: bursty traffic near the
+                                   # threshold can alert on different packets)
+        "port_scan_mode": "exact", # distinct ports per (src, dst): "exact" or "hll" (approximate, fixed memory)
+        "hll_slices": 5,           # hll mode: time slices per scan window
+        "hll_precision": 6,        # hll mode: 2**p registers per slice (6 -> 64, ~13% error)
+    },
+
+    # signature matching
+    "signatures": {
+        "enforce_drop": True,      # really drop packets matching an action: "drop" rule (False = alert only)
+        "watch_file": True,        # reload the rules when their file changes (kill -HUP reloads too)
+        "cache": True,             # keep compiled rule sets in logs/cache/ (keyed by the sha256 of the rules file)
+    },
+
+    # top sources / destinations / ports per window, constant memory (see sketches.py)
+    "heavy_hitters": {
+        "enabled": True,
+        "window": 10.0,            # seconds per window, counts start over every window
+        "width": 2048,             # Count-Min counters per row
+        "depth": 4,                # Count-Min rows (error ~ packets / width, with probability 1 - 2**-depth)
+        "top_k": 20,               # keys kept in the top lists
+        "thresholds": {            # packets per window before an alert, 0 = no alert
+            "src": 20000,          # one source, whatever it talks to (low-and-slow scans, top talkers)
+            "dst": 50000,          # one destination, whatever the sources (spoofed-source DDoS)
+            "dst_port": 50000,     # one destination port ("UDP/53"), whatever the addresses
+        },
+    },
+
+    # send the heavy hitter windows to a collector (see summary_export.py / collector.py)
+    "summary_export": {
+        "enabled": False,
+        "node": "",                # name of this sensor, "" = hostname
+        "mode": "spool",           # "spool" (one file per window) or "socket" (unix datagram)
+        "spool_dir": "",           # "" = logs/summaries
+        "socket_path": "",         # "" = logs/collector.sock
+    },
+
+    # collector.py: global thresholds over the summaries of every node
+    "collector": {
+        "grace": 5.0,              # seconds to wait for late nodes after a window ends
+        "top_k": 20,
+        "thresholds": {            # packets per window summed over every node, 0 = no alert
+            "src": 100000,
+            "dst": 200000,
+            "dst_port": 200000,
+        },
+    },
+
+    # flow table (5-tuple -> state/verdict) in front of the analysis
+    "flow_cache": {
+        "enabled": True,
+        "max_flows": 65536,        # memory cap, least recently seen flow is evicted first
+        "ttl": 120,                # idle seconds before a flow is forgotten
+        "inspect_bytes": 32768,    # payload scanned per flow before it's trusted (fast path)
+    },
+
+    # TCP stream reassembly for the signature scan (see stream_reassembly.py), limits are per queue
+    "stream_reassembly": {
+        "enabled": True,
+        "max_flows": 32768,        # connection directions tracked
+        "ttl": 120,                # idle seconds before a direction is forgotten
+        "max_flow_bytes": 16384,   # out-of-order bytes parked per direction
+        "max_total_bytes": 33554432, # tails + parked segments of all the directions (32 MiB)
+        "regex_window": 128,       # stream tail kept when there are regex rules
+    },
+
+    # IP blocklist, looked up on the raw header before anything else (see blocklist.py)
+    "blocklist": {
+        "enabled": True,
+        "static": [],              # addresses / CIDRs blocked for good
+        "never_block": ["127.0.0.0/8"], # automatic blocks never cover these (add your LAN / gateway)
+        "match_destination": False, # also drop packets going *to* a blocked address
+        "max_entries": 100000,     # automatic blocks are refused past this
+        "persist": True,           # keep the list in logs/blocklist.json across restarts
+        "save_interval": 30,       # seconds between saves (only when something changed)
+        "auto_block_signature_ttl": 600, # block the source of a signature drop on a verified TCP handshake (FORWARD), 0 = don't
+        "auto_block_behavior_ttl": 0,    # same for port scans (floods never block: spoofable sources), 0 = don't
+    },
+
+    # automatic blocks pushed into a kernel set, dropped before NFQUEUE (see enforcement.py)
+    "enforcement": {
+        "enabled": False,          # needs root and nft / ipset
+        "backend": "nftables",     # nftables | ipset | dry_run (in memory, logs what it would push)
+        "table": "loki",           # nftables table (inet family)
+        "set_name": "blocked",     # nftables set / ipset name
+        "max_batch": 512,          # offenders per kernel update, updates go out once a second
+        "max_entries": 65536,      # offenders in the set, new ones are refused past it
+        "sync_blocklist": True,    # also push the static and persisted blocklist entries at startup
+    },
+
+    # load shedding when the pipeline falls behind the queue (see overload.py)
+    "overload": {
+        "enabled": True,
+        "lag": [0.05, 0.25, 1.0],  # seconds behind the packet timestamps to enter tier 1 / 2 / 3, 0 = never
+        "depth": [0.25, 0.5, 0.8], # queue fill (share of nfqueue.max_len) to enter tier 1 / 2 / 3
+        "hysteresis": 0.5,         # a tier is left once under this share of its thresholds..
+        "hold": 5,                 # ..for this many seconds, one tier at a time
+        "trusted_bytes": 4096,     # tier 1+: flows clean for this many bytes skip the signature scan
+        "large_payload": 1024,     # tier 2+: only this many bytes of a payload are scanned
+        "behavior_sample": 4,      # tier 2+: flood counters see 1 packet in N (weighted)
+        "critical_behavior_sample": 16, # tier 3 (no signature scanning at all)
+    },
+
+    # packet tracing (ring buffer of packet summaries, see packet_trace.py)
+    "trace": {
+        "enabled": True,
+        "ring_size": 4096,         # packet summaries kept in memory
+        "sample_every": 1,         # keep 1 packet in N
+        "per_source": False,       # sample 1 source in N (complete traces of those) instead of 1 packet in N
+        "dump_on_alert": True,     # write the ring to logs/traces/ when a new alert starts..
+        "dump_cooldown": 60,       # ..at most once per this many seconds (SIGUSR1 always dumps)
+        "console_packets": False,  # the old per-packet console line (slow, debugging only)
+    },
+
+    # counters / latency histograms (see metrics.py)
+    "metrics": {
+        "enabled": True,
+        "http": True,              # Prometheus text on http://host:port/metrics (JSON on /stats.json)
+        "host": "127.0.0.1",       # local only, put a reverse proxy in front if you need it elsewhere
+        "port": 9108,              # sharded mode: worker N listens on port + 1 + N
+        "stats_file": True,        # rewrite logs/loki_stats.json every stats_interval seconds
+        "stats_interval": 10.0,
+    },
+
+    # SQLite copy of the alerts, indexed for queries (see alert_store.py)
+    "alert_store": {
+        "enabled": True,
+        "path": "",                # "" = logs/loki_alerts.db
+    },
+
+    # background writer for loki_alerts.jsonl
+    "alert_writer": {
+        "queue_size": 10000,       # records waiting for the disk, extra ones are dropped (and counted)
+        "batch_size": 256,         # write as soon as this many records are waiting..
+        "flush_interval": 1.0,     # ..or this many seconds after the first one arrived
+        "fsync": "interval",       # "always" (every batch), "interval" or "never" (leave it to the OS)
+        "fsync_interval": 5.0,
+    },
+
+    # segments of the JSONL logs (see log_segments.py)
+    "log_rotation": {
+        "segment_bytes": 8388608,  # rotate the live file past this size..
+        "segment_seconds": 86400,  # ..or this age
+        "index_interval": 65536,   # bytes between two entries of the time index
+        "compress": True,          # gzip the closed segments in the background
+        "retention_bytes": 268435456, # closed segments over this total are deleted, oldest first, 0 = keep all
+        "system_file": "loki_system.jsonl", # system events, "" = in the alert log
+    },
+}
+
+
+def _merge(base, override):
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def load_config(path=None):
+    """Return the defaults merged with the yaml config file (if there is one)."""
+    path = path or os.environ.get("LOKI_CONFIG", DEFAULT_CONFIG_PATH)
+    result = copy.deepcopy(DEFAULTS)
+    try:
+        with open(path, 'r') as f:
+            user_config = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
+        _merge(result, user_config)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[!] couldn't read the config file {path}, using the defaults: {e}")
+    return result
+
+
+# loaded once, like the logger singleton
+config = load_config()
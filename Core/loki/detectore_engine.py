@@ -1,18 +1,20 @@
-from netfilterqueue import NetfilterQueue
 import time
 from collections import deque, defaultdict, Counter
+from config import config
+from state import BoundedStateTable, new_window_counter, new_port_window, port_hash_tables
 
 # global var
+state_config = config["detector_state"]
+
+
+def _window_size(window):
+    return window.size_bytes()
+
 
 class PortScanningDetector:
-    def __init__(self, threshold, max_seconds):
+    def __init__(self, threshold, max_seconds, state_ttl=None, max_keys=None, sweep_batch=None,
+                 counter_slices=None, port_scan_mode=None):
         self.threshold = threshold
-        self.port_scanning_log = defaultdict(deque)
-
-        self.tcp_flood_log = defaultdict(deque)
-        self.udp_flood_log = defaultdict(deque)
-        self.icmp_flood_log = defaultdict(deque)
-        
         self.m_sec = max_seconds
 
         # values for testing attacks..
@@ -29,15 +31,62 @@ class PortScanningDetector:
         self.icmp_flood_window = 2
         self.icmp_flood_threshold = 100
 
-    def analyze_tcp(self, src_ip_add, dst_ip_add, timestamp, port_number):
+        # per-key windows, bounded: idle keys expire after state_ttl seconds and
+        # each table holds at most max_keys keys (least recently used goes first).
+        state_ttl = state_config["ttl"] if state_ttl is None else state_ttl
+        max_keys = state_config["max_keys"] if max_keys is None else max_keys
+        sweep_batch = state_config["sweep_batch"] if sweep_batch is None else sweep_batch
+
+        # flood rates are counted with the exact one-timestamp-per-packet deque (0, the
+        # default) or a ring of this many time slices per window (constant memory, but
+        # the count is an estimate, so bursts near the threshold can decide differently).
+        self.counter_slices = state_config["counter_slices"] if counter_slices is None else counter_slices
+
+        # distinct ports per (src, dst): "exact" or "hll" (approximate, fixed memory per pair
+        # for very wide scans from many sources)
+        self.port_scan_mode = state_config["port_scan_mode"] if port_scan_mode is None else port_scan_mode
+        self.hll_slices = state_config["hll_slices"]
+        self.hll_precision = state_config["hll_precision"]
+        if self.port_scan_mode == "hll":
+            port_hash_tables(self.hll_precision) # build the port hash tables now, not on the first SYN
+
+        def table(name, window, value_size):
+            # a key idle for less than its window still matters, never expire it sooner.
+            return BoundedStateTable(name, max(state_ttl, window), max_keys, sweep_batch, value_size)
+
+        self.port_scanning_log = table("port_scanning", self.port_scanning_window, _window_size)
+        self.tcp_flood_log = table("tcp_flood", self.tcp_flood_window, _window_size)
+        self.udp_flood_log = table("udp_flood", self.udp_flood_window, _window_size)
+        self.icmp_flood_log = table("icmp_flood", self.icmp_flood_window, _window_size)
+
+    def share_flood_thresholds(self, shards):
+        """
+        This detector only sees 1/shards of the packets to any destination (the
+        queues are split by source, see iptables_up.sh): every flood fires on its
+        share of the threshold. The port scan is per (src, dst), it stays whole.
+        """
+        self.tcp_flood_threshold = max(1, -(-self.tcp_flood_threshold // shards))
+        self.udp_flood_threshold = max(1, -(-self.udp_flood_threshold // shards))
+        self.icmp_flood_threshold = max(1, -(-self.icmp_flood_threshold // shards))
+
+    def state_stats(self):
+        """live keys / evictions / approx bytes of every state table, for exporting."""
+        return {t.name: t.stats() for t in (self.port_scanning_log, self.tcp_flood_log,
+                                             self.udp_flood_log, self.icmp_flood_log)}
+
+    def analyze_tcp(self, src_ip_add, dst_ip_add, timestamp, port_number, weight=1):
         # return types: (just again for test, maybe optimized later..)
         # 0 => no attack detected
         # 1 => port scanning
         # 2 => tcp flood
+        # weight: packets this one stands for in the flood counters (1 in `weight` sampled
+        # under overload), weight 0 = scan check only, the flood counter skips it.
         result = self.check_port_scanning(src_ip_add, dst_ip_add, timestamp, port_number)
         if result:
             return 1 # whatever you wanna say about port scanning..
-        result = self.check_tcp_flood(dst_ip_add, timestamp, port_number)
+        if not weight:
+            return 0
+        result = self.check_tcp_flood(dst_ip_add, timestamp, port_number, weight)
         if result:
             return 2 # again whatever you feel about DoS/DDoS attack.
         return 0
@@ -45,137 +94,86 @@ class PortScanningDetector:
     def check_port_scanning(self, src_ip_add, dst_ip_add, timestamp, port_number):
     
         # first let's check the port scanning log:
-        if ((src_ip_add, dst_ip_add) not in self.port_scanning_log):
+        ports = self.port_scanning_log.get((src_ip_add, dst_ip_add), timestamp)
+        if ports is None:
             # now it's the simplest case, just add it to the dictionary:    
-            self.port_scanning_log[(src_ip_add, dst_ip_add)].append((timestamp, port_number))
+            ports = new_port_window(self.port_scanning_window, self.port_scan_mode, timestamp,
+                                    self.hll_slices, self.hll_precision)
+            ports.add(timestamp, port_number)
+            self.port_scanning_log.put((src_ip_add, dst_ip_add), ports, timestamp)
 
             # and that's it..
             return False
         else:
           
             # now it's the main thing, here we should compare and do the other logic.
-            
-            history = self.port_scanning_log.get((src_ip_add, dst_ip_add))
-
-            # check if there's already an item there and the difference in time is not big..
-            while history and ((timestamp - history[0][0]) > self.port_scanning_window) :
-                # just pop up that entry::
-                history.popleft()
-                
-            # let's just append that item..
-            history.append((timestamp, port_number))
-
-            # now you have everything fresh, let's go to the next step::
-            # 2. now the last and most important thing, let's check if the uniqueue port access is bigger than the threshold::
-            active_ports = {item[1] for item in history}
-            # I used a set to automatically add only unique items
+            # the window keeps the distinct ports up to date as entries come and go,
+            # so there's no set to rebuild here, the count is O(1):
+            active_ports = ports.add(timestamp, port_number)
 
-            #now let's check if the list contains more than 10 items
-            if len(active_ports) > self.port_scanning_threshold:
+            #now let's check if there are more unique ports than the threshold
+            if active_ports > self.port_scanning_threshold:
                 return True
 
             return False
 
-    def check_tcp_flood(self, dst_ip_add, timestamp, port_number):
+    def check_tcp_flood(self, dst_ip_add, timestamp, port_number, weight=1):
 
-        # first let's check the port scanning log:
-        if ((dst_ip_add, port_number) not in self.tcp_flood_log):
+        # first let's check the flood log:
+        counter = self.tcp_flood_log.get((dst_ip_add, port_number), timestamp)
+        if counter is None:
             # now it's the simplest case, just add it to the dictionary:    
-            self.tcp_flood_log[(dst_ip_add, port_number)].append(timestamp)
+            counter = new_window_counter(self.tcp_flood_window, self.counter_slices, timestamp)
+            counter.add(timestamp, weight)
+            self.tcp_flood_log.put((dst_ip_add, port_number), counter, timestamp)
 
             # and that's it..
             return False
 
         else:
-          
-            # now it's the main thing, here we should compare and do the other logic.
-            
-            history = self.tcp_flood_log.get((dst_ip_add, port_number))
-
-            # check if there's already an item there and the difference in time is not big..
-            while history and ((timestamp - history[0]) > self.tcp_flood_window) :
-                # just pop up that entry::
-                history.popleft()
-                
-            # let's just append that item..
-            history.append(timestamp)
-
-            # now you have everything fresh, let's go to the next step::
-            # 2. now the last and most important thing, let's check if the uniqueue port access is bigger than the threshold::
-            #access_rate = len(history)
-            # I used a set to automatically add only unique items
-
-            #now let's check if the list contains more than 10 items
-            if len(history) > self.tcp_flood_threshold:
+            # now it's the main thing, count this packet in the sliding window
+            # (ring of time slices, O(1) and fixed size no matter the rate)
+            # and check if the rate is bigger than the threshold::
+            if counter.add(timestamp, weight) > self.tcp_flood_threshold:
                 return True
 
             return False
 
-    def analyze_udp(self, dst_ip_add, timestamp, port_number):
+    def analyze_udp(self, dst_ip_add, timestamp, port_number, weight=1):
 
-        # first let's check the port scanning log:
-        if ((dst_ip_add, port_number) not in self.udp_flood_log):
+        # first let's check the flood log:
+        counter = self.udp_flood_log.get((dst_ip_add, port_number), timestamp)
+        if counter is None:
             # now it's the simplest case, just add it to the dictionary:    
-            self.udp_flood_log[(dst_ip_add, port_number)].append(timestamp)
+            counter = new_window_counter(self.udp_flood_window, self.counter_slices, timestamp)
+            counter.add(timestamp, weight)
+            self.udp_flood_log.put((dst_ip_add, port_number), counter, timestamp)
 
             # and that's it..
             return False
 
         else:
-          
-            # now it's the main thing, here we should compare and do the other logic.
-            
-            history = self.udp_flood_log.get((dst_ip_add, port_number))
-
-            # check if there's already an item there and the difference in time is not big..
-            while history and ((timestamp - history[0]) > self.udp_flood_window) :
-                # just pop up that entry::
-                history.popleft()
-                
-            # let's just append that item..
-            history.append(timestamp)
-
-            # now you have everything fresh, let's go to the next step::
-            # 2. now the last and most important thing, let's check if the uniqueue port access is bigger than the threshold::
-            #access_rate = len(history)
-            # I used a set to automatically add only unique items
-
-            #now let's check if the list contains more than 10 items
-            if len(history) > self.udp_flood_threshold:
+            # count it in the sliding window and compare with the threshold::
+            if counter.add(timestamp, weight) > self.udp_flood_threshold:
                 return True
 
             return False
 
-    def analyze_icmp(self, dst_ip_add, timestamp):
-        # first let's check the port scanning log:
-        if dst_ip_add not in self.icmp_flood_log:
+    def analyze_icmp(self, dst_ip_add, timestamp, weight=1):
+        # first let's check the flood log:
+        counter = self.icmp_flood_log.get(dst_ip_add, timestamp)
+        if counter is None:
             # now it's the simplest case, just add it to the dictionary:    
-            self.icmp_flood_log[dst_ip_add].append(timestamp)
+            counter = new_window_counter(self.icmp_flood_window, self.counter_slices, timestamp)
+            counter.add(timestamp, weight)
+            self.icmp_flood_log.put(dst_ip_add, counter, timestamp)
 
             # and that's it..
             return False
 
         else:
-          
-            # now it's the main thing, here we should compare and do the other logic.
-            
-            history = self.icmp_flood_log.get(dst_ip_add)
-
-            # check if there's already an item there and the difference in time is not big..
-            while history and ((timestamp - history[0]) > self.icmp_flood_window) :
-                # just pop up that entry::
-                history.popleft()
-                
-            # let's just append that item..
-            history.append(timestamp)
-
-            # now you have everything fresh, let's go to the next step::
-            # 2. now the last and most important thing, let's check if the uniqueue port access is bigger than the threshold::
-            # access_rate = len(history)
-            # I used a set to automatically add only unique items
-
-            #now let's check if the list contains more than 10 items
-            if len(history) > self.icmp_flood_threshold:
+            # count it in the sliding window and compare with the threshold::
+            if counter.add(timestamp, weight) > self.icmp_flood_threshold:
                 return True
 
             return False
@@ -0,0 +1,357 @@
+import ipaddress
+import math
+import shutil
+import subprocess
+import threading
+import time
+
+# Kernel-side enforcement of the automatic blocks.
+#
+# The userspace blocklist (blocklist.py) still pays for every packet of a
+# blocked source: NFQUEUE copies it to us, we look it up and send a verdict
+# back. The Enforcer pushes the confirmed offenders (the addresses the
+# detectors auto-block on a signature drop or a port scan) into a kernel
+# set instead, matched by a drop rule that runs before the NFQUEUE rules, so
+# their packets never leave the kernel. Updates are queued by the packet
+# threads and pushed in batches by the maintenance loop, one kernel
+# transaction per batch. The kernel expires every entry after its TTL on its
+# own (set timeouts), the Enforcer only tracks what it already pushed.
+#
+# Backends: "nftables" (a set + prerouting chain in table inet loki),
+# "ipset" (hash:net set + a raw PREROUTING iptables rule) and "dry_run",
+# which keeps everything in memory and needs neither root nor the tools.
+
+class EnforcementError(Exception):
+    pass
+
+
+def _run(command, stdin=None):
+    try:
+        result = subprocess.run(command, input=stdin, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise EnforcementError(f"{command[0]}: {e}")
+    if result.returncode != 0:
+        raise EnforcementError(f"{' '.join(command)}: {result.stderr.strip() or result.returncode}")
+    return result.stdout
+
+
+class EnforcementBackend:
+    """
+    Where the offenders end up. add() and remove() get whole batches, one call
+    should be one kernel transaction. A ttl of 0 means permanent.
+    """
+    name = "none"
+
+    def setup(self):
+        """Create the set and the drop rule if they're not there (idempotent, several workers call it)."""
+
+    def add(self, entries, refresh=()):
+        """
+        entries: [(address or CIDR, ttl seconds)]. `refresh`: the addresses of
+        entries already in the set, their timeout must be replaced by the new one.
+        """
+        raise NotImplementedError
+
+    def remove(self, addresses):
+        raise NotImplementedError
+
+    def close(self):
+        """Stop using the backend. The set stays: the entries expire by themselves, iptables_down.sh removes it."""
+
+
+class DryRunBackend(EnforcementBackend):
+    """
+    In-memory backend: what would be pushed, with the kernel's expiry emulated.
+    Like an nftables set, adding an address that is still in the set keeps its
+    old timeout unless it's refreshed. For testing the enforcement logic
+    without root, or to see what a real backend would do on a live box (log).
+    """
+    name = "dry_run"
+
+    def __init__(self, clock=time.time, log=None):
+        self.clock = clock
+        self.log = log         # called with a description of every batch, e.g. logger.console_logger.info
+        self.entries = {}      # address -> expires (0 = permanent)
+        self.batches = []      # ("add", [(address, ttl)]) / ("remove", [address]) in call order
+
+    def add(self, entries, refresh=()):
+        now = self.clock()
+        entries = list(entries)
+        live = self.active(now)
+        for address, ttl in entries:
+            if address in live and address not in refresh:
+                continue # "add element" of a live element changes nothing
+            self.entries[address] = now + ttl if ttl else 0
+        self.batches.append(("add", entries))
+        if self.log:
+            self.log(f"[dry-run] would block {len(entries)} address(es): "
+                     f"{', '.join(f'{address} ({ttl}s)' if ttl else f'{address} (permanent)' for address, ttl in entries[:10])}")
+
+    def remove(self, addresses):
+        addresses = list(addresses)
+        for address in addresses:
+            self.entries.pop(address, None)
+        self.batches.append(("remove", addresses))
+
+    def active(self, now=None):
+        """address -> expires of the entries the kernel would still have"""
+        now = self.clock() if now is None else now
+        return {address: expires for address, expires in self.entries.items() if not expires or expires > now}
+
+    def contains(self, address, now=None):
+        return address in self.active(now)
+
+
+class IpsetBackend(EnforcementBackend):
+    """hash:net ipset with per-entry timeouts, dropped in the raw table before conntrack and NFQUEUE."""
+    name = "ipset"
+
+    def __init__(self, set_name="blocked", max_entries=65536):
+        self.set_name = set_name
+        self.max_entries = max_entries
+        self.rule = ["PREROUTING", "-m", "set", "--match-set", set_name, "src", "-j", "DROP"]
+
+    def setup(self):
+        for tool in ("ipset", "iptables"):
+            if shutil.which(tool) is None:
+                raise EnforcementError(f"{tool} is not installed")
+        _run(["ipset", "create", self.set_name, "hash:net", "family", "inet", "timeout", "0",
+              "maxelem", str(self.max_entries), "-exist"])
+        try:
+            _run(["iptables", "-t", "raw", "-C"] + self.rule)
+        except EnforcementError:
+            _run(["iptables", "-t", "raw", "-I"] + self.rule)
+
+    def add(self, entries, refresh=()):
+        # -exist: an address already in the set gets the new timeout, refresh or not
+        lines = "".join(f"add {self.set_name} {address} timeout {ttl}\n" for address, ttl in entries)
+        _run(["ipset", "restore", "-exist"], lines)
+
+    def remove(self, addresses):
+        lines = "".join(f"del {self.set_name} {address}\n" for address in addresses)
+        _run(["ipset", "restore", "-exist"], lines)
+
+
+class NftablesBackend(EnforcementBackend):
+    """
+    Interval set with timeouts in its own table, matched by a prerouting
+    chain at raw priority. An element already in the set keeps its timeout
+    (nft "add element" doesn't update it): refreshed ones are deleted and
+    added again in the same transaction.
+    """
+    name = "nftables"
+
+    def __init__(self, table="loki", set_name="blocked"):
+        self.table = table
+        self.set_name = set_name
+
+    def setup(self):
+        if shutil.which("nft") is None:
+            raise EnforcementError("nft is not installed")
+        _run(["nft", "-f", "-"], self.setup_script())
+
+    def setup_script(self):
+        # one transaction, and the same result however many workers run it at once:
+        # "add" of an existing table/set/chain is a no-op, and the chain (ours alone)
+        # is flushed before its one rule goes in, so the rule is never there twice
+        return (f"add table inet {self.table}\n"
+                f"add set inet {self.table} {self.set_name} {{ type ipv4_addr; flags interval, timeout; }}\n"
+                f"add chain inet {self.table} prerouting {{ type filter hook prerouting priority -300; policy accept; }}\n"
+                f"flush chain inet {self.table} prerouting\n"
+                f"add rule inet {self.table} prerouting ip saddr @{self.set_name} drop\n")
+
+    def add(self, entries, refresh=()):
+        _run(["nft", "-f", "-"], self.add_script(entries, refresh))
+
+    def add_script(self, entries, refresh=()):
+        script = ""
+        if refresh:
+            script += f"delete element inet {self.table} {self.set_name} {{ {', '.join(refresh)} }}\n"
+        elements = ", ".join(f"{address} timeout {ttl}s" if ttl else address for address, ttl in entries)
+        return script + f"add element inet {self.table} {self.set_name} {{ {elements} }}\n"
+
+    def remove(self, addresses):
+        elements = ", ".join(addresses)
+        _run(["nft", "-f", "-"], f"delete element inet {self.table} {self.set_name} {{ {elements} }}\n")
+
+
+BACKENDS = {
+    "nftables": NftablesBackend,
+    "ipset": IpsetBackend,
+    "dry_run": DryRunBackend,
+}
+
+
+def _parse(address):
+    network = ipaddress.IPv4Network(str(address).strip(), strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+
+class Enforcer:
+    """
+    Batches the offenders for a backend. offend() is cheap and never touches
+    the backend (packet threads), flush() pushes what's pending (maintenance loop).
+    """
+
+    def __init__(self, backend, max_batch=512, max_entries=65536, never_block=(), error_logger=None,
+                 clock=time.time):
+        self.backend = backend
+        self.max_batch = max(1, max_batch)
+        self.max_entries = max_entries
+        self.never_block = [_parse(network) for network in never_block]
+        self.error_logger = error_logger
+        self.clock = clock
+
+        self._pending = {} # address -> (expires, reason), 0 = permanent
+        self._lock = threading.Lock()
+        self.enforced = {} # address -> expires, what we pushed and the kernel still has (maintenance thread only)
+
+        # Statistics
+        self.pushed = 0
+        self.batches = 0
+        self.refused = 0
+        self.errors = 0
+
+    def offend(self, address, ttl, reason=""):
+        """
+        Queue `address` (or a CIDR) for the kernel set, for `ttl` seconds (0/None = permanent).
+        Returns False if it's refused (never_block list).
+        """
+        try:
+            first, last = _parse(address)
+        except ValueError:
+            self.refused += 1
+            return False
+        for low, high in self.never_block:
+            if first <= high and last >= low:
+                self.refused += 1
+                return False
+        expires = self.clock() + ttl if ttl else 0
+        with self._lock:
+            queued = self._pending.get(address)
+            if queued is None or (queued[0] and (not expires or expires > queued[0])):
+                self._pending[address] = (expires, reason)
+        return True
+
+    @property
+    def backlog(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Push the pending offenders in batches of max_batch. Returns how many went to the kernel."""
+        now = self.clock()
+        # the kernel already dropped these from its set
+        for address in [address for address, expires in self.enforced.items() if expires and expires <= now]:
+            del self.enforced[address]
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        entries = []
+        for address, (expires, _reason) in pending.items():
+            if expires and expires <= now:
+                continue
+            known = self.enforced.get(address)
+            if known is not None and (not known or (expires and expires <= known)):
+                continue # already in the set for at least as long
+            if known is None and len(self.enforced) + len(entries) >= self.max_entries:
+                self.refused += 1
+                continue
+            # known: in the set already, with a shorter timeout that has to be replaced
+            entries.append((address, math.ceil(expires - now) if expires else 0, expires, known is not None))
+
+        pushed = 0
+        for start in range(0, len(entries), self.max_batch):
+            pushed += self._push(entries[start:start + self.max_batch])
+        return pushed
+
+    def _push(self, batch):
+        try:
+            self.backend.add([(address, ttl) for address, ttl, _expires, _known in batch],
+                             [address for address, _ttl, _expires, known in batch if known])
+            done = batch
+        except EnforcementError as e:
+            self._error(f"Enforcement batch of {len(batch)} failed: {e}")
+            if len(batch) == 1:
+                # a failed refresh: the entry may be gone from the set already (deleted by hand?)
+                done = batch if batch[0][3] and self._push_one(batch[0], refresh=False) else []
+            else:
+                # one bad element (e.g. overlapping an interval already in the set) fails
+                # the whole transaction, push the others one by one
+                done = [entry for entry in batch if self._push_one(entry)]
+        for address, _ttl, expires, _known in done:
+            self.enforced[address] = expires
+        self.batches += 1
+        self.pushed += len(done)
+        return len(done)
+
+    def _push_one(self, entry, refresh=True):
+        address, ttl, _expires, known = entry
+        if known and refresh:
+            try:
+                self.backend.add([(address, ttl)], [address])
+                return True
+            except EnforcementError:
+                pass # nothing to refresh, maybe, try a plain add
+        try:
+            self.backend.add([(address, ttl)])
+            return True
+        except EnforcementError as e:
+            self._error(f"Enforcement of {address} failed: {e}")
+            return False
+
+    def _error(self, message):
+        self.errors += 1
+        if self.error_logger and (self.errors in (1, 10, 100) or self.errors % 1000 == 0):
+            self.error_logger.error(message)
+
+    def release(self, addresses):
+        """Take addresses out of the kernel set now (unblocked by hand)."""
+        addresses = [address for address in addresses if self.enforced.pop(address, None) is not None]
+        if addresses:
+            try:
+                self.backend.remove(addresses)
+            except EnforcementError as e:
+                self._error(f"Enforcement removal failed: {e}")
+        return len(addresses)
+
+    def sync(self, blocklist):
+        """Queue every live entry of an IPBlocklist (static ones, the ones loaded from disk)."""
+        from blocklist import FOREVER, _network_str
+        now = time.time()
+        queued = 0
+        with blocklist._lock:
+            items = [((ip, ip), entry) for ip, entry in blocklist.hosts.items()]
+            items += list(blocklist.networks.items())
+        for (first, last), entry in items:
+            if not entry.alive(now):
+                continue
+            ttl = 0 if entry.expires == FOREVER else max(1, math.ceil(entry.expires - now))
+            if self.offend(_network_str(first, last), ttl, entry.reason):
+                queued += 1
+        return queued
+
+    def stats(self):
+        return {
+            "backend": self.backend.name,
+            "enforced": len(self.enforced),
+            "pending": len(self._pending),
+            "pushed": self.pushed,
+            "batches": self.batches,
+            "refused": self.refused,
+            "errors": self.errors,
+        }
+
+    def close(self):
+        self.backend.close()
+
+
+def new_backend(enforcement_config, log=None):
+    """Backend named in the enforcement config section."""
+    name = enforcement_config["backend"]
+    if name == "nftables":
+        return NftablesBackend(table=enforcement_config["table"], set_name=enforcement_config["set_name"])
+    if name == "ipset":
+        return IpsetBackend(set_name=enforcement_config["set_name"], max_entries=enforcement_config["max_entries"])
+    if name == "dry_run":
+        return DryRunBackend(log=log)
+    raise EnforcementError(f"unknown enforcement backend: {name} (use one of {', '.join(BACKENDS)})")
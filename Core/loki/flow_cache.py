@@ -0,0 +1,138 @@
+from state import BoundedStateTable
+
+# Flow table: remembers what we already know about a connection so its
+# following packets don't pay for the whole analysis again.
+#
+# A flow starts as INSPECT. Its payload is scanned until `inspect_bytes`
+# (both directions together) came out clean, then it becomes BENIGN and the
+# rest of the connection takes the fast path. A signature "drop" match marks
+# it DROP and every later packet of the flow is dropped right away.
+
+FLOW_INSPECT = 0
+FLOW_BENIGN = 1
+FLOW_DROP = 2
+
+VERDICT_NAMES = {FLOW_INSPECT: "INSPECT", FLOW_BENIGN: "BENIGN", FLOW_DROP: "DROP"}
+
+# TCP state, only what the fast path (and the automatic blocks) need.
+# ESTABLISHED means the handshake was verified: the client acknowledged the
+# responder's SYN-ACK (ack == its seq + 1), or the responder sent data. A blind
+# spoofer never sees the SYN-ACK, so "SYN then ACK + data" from a forged address
+# stays NEW. On INPUT the Pi's own replies aren't queued, so flows there never
+# get past NEW (nothing that needs a verified source fires on INPUT).
+TCP_NEW = 0          # SYN seen, handshake not verified yet
+TCP_ESTABLISHED = 1
+TCP_CLOSING = 2      # FIN seen
+TCP_MIDSTREAM = 3    # first packet wasn't a SYN, we never saw the handshake
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+SEQ_MOD = 1 << 32
+
+
+class FlowEntry:
+    __slots__ = ("verdict", "tcp_state", "packets", "inspected_bytes", "client", "server_isn")
+
+    def __init__(self):
+        self.verdict = FLOW_INSPECT
+        self.tcp_state = TCP_NEW
+        self.packets = 0
+        self.inspected_bytes = 0
+        self.client = None     # (address, port) that sent the SYN
+        self.server_isn = -1   # seq of the responder's SYN-ACK, -1 until we saw it
+
+
+class FlowCache:
+    """
+    LRU/TTL table of flows keyed by the 5-tuple (both directions share an entry).
+    Memory is capped by max_flows, the least recently seen flow is evicted first.
+    """
+
+    def __init__(self, max_flows=65536, ttl=120, inspect_bytes=32768, sweep_batch=8):
+        self.inspect_bytes = inspect_bytes
+        self.flows = BoundedStateTable("flows", ttl, max_flows, sweep_batch,
+                                       value_size=lambda entry: 136)
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.fast_path = 0    # packets that skipped the analysis
+        self.dropped = 0      # packets dropped because their flow is marked DROP
+
+    @staticmethod
+    def flow_key(info):
+        a = (info.src_ip, info.src_port)
+        b = (info.dst_ip, info.dst_port)
+        if a <= b:
+            return (info.proto, a[0], a[1], b[0], b[1])
+        return (info.proto, b[0], b[1], a[0], a[1])
+
+    def lookup(self, info):
+        """Return the FlowEntry of this packet's flow (created on a miss) and update its TCP state."""
+        key = self.flow_key(info)
+        now = info.rawts
+        entry = self.flows.get(key, now)
+        if entry is None:
+            self.misses += 1
+            entry = FlowEntry()
+            if info.port == "TCP":
+                if info.tcp_flags & (TCP_SYN | TCP_ACK) == TCP_SYN:
+                    entry.client = (info.src_ip, info.src_port)
+                else:
+                    entry.tcp_state = TCP_MIDSTREAM # we never saw the SYN, nothing to verify
+            self.flows.put(key, entry, now)
+        else:
+            self.hits += 1
+        entry.packets += 1
+
+        if info.port == "TCP":
+            flags = info.tcp_flags
+            if flags & TCP_RST:
+                # connection is gone, forget it (a DROP verdict stays, the attacker may retry)
+                if entry.verdict != FLOW_DROP:
+                    self.flows.pop(key)
+            elif flags & TCP_FIN:
+                entry.tcp_state = TCP_CLOSING
+            elif entry.tcp_state == TCP_NEW:
+                self._handshake(entry, info, flags)
+        return entry
+
+    @staticmethod
+    def _handshake(entry, info, flags):
+        from_client = info.src_ip == entry.client[0] and info.src_port == entry.client[1]
+        if flags & TCP_SYN:
+            if flags & TCP_ACK and not from_client:
+                entry.server_isn = info.seq # SYN-ACK of the responder
+        elif entry.server_isn >= 0:
+            if from_client:
+                if flags & TCP_ACK and info.ack == (entry.server_isn + 1) % SEQ_MOD:
+                    entry.tcp_state = TCP_ESTABLISHED
+            elif info.payload:
+                entry.tcp_state = TCP_ESTABLISHED # the responder talks to the client
+
+    def inspected(self, entry, nbytes):
+        """Count payload bytes that were scanned clean, the flow turns BENIGN past inspect_bytes."""
+        entry.inspected_bytes += nbytes
+        if entry.verdict == FLOW_INSPECT and entry.inspected_bytes >= self.inspect_bytes:
+            entry.verdict = FLOW_BENIGN
+
+    def mark_drop(self, entry):
+        entry.verdict = FLOW_DROP
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        table_stats = self.flows.stats()
+        return {
+            "flows": table_stats["live_keys"],
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "fast_path": self.fast_path,
+            "dropped": self.dropped,
+            "evicted_ttl": table_stats["evicted_ttl"],
+            "evicted_cap": table_stats["evicted_cap"],
+            "approx_bytes": table_stats["approx_bytes"],
+        }
@@ -0,0 +1,456 @@
+"""
+Segmented JSONL logs for Loki IDS.
+
+The alert (and system event) logs are written by the AlertWriter thread as a
+series of segments: the live file (loki_alerts.jsonl) is rotated by size or
+age to loki_alerts-YYYYmmdd-HHMMSS.jsonl (UTC, like the records), closed segments are gzip'ed in
+the background, and the oldest ones are deleted past a total size.
+
+Every segment has a sidecar index (<segment>.idx): fixed 24 byte records
+(time, offset in the JSON lines, offset in the file) written at batch
+boundaries every `index_interval` bytes. Compressed segments are written as
+one gzip member per index block, so they stay valid .gz files (zcat works)
+but a reader can seek to any indexed block and start decompressing there.
+
+Usage (from Core/loki):
+    python3 log_segments.py read --since 1h                 # records of the last hour, every segment
+    python3 log_segments.py read --since 30m --follow        # ..then keep following the live file
+    python3 log_segments.py read --log ../../logs/loki_system.jsonl --since 2d --until 1d
+"""
+import argparse
+import glob
+import json
+import mmap
+import os
+import queue
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+INDEX_ENTRY = struct.Struct("!dQQ") # time, offset in the lines, offset in the file
+INDEX_SUFFIX = ".idx"
+GZ_SUFFIX = ".gz"
+
+# the index has the time of the first record of a batch, the records after it
+# aren't strictly in order (timestamps taken on several threads): look this much around.
+INDEX_SLACK = 60.0
+
+
+def record_time(record):
+    """Unix time of a record (they carry a naive UTC ISO timestamp), None if it has none."""
+    try:
+        return datetime.fromisoformat(record["timestamp"]).replace(tzinfo=timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _split(path):
+    root, ext = os.path.splitext(path)
+    return root, ext or ".jsonl"
+
+
+def _segment_pattern(path):
+    # base-YYYYmmdd-HHMMSS[-n].ext[.gz], anchored on the exact base: a base name
+    # with dashes in it, or another log whose name starts with ours, can't confuse it
+    root, ext = _split(os.path.basename(path))
+    return re.compile(rf"{re.escape(root)}-(\d{{8}})-(\d{{6}})(?:-(\d+))?{re.escape(ext)}(?:{re.escape(GZ_SUFFIX)})?")
+
+
+def closed_segments(path):
+    """Rotated segments of the log `path`, oldest first (compressed or not)."""
+    root, ext = _split(path)
+    pattern = _segment_pattern(path)
+    segments = []
+    for segment in glob.glob(f"{glob.escape(root)}-*{ext}") + glob.glob(f"{glob.escape(root)}-*{ext}{GZ_SUFFIX}"):
+        match = pattern.fullmatch(os.path.basename(segment))
+        if match:
+            # by start time, then n (-10 comes after -9, no -n is the first)
+            segments.append(((match[1], match[2], int(match[3] or 1)), segment))
+    return [segment for _order, segment in sorted(segments)]
+
+
+def all_segments(path):
+    """Every segment of the log, oldest first, the live file last."""
+    segments = closed_segments(path)
+    if os.path.exists(path):
+        segments.append(path)
+    return segments
+
+
+def read_index(segment):
+    """[(time, line offset, file offset), ...] of a segment, [] if it has no index."""
+    try:
+        with open(segment + INDEX_SUFFIX, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            size -= size % INDEX_ENTRY.size # a torn last entry is ignored
+            if not size:
+                return []
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as view:
+                return list(INDEX_ENTRY.iter_unpack(view[:size]))
+    except (FileNotFoundError, ValueError):
+        return []
+
+
+class SegmentedLog:
+    """
+    One JSONL log with rotation, index and retention. Not thread safe: only the
+    AlertWriter thread touches it.
+    """
+
+    def __init__(self, path, segment_bytes=8 * 1024 * 1024, segment_seconds=86400, index_interval=65536,
+                 compress=True, retention_bytes=256 * 1024 * 1024, compressor=None):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.index_interval = index_interval
+        self.compress = compress
+        self.retention_bytes = retention_bytes
+        self.compressor = compressor # SegmentCompressor, None = compress inline
+
+        self._file = None
+        self._index = None
+        self._size = 0
+        self._last_indexed = None
+        self._started = 0.0
+
+        # Statistics
+        self.rotations = 0
+        self.deleted = 0
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "ab")
+        self._index = open(self.path + INDEX_SUFFIX, "ab")
+        self._size = self._file.tell()
+        entries = read_index(self.path)
+        if entries:
+            self._started = entries[0][0]
+            self._last_indexed = entries[-1][1]
+        else:
+            self._started = os.path.getmtime(self.path) if self._size else time.time()
+            self._last_indexed = None
+
+    def write(self, lines, now):
+        """
+        Append the encoded lines (bytes, newline terminated) of one batch.
+        `now` is the time of its first record, it's what the index points at.
+        """
+        if self._file is None:
+            self._open()
+        if self._size and (self._size >= self.segment_bytes or now - self._started >= self.segment_seconds):
+            self.rotate()
+            self._open()
+        if not self._size:
+            self._started = now
+        if self._last_indexed is None or self._size - self._last_indexed >= self.index_interval:
+            self._index.write(INDEX_ENTRY.pack(now, self._size, self._size))
+            self._index.flush()
+            self._last_indexed = self._size
+        self._file.write(lines)
+        self._file.flush()
+        self._size += len(lines)
+
+    def fileno(self):
+        return self._file.fileno() if self._file is not None else None
+
+    def close(self):
+        for f in (self._file, self._index):
+            if f is not None:
+                f.close()
+        self._file = self._index = None
+
+    def rotate(self):
+        """Close the live segment, rename it after its start time and queue it for compression."""
+        self.close()
+        root, ext = _split(self.path)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(self._started))
+        target = f"{root}-{stamp}{ext}"
+        n = 1
+        while os.path.exists(target) or os.path.exists(target + GZ_SUFFIX):
+            n += 1
+            target = f"{root}-{stamp}-{n}{ext}"
+        os.replace(self.path, target)
+        if os.path.exists(self.path + INDEX_SUFFIX):
+            os.replace(self.path + INDEX_SUFFIX, target + INDEX_SUFFIX)
+        self.rotations += 1
+        if self.compress:
+            if self.compressor is not None:
+                self.compressor.submit(target, self)
+            else:
+                compress_segment(target)
+                self.enforce_retention()
+        else:
+            self.enforce_retention()
+        return target
+
+    def enforce_retention(self):
+        """Delete the oldest closed segments until they fit in retention_bytes (0 = keep everything)."""
+        if not self.retention_bytes:
+            return
+        segments = closed_segments(self.path)
+        sizes = []
+        for segment in segments:
+            try:
+                size = os.path.getsize(segment)
+                if os.path.exists(segment + INDEX_SUFFIX):
+                    size += os.path.getsize(segment + INDEX_SUFFIX)
+            except OSError:
+                size = 0
+            sizes.append(size)
+        total = sum(sizes)
+        for segment, size in zip(segments, sizes):
+            if total <= self.retention_bytes:
+                break
+            for victim in (segment, segment + INDEX_SUFFIX):
+                try:
+                    os.remove(victim)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            self.deleted += 1
+
+
+def compress_segment(segment, level=6):
+    """
+    segment -> segment.gz with one gzip member per index block, and its index
+    rewritten with the compressed offsets. The original is removed.
+    """
+    entries = read_index(segment) or [(os.path.getmtime(segment), 0, 0)]
+    target = segment + GZ_SUFFIX
+    new_entries = []
+    with open(segment, "rb") as source, open(target + ".tmp", "wb") as out:
+        size = os.fstat(source.fileno()).st_size
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) if size else _Empty() as data:
+            bounds = [offset for _ts, offset, _stored in entries] + [size]
+            for (ts, offset, _stored), end in zip(entries, bounds[1:]):
+                new_entries.append((ts, offset, out.tell()))
+                packer = zlib.compressobj(level, zlib.DEFLATED, 31) # 31: gzip container
+                out.write(packer.compress(data[offset:end]) + packer.flush())
+    with open(target + INDEX_SUFFIX + ".tmp", "wb") as index:
+        for entry in new_entries:
+            index.write(INDEX_ENTRY.pack(*entry))
+    os.replace(target + ".tmp", target)
+    os.replace(target + INDEX_SUFFIX + ".tmp", target + INDEX_SUFFIX)
+    os.remove(segment)
+    if os.path.exists(segment + INDEX_SUFFIX):
+        os.remove(segment + INDEX_SUFFIX)
+    return target
+
+
+class _Empty:
+    # stands in for the mmap of an empty file (mmap can't map 0 bytes)
+    def __enter__(self):
+        return b""
+
+    def __exit__(self, *exc):
+        return False
+
+
+class SegmentCompressor:
+    """Background thread gzip'ing the closed segments, so rotation never stalls the writer."""
+
+    def __init__(self, error_logger=None):
+        self.error_logger = error_logger
+        self._queue = queue.Queue()
+        self._thread = None
+        self.compressed = 0
+        self.errors = 0
+
+    def submit(self, segment, log):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="loki-log-compressor", daemon=True)
+            self._thread.start()
+        self._queue.put((segment, log))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            segment, log = item
+            try:
+                compress_segment(segment)
+                self.compressed += 1
+            except Exception as e:
+                self.errors += 1
+                if self.error_logger:
+                    self.error_logger.error(f"Failed to compress {segment}: {e}")
+            try:
+                log.enforce_retention()
+            except Exception as e:
+                if self.error_logger:
+                    self.error_logger.error(f"Failed to apply the log retention: {e}")
+
+    def close(self, timeout=30.0):
+        """Finish the queued segments (called when the writer stops)."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+
+# ---------------------------------------------------------------- reading
+
+def _segment_lines(segment, start_offset, stored_offset):
+    """Yield the lines of a segment from an indexed position."""
+    if segment.endswith(GZ_SUFFIX):
+        with open(segment, "rb") as f:
+            f.seek(stored_offset)
+            unpacker = zlib.decompressobj(31)
+            pending = b""
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                data = chunk
+                while data:
+                    pending += unpacker.decompress(data)
+                    data = unpacker.unused_data
+                    if unpacker.eof:
+                        unpacker = zlib.decompressobj(31) # next gzip member
+                    else:
+                        break
+                *lines, pending = pending.split(b"\n")
+                yield from lines
+            if pending:
+                yield pending
+    else:
+        with open(segment, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= start_offset:
+                return
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+                position = start_offset
+                while position < size:
+                    end = data.find(b"\n", position)
+                    if end < 0:
+                        break # torn last line, still being written
+                    yield data[position:end]
+                    position = end + 1
+
+
+def read_range(path, since=None, until=None):
+    """
+    Yield the records of the log `path` (every segment) with since <= time < until,
+    seeking through the indexes instead of reading everything.
+    """
+    segments = all_segments(path)
+    indexes = [read_index(segment) for segment in segments]
+    for i, segment in enumerate(segments):
+        entries = indexes[i]
+        # the next segment already starts before `since`: nothing for us in this one
+        if since is not None and i + 1 < len(segments) and indexes[i + 1] and \
+                indexes[i + 1][0][0] <= since - INDEX_SLACK:
+            continue
+        if until is not None and entries and entries[0][0] > until + INDEX_SLACK:
+            break
+        start = (0, 0)
+        if since is not None and entries:
+            j = bisect_right([entry[0] for entry in entries], since - INDEX_SLACK) - 1
+            if j >= 0:
+                start = (entries[j][1], entries[j][2])
+        for line in _segment_lines(segment, *start):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            ts = record_time(record)
+            if ts is not None:
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts >= until:
+                    if ts >= until + INDEX_SLACK:
+                        return
+                    continue
+            yield record
+
+
+def follow(path, since=None, poll_interval=0.5):
+    """read_range(path, since) and then the records appended to the live file, forever (tail -f)."""
+    for record in read_range(path, since):
+        yield record
+    f = None
+    inode = None
+    while True:
+        try:
+            current = os.stat(path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != inode:
+            # first time, or the live file was rotated: the new one is read from its start
+            if f is not None:
+                yield from _read_new(f)
+                f.close()
+            f = open(path, "rb") if current is not None else None
+            if f is not None and inode is None:
+                f.seek(0, os.SEEK_END) # read_range above already went through it
+            inode = current
+        if f is not None:
+            yield from _read_new(f)
+        time.sleep(poll_interval)
+
+
+def _read_new(f):
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line:
+            return
+        if not line.endswith(b"\n"):
+            f.seek(position) # half written, next time
+            return
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+
+def parse_since(value):
+    """--since / --until of the command line tools: '1h', '30m', '2d', '45s' ago, or a unix time"""
+    if value is None:
+        return None
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value[-1] in units:
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Read the segmented Loki IDS logs by time range.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    read = sub.add_parser("read", help="print the records of a time range as JSON lines")
+    read.add_argument("--log", help="live log file (default: logs/loki_alerts.jsonl)")
+    read.add_argument("--since", help="1h, 30m, 2d... ago, or a unix time")
+    read.add_argument("--until", help="same format as --since")
+    read.add_argument("--follow", action="store_true", help="keep printing new records")
+    args = parser.parse_args(argv)
+
+    path = args.log
+    if path is None:
+        from logger import logger
+        path = logger.filepath
+    try:
+        if args.follow:
+            records = follow(path, parse_since(args.since))
+        else:
+            records = read_range(path, parse_since(args.since), parse_since(args.until))
+        for record in records:
+            sys.stdout.write(json.dumps(record) + "\n")
+            if args.follow:
+                sys.stdout.flush()
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
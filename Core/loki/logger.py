@@ -1,16 +1,230 @@
+import atexit
+import heapq
+import itertools
 import json
 import logging
 import os
+import queue
+import threading
 import time
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, Counter
+from enum import IntEnum
+from config import config
+from log_segments import SegmentedLog, SegmentCompressor, record_time
+
+
+class AlertKind(IntEnum):
+    """Alert types. Records and the console still show the name ("SIGNATURE", ...)."""
+    SIGNATURE = 1
+    BEHAVIOR = 2
+    BLACKLIST = 3
+
+
+class AlertState:
+    """Aggregation state of one active alert (see LokiLogger.log_alert)."""
+
+    __slots__ = ("first_seen", "last_seen", "last_logged", "packet_count", "update_count",
+                 "src_port", "dst_port", "details")
+
+    def __init__(self, timestamp, src_port, dst_port, details):
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.last_logged = timestamp
+        self.packet_count = 1
+        self.update_count = 0
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.details = details
+
+
+class AlertWriter:
+    """
+    Background writer for the JSONL alert file.
+    The packet threads only put records on a bounded queue (never blocking), one
+    thread owns the open files and group-commits records by size or time.
+    The files are SegmentedLogs (see log_segments.py): rotated, compressed and
+    indexed by time. System events go to their own file when system_filepath is set.
+    """
+    _STOP = object()
+
+    def __init__(self, filepath, queue_size=10000, batch_size=256, flush_interval=1.0,
+                 fsync="interval", fsync_interval=5.0, error_logger=None, sinks=(),
+                 system_filepath=None, rotation=None):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"unknown fsync policy: {fsync}")
+
+        self.filepath = filepath
+        self.system_filepath = system_filepath
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.error_logger = error_logger
+        self.sinks = list(sinks) # more destinations for every batch (write_batch / close), run on our thread
+
+        # stream -> SegmentedLog, only touched by our thread
+        self.rotation = dict(rotation or {})
+        self.compressor = SegmentCompressor(error_logger)
+        self.logs = {}
+
+        # Statistics
+        self.written = 0        # records that made it to the file
+        self.dropped = 0        # records thrown away because the queue was full
+        self.write_errors = 0
+        self.sink_errors = 0
+
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._last_fsync = time.monotonic()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="loki-alert-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, record, stream="alerts"):
+        """Queue a record for writing. Never blocks, returns False if it had to be dropped."""
+        try:
+            self._queue.put_nowait((stream, record))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    @property
+    def backlog(self):
+        return self._queue.qsize()
+
+    def close(self, timeout=5.0):
+        """Flush everything still queued and close the files."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def _run(self):
+        get = self._queue.get
+        while True:
+            # wait for the first record of the next batch
+            try:
+                item = get(timeout=self.fsync_interval if self.fsync == "interval" else None)
+            except queue.Empty:
+                self._maybe_fsync(force=False)
+                continue
+            if item is self._STOP:
+                break
+
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            # keep collecting until the batch is full or the flush interval passed
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._write_batch(batch)
+            if stop:
+                break
+
+        # drain whatever is left and close cleanly
+        leftovers = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                leftovers.append(item)
+        if leftovers:
+            self._write_batch(leftovers)
+        self._maybe_fsync(force=self.fsync != "never")
+        for log in self.logs.values():
+            log.close()
+        self.compressor.close() # segments rotated just now are still compressed
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                pass
+
+    def _log(self, stream):
+        path = self.system_filepath if stream == "system" and self.system_filepath else self.filepath
+        log = self.logs.get(path)
+        if log is None:
+            # the path changed (LokiLogger.set_log_file): close the one we don't use anymore
+            for old_path in list(self.logs):
+                if old_path not in (self.filepath, self.system_filepath):
+                    self.logs.pop(old_path).close()
+            log = self.logs[path] = SegmentedLog(path, compressor=self.compressor, **self.rotation)
+        return log
+
+    def _write_batch(self, batch):
+        by_log = {}
+        for stream, record in batch:
+            by_log.setdefault(self._log(stream), []).append(record)
+        now = time.time()
+        for log, records in by_log.items():
+            try:
+                log.write("".join(json.dumps(record) + "\n" for record in records).encode(),
+                          record_time(records[0]) or now)
+                self.written += len(records)
+            except Exception as e:
+                self.write_errors += 1
+                log.close() # reopened by the next batch
+                if self.error_logger:
+                    self.error_logger.error(f"Failed to write to log file {log.path}: {e}")
+        self._maybe_fsync(force=self.fsync == "always")
+
+        records = [record for _stream, record in batch]
+        for sink in self.sinks:
+            try:
+                sink.write_batch(records)
+            except Exception as e:
+                self.sink_errors += 1
+                if self.error_logger and (self.sink_errors in (1, 10, 100) or self.sink_errors % 1000 == 0):
+                    self.error_logger.error(f"Alert sink {type(sink).__name__} failed: {e}")
+
+    def _maybe_fsync(self, force):
+        if self.fsync == "never":
+            return
+        now = time.monotonic()
+        if force or now - self._last_fsync >= self.fsync_interval:
+            for log in self.logs.values():
+                fd = log.fileno()
+                if fd is None:
+                    continue
+                try:
+                    os.fsync(fd)
+                except OSError:
+                    pass
+            self._last_fsync = now
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+            "rotations": sum(log.rotations for log in list(self.logs.values())),
+            "segments_deleted": sum(log.deleted for log in list(self.logs.values())),
+            "segments_compressed": self.compressor.compressed,
+        }
+
 
 class LokiLogger:
     """
     Handles logging of IDS alerts to both console and a structured JSONL file.
     NOW WITH: Alert aggregation to prevent log flooding during attacks.
     """
-    def __init__(self, log_dir="logs", filename="loki_alerts.jsonl"):
+    def __init__(self, log_dir="logs", filename="loki_alerts.jsonl", system_filename=None):
         
         current_dir = os.path.dirname(os.path.abspath(__file__))
         project_root = os.path.dirname(os.path.dirname(current_dir))
@@ -18,6 +232,9 @@ class LokiLogger:
         
         self.filename = filename
         self.filepath = os.path.join(self.log_dir, self.filename)
+        rotation_config = config["log_rotation"]
+        system_filename = system_filename or rotation_config["system_file"]
+        self.system_filepath = os.path.join(self.log_dir, system_filename) if system_filename else None
         
         # Ensure log directory exists
         if not os.path.exists(self.log_dir):
@@ -37,50 +254,93 @@ class LokiLogger:
             formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
             ch.setFormatter(formatter)
             self.console_logger.addHandler(ch)
+
+        # Alert records are written by a background thread so the packet
+        # callbacks never wait on the disk.
+        writer_config = config["alert_writer"]
+        sinks = []
+        if config["alert_store"]["enabled"]:
+            # indexed copy of the records for queries (see alert_store.py)
+            from alert_store import AlertStoreSink
+            sinks.append(AlertStoreSink(config["alert_store"]["path"] or
+                                        os.path.join(self.log_dir, "loki_alerts.db")))
+        self.writer = AlertWriter(
+            self.filepath,
+            queue_size=writer_config["queue_size"],
+            batch_size=writer_config["batch_size"],
+            flush_interval=writer_config["flush_interval"],
+            fsync=writer_config["fsync"],
+            fsync_interval=writer_config["fsync_interval"],
+            error_logger=self.console_logger,
+            sinks=sinks,
+            system_filepath=self.system_filepath,
+            rotation={
+                "segment_bytes": rotation_config["segment_bytes"],
+                "segment_seconds": rotation_config["segment_seconds"],
+                "index_interval": rotation_config["index_interval"],
+                "compress": rotation_config["compress"],
+                "retention_bytes": rotation_config["retention_bytes"],
+            },
+        )
+        atexit.register(self.close)
         
         # ===== NEW: Alert Aggregation =====
         # Track active alerts to prevent flooding
-        self.active_alerts = {}  # Key: (type, src, dst, port) -> Alert state
+        self.active_alerts = {}  # Key: (AlertKind, message, src, dst, dst_port or None) -> AlertState
+        # (deadline, seq, key, state) min-heap: when each alert ends if nothing new
+        # comes in, so check_ended_alerts only looks at the ones due.
+        self._expiry = []
+        self._expiry_seq = itertools.count()
+        self._expiry_lock = threading.Lock()
         
         # Configuration
         self.alert_cooldown = 10      # Seconds - attack considered "ended" after this
         self.update_interval = 5      # Seconds - log updates during ongoing attacks
         self.max_updates = 3          # Max number of "ONGOING" logs per attack
         
+        # callbacks run with the record of every NEW alert (e.g. the packet tracer)
+        self.new_alert_hooks = []
+
         # Statistics
         self.suppressed_count = 0     # How many duplicate alerts we prevented
+        self.alert_counts = Counter() # message -> how many times log_alert was called for it
     
-    def log_alert(self, alert_type, src_ip, dst_ip, src_port, dst_port, message, details=None):
+    def log_alert(self, alert_type, src_ip, dst_ip, src_port, dst_port, message, details=None,
+                  group_by_port=True):
         """
         Logs an alert with smart deduplication.
         
         Args:
-            alert_type (str): "SIGNATURE", "BEHAVIOR", or "BLACKLIST".
+            alert_type (AlertKind): SIGNATURE, BEHAVIOR or BLACKLIST (the name as a str works too).
             src_ip (str): The attacker's IP address.
             dst_ip (str): The victim's IP address.
             src_port (int): Source port.
             dst_port (int): Destination port.
             message (str): A human-readable description (e.g., "Port Scan Detected").
             details (dict, optional): Extra data (e.g., ports scanned, payload snippet).
+            group_by_port (bool): one alert per destination port (floods, signatures), False
+                for one alert per (src, dst) pair whatever the port (port scans).
         """
+        self.alert_counts[message] += 1
+        if type(alert_type) is str:
+            alert_type = AlertKind[alert_type]
+
         # Create unique key for this type of alert
         # For port scans: group by (type, src_ip, dst_ip)
         # For floods: group by (type, src_ip, dst_ip, dst_port)
-        if "Port Scan" in message or "Scan" in message:
-            alert_key = (alert_type, message, src_ip, dst_ip, "scan")
-        else:
-            alert_key = (alert_type, message, src_ip, dst_ip, dst_port)
+        alert_key = (alert_type, message, src_ip, dst_ip, dst_port if group_by_port else None)
         
         current_time = time.time()
         
         # Check if this is a new or ongoing alert
-        if alert_key not in self.active_alerts:
+        alert_state = self.active_alerts.get(alert_key)
+        if alert_state is None:
             # NEW ALERT - Log it!
             self._log_new_alert(alert_key, alert_type, src_ip, dst_ip, src_port, 
                               dst_port, message, details, current_time)
         else:
             # ONGOING ALERT - Handle smartly
-            self._handle_ongoing_alert(alert_key, alert_type, src_ip, dst_ip, 
+            self._handle_ongoing_alert(alert_key, alert_state, alert_type, src_ip, dst_ip, 
                                        src_port, dst_port, message, details, current_time)
     
     def _log_new_alert(self, alert_key, alert_type, src_ip, dst_ip, src_port, 
@@ -89,55 +349,54 @@ class LokiLogger:
         
         # Console Output - Emphasized for new attack
         self.console_logger.warning(
-            f"🚨 [NEW] [{alert_type}] {src_ip}:{src_port} → {dst_ip}:{dst_port} - {message}"
+            f"🚨 [NEW] [{alert_type.name}] {src_ip}:{src_port} → {dst_ip}:{dst_port} - {message}"
         )
         
         # File Output
         record = {
             "timestamp": datetime.utcnow().isoformat(),
             "status": "STARTED",  # NEW field to track lifecycle
-            "type": alert_type,
+            "type": alert_type.name,
             "src_ip": src_ip,
             "src_port": src_port,
             "dst_ip": dst_ip,
             "dst_port": dst_port,
             "message": message,
-            "details": details or {}
+            "details": dict(details) if details else {} # copy, ongoing alerts keep updating the state's dict
         }
         
         self._write_to_file(record)
+
+        for hook in self.new_alert_hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                self.console_logger.error(f"Alert hook failed: {e}")
         
         # Track this alert
-        self.active_alerts[alert_key] = {
-            'first_seen': timestamp,
-            'last_seen': timestamp,
-            'last_logged': timestamp,
-            'packet_count': 1,
-            'update_count': 0,
-            'src_port': src_port,
-            'dst_port': dst_port,
-            'details': details or {}
-        }
+        alert_state = AlertState(timestamp, src_port, dst_port, details or {})
+        with self._expiry_lock:
+            self.active_alerts[alert_key] = alert_state
+            heapq.heappush(self._expiry, (timestamp + self.alert_cooldown, next(self._expiry_seq),
+                                          alert_key, alert_state))
     
-    def _handle_ongoing_alert(self, alert_key, alert_type, src_ip, dst_ip, 
+    def _handle_ongoing_alert(self, alert_key, alert_state, alert_type, src_ip, dst_ip, 
                              src_port, dst_port, message, details, timestamp):
         """Handle repeated alerts (ongoing attack)"""
         
-        alert_state = self.active_alerts[alert_key]
-        
-        # Update state
-        alert_state['last_seen'] = timestamp
-        alert_state['packet_count'] += 1
+        # Update state (the expiry heap entry stays as is, it's checked against last_seen when due)
+        alert_state.last_seen = timestamp
+        alert_state.packet_count += 1
         
         # Merge new details with existing
         if details:
-            alert_state['details'].update(details)
+            alert_state.details.update(details)
         
         # Check if we should log an update
-        time_since_last_log = timestamp - alert_state['last_logged']
+        time_since_last_log = timestamp - alert_state.last_logged
         
         if (time_since_last_log >= self.update_interval and 
-            alert_state['update_count'] < self.max_updates):
+            alert_state.update_count < self.max_updates):
             # Log an ONGOING update
             self._log_ongoing_update(alert_key, alert_type, src_ip, dst_ip, 
                                     src_port, dst_port, message, timestamp, alert_state)
@@ -145,120 +404,150 @@ class LokiLogger:
             # Suppress this duplicate alert
             self.suppressed_count += 1
             # Optionally log to console every N packets
-            if alert_state['packet_count'] % 100 == 0:
+            if alert_state.packet_count % 100 == 0:
                 self.console_logger.debug(
-                    f"⚠️  [{alert_type}] {src_ip} → {dst_ip}:{dst_port} - "
-                    f"{message} ({alert_state['packet_count']} packets)"
+                    f"⚠️  [{alert_type.name}] {src_ip} → {dst_ip}:{dst_port} - "
+                    f"{message} ({alert_state.packet_count} packets)"
                 )
     
     def _log_ongoing_update(self, alert_key, alert_type, src_ip, dst_ip, 
                            src_port, dst_port, message, timestamp, alert_state):
         """Log periodic updates during ongoing attack"""
         
-        duration = timestamp - alert_state['first_seen']
+        duration = timestamp - alert_state.first_seen
         
         # Console Output
         self.console_logger.warning(
-            f"⚠️  [ONGOING] [{alert_type}] {src_ip}:{src_port} → {dst_ip}:{dst_port} - "
-            f"{message} ({alert_state['packet_count']} packets, {duration:.1f}s)"
+            f"⚠️  [ONGOING] [{alert_type.name}] {src_ip}:{src_port} → {dst_ip}:{dst_port} - "
+            f"{message} ({alert_state.packet_count} packets, {duration:.1f}s)"
         )
         
         # File Output
         record = {
             "timestamp": datetime.utcnow().isoformat(),
             "status": "ONGOING",
-            "type": alert_type,
+            "type": alert_type.name,
             "src_ip": src_ip,
             "src_port": src_port,
             "dst_ip": dst_ip,
             "dst_port": dst_port,
             "message": message,
             "duration_seconds": round(duration, 2),
-            "packet_count": alert_state['packet_count'],
-            "attack_rate_pps": round(alert_state['packet_count'] / duration, 1) if duration > 0 else 0,
-            "details": alert_state['details']
+            "packet_count": alert_state.packet_count,
+            "attack_rate_pps": round(alert_state.packet_count / duration, 1) if duration > 0 else 0,
+            "details": dict(alert_state.details) # copy, the writer thread serializes it later
         }
         
         self._write_to_file(record)
         
         # Update tracking
-        alert_state['last_logged'] = timestamp
-        alert_state['update_count'] += 1
+        alert_state.last_logged = timestamp
+        alert_state.update_count += 1
     
     def check_ended_alerts(self):
         """
         Check for attacks that have ended.
         Call this periodically (e.g., every 1-2 seconds) from your main IDS loop.
+        Only the alerts whose deadline passed are looked at: one that saw
+        packets since it was scheduled goes back in the heap with its new
+        deadline, the others are ended.
         """
         current_time = time.time()
         ended_alerts = []
         
-        for alert_key, alert_state in self.active_alerts.items():
-            # Check if attack has been inactive for cooldown period
-            time_since_last = current_time - alert_state['last_seen']
-            
-            if time_since_last >= self.alert_cooldown:
-                self._log_ended_alert(alert_key, alert_state, current_time)
-                ended_alerts.append(alert_key)
-        
-        # Remove ended alerts
-        for key in ended_alerts:
-            del self.active_alerts[key]
+        expiry = self._expiry
+        with self._expiry_lock:
+            while expiry and expiry[0][0] <= current_time:
+                _deadline, _seq, alert_key, alert_state = heapq.heappop(expiry)
+                if self.active_alerts.get(alert_key) is not alert_state:
+                    continue # stale entry
+                # Check if attack has been inactive for cooldown period
+                deadline = alert_state.last_seen + self.alert_cooldown
+                if deadline > current_time:
+                    heapq.heappush(expiry, (deadline, next(self._expiry_seq), alert_key, alert_state))
+                    continue
+                del self.active_alerts[alert_key]
+                ended_alerts.append((alert_key, alert_state))
+        
+        # logged outside the lock, the packet threads may open new alerts meanwhile
+        for alert_key, alert_state in ended_alerts:
+            self._log_ended_alert(alert_key, alert_state, current_time)
         
         return len(ended_alerts)
     
     def _log_ended_alert(self, alert_key, alert_state, timestamp):
         """Log when an attack ends"""
         
-        alert_type, message, src_ip, dst_ip, dst_port_or_scan = alert_key
+        alert_type, message, src_ip, dst_ip, _dst_port = alert_key
         
-        total_duration = alert_state['last_seen'] - alert_state['first_seen']
+        total_duration = alert_state.last_seen - alert_state.first_seen
         
         # Console Output
         self.console_logger.info(
-            f"✅ [ENDED] [{alert_type}] {src_ip} → {dst_ip} - {message} "
-            f"(Total: {alert_state['packet_count']} packets, {total_duration:.1f}s)"
+            f"✅ [ENDED] [{alert_type.name}] {src_ip} → {dst_ip} - {message} "
+            f"(Total: {alert_state.packet_count} packets, {total_duration:.1f}s)"
         )
         
         # File Output - Comprehensive summary
         record = {
             "timestamp": datetime.utcnow().isoformat(),
             "status": "ENDED",
-            "type": alert_type,
+            "type": alert_type.name,
             "src_ip": src_ip,
             "dst_ip": dst_ip,
-            "src_port": alert_state.get('src_port', 0),
-            "dst_port": alert_state.get('dst_port', 0),
+            "src_port": alert_state.src_port,
+            "dst_port": alert_state.dst_port,
             "message": message,
             "total_duration_seconds": round(total_duration, 2),
-            "total_packets": alert_state['packet_count'],
-            "average_rate_pps": round(alert_state['packet_count'] / total_duration, 1) if total_duration > 0 else 0,
-            "first_seen": datetime.fromtimestamp(alert_state['first_seen']).isoformat(),
-            "last_seen": datetime.fromtimestamp(alert_state['last_seen']).isoformat(),
-            "details": alert_state['details']
+            "total_packets": alert_state.packet_count,
+            "average_rate_pps": round(alert_state.packet_count / total_duration, 1) if total_duration > 0 else 0,
+            "first_seen": datetime.fromtimestamp(alert_state.first_seen).isoformat(),
+            "last_seen": datetime.fromtimestamp(alert_state.last_seen).isoformat(),
+            "details": dict(alert_state.details)
         }
         
         self._write_to_file(record)
     
     def _write_to_file(self, record):
-        """Write JSON record to log file"""
-        try:
-            with open(self.filepath, 'a') as f:
-                f.write(json.dumps(record) + "\n")
-        except Exception as e:
-            self.console_logger.error(f"Failed to write to log file: {e}")
+        """Hand the JSON record to the background writer (never blocks)"""
+        self.writer.submit(record)
+
+    def set_log_file(self, filename, system_filename=None):
+        """Send the following records (and system events, if given) to other files in the log directory"""
+        self.filename = filename
+        self.filepath = os.path.join(self.log_dir, filename)
+        self.writer.filepath = self.filepath
+        if system_filename:
+            self.system_filepath = os.path.join(self.log_dir, system_filename)
+            self.writer.system_filepath = self.system_filepath
+
+    def close(self):
+        """Flush the queued records to disk, call it on shutdown"""
+        self.writer.close()
     
     def get_stats(self):
         """Get logging statistics"""
         return {
             'active_alerts': len(self.active_alerts),
             'suppressed_alerts': self.suppressed_count,
-            'suppression_rate': f"{(self.suppressed_count / max(1, self.suppressed_count + len(self.active_alerts))) * 100:.1f}%"
+            'alerts_raised': sum(self.alert_counts.values()),
+            'writer_backlog': self.writer.backlog,
+            'writer_dropped': self.writer.dropped,
+            'log_rotations': self.writer.stats()["rotations"],
+            # share of the alerts raised by the detectors that never reached the log
+            'suppression_rate': f"{(self.suppressed_count / max(1, sum(self.alert_counts.values()))) * 100:.1f}%"
         }
     
+    def set_console_quiet(self, quiet):
+        """Only errors on the console (overload shedding), the files still get everything."""
+        level = logging.ERROR if quiet else logging.NOTSET
+        for handler in self.console_logger.handlers:
+            handler.setLevel(level)
+
     def log_system_event(self, message, level="INFO"):
         """
         Log non-alert system events (startup, shutdown, errors, etc.)
+        They go to their own file (log_rotation.system_file), the alert log only has alerts.
         """
         if level == "ERROR":
             self.console_logger.error(message)
@@ -274,7 +563,7 @@ class LokiLogger:
             "message": message
         }
         
-        self._write_to_file(record)
+        self.writer.submit(record, stream="system")
 
 # Create a singleton instance for easy import
 logger = LokiLogger()
\ No newline at end of file
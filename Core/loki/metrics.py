@@ -0,0 +1,382 @@
+import json
+import os
+import threading
+import time
+
+from config import config
+from logger import logger
+
+# Built-in instrumentation: packet/verdict counters and per-stage latency
+# histograms for every chain, plus gauges pulled from the detectors, flow
+# caches and the alert writer when somebody asks for them.
+# Exposed as Prometheus text on a local HTTP port and as a JSON file under
+# logs/ that is rewritten every few seconds.
+#
+# The packet path only does integer work: a histogram observation is one
+# bit_length() and two additions, no locks. Each chain (queue) has its own
+# ChainMetrics, so the agent threads never write to the same counters.
+
+perf_ns = time.perf_counter_ns
+
+
+def _process_start():
+    """time.monotonic() value of when this process started (interpreter startup and imports included)."""
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        age = uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK") # field 22: start time in clock ticks after boot
+        if 0 <= age < 60:
+            return time.monotonic() - age
+    except (OSError, ValueError, IndexError):
+        pass
+    return time.monotonic() # no /proc: count from the first import of this module
+
+
+PROCESS_START = _process_start()
+
+STAGES = ("parse", "sketches", "behavior", "signature", "logging")
+
+# log2 buckets over nanoseconds: bucket b holds durations with b significant bits,
+# i.e. below 2**b ns. 2**33 ns is ~8.6 s, anything slower lands in the last one.
+N_BUCKETS = 34
+
+
+class Histogram:
+    """Latency histogram with power-of-two buckets, O(1) observe and constant memory."""
+
+    __slots__ = ("counts", "count", "total_ns")
+
+    def __init__(self):
+        self.counts = [0] * N_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+
+    def observe(self, ns):
+        bucket = ns.bit_length()
+        if bucket >= N_BUCKETS:
+            bucket = N_BUCKETS - 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total_ns += ns
+
+    def quantile(self, q):
+        """Upper bound (ns) of the bucket holding the q-quantile, 0 when empty."""
+        if not self.count:
+            return 0
+        target = q * self.count
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return 1 << bucket
+        return 1 << (N_BUCKETS - 1)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": round(self.total_ns / self.count / 1000, 2) if self.count else 0.0,
+            "p50_us": self.quantile(0.50) / 1000,
+            "p99_us": self.quantile(0.99) / 1000,
+        }
+
+
+class ChainMetrics:
+    """Counters and stage histograms of one chain/queue, written only by its agent thread."""
+
+    __slots__ = ("chain", "queue", "packets", "dropped", "errors", "wakeups",
+                 "parse", "sketches", "behavior", "signature", "logging",
+                 "_last_packets", "_last_time", "pps")
+
+    def __init__(self, chain, queue):
+        self.chain = chain
+        self.queue = queue
+        self.packets = 0
+        self.dropped = 0
+        self.errors = 0
+        self.wakeups = 0 # receive loop wakeups (drain mode), packets / wakeups = burst size
+        self.parse = Histogram()
+        self.sketches = Histogram() # top talkers, not part of "behavior" (that's the detectors)
+        self.behavior = Histogram()
+        self.signature = Histogram()
+        self.logging = Histogram()
+        self._last_packets = 0
+        self._last_time = time.monotonic()
+        self.pps = 0.0
+
+    @property
+    def accepted(self):
+        return self.packets - self.dropped
+
+    def update_rate(self, now):
+        elapsed = now - self._last_time
+        if elapsed > 0:
+            packets = self.packets
+            self.pps = (packets - self._last_packets) / elapsed
+            self._last_packets = packets
+            self._last_time = now
+
+    def snapshot(self):
+        return {
+            "chain": self.chain,
+            "queue": self.queue,
+            "packets": self.packets,
+            "pps": round(self.pps, 1),
+            "verdicts": {"accept": self.accepted, "drop": self.dropped},
+            "errors": self.errors,
+            "wakeups": self.wakeups,
+            "latency": {stage: getattr(self, stage).summary() for stage in STAGES},
+        }
+
+
+# gauges the collectors may report: name -> (type, help)
+GAUGE_HELP = {
+    "loki_detector_keys": ("gauge", "Live keys in a detector state table"),
+    "loki_detector_bytes": ("gauge", "Approximate memory of a detector state table"),
+    "loki_detector_evictions_total": ("counter", "Keys evicted from a detector state table"),
+    "loki_flow_cache_flows": ("gauge", "Flows in the flow cache"),
+    "loki_flow_cache_fast_path_total": ("counter", "Packets that took the flow cache fast path"),
+    "loki_stream_reassembly_streams": ("gauge", "TCP stream directions tracked by the reassembly"),
+    "loki_stream_reassembly_bytes": ("gauge", "Bytes held by the reassembly (tails + parked segments)"),
+    "loki_stream_reassembly_out_of_order_total": ("counter", "Out of order TCP segments seen by the reassembly"),
+    "loki_heavy_hitter_window_packets": ("gauge", "Packets counted by the heavy hitter sketches in the last window"),
+    "loki_heavy_hitter_packets": ("gauge", "Packets of the top keys in the last window (Space-Saving upper bound)"),
+    "loki_signature_rule_cpu_seconds_total": ("counter", "CPU time spent evaluating the regex of a signature"),
+    "loki_signature_rule_evaluations_total": ("counter", "Times the regex of a signature had to run"),
+    "loki_signature_rule_matches_total": ("counter", "Payloads a signature matched"),
+    "loki_blocklist_entries": ("gauge", "Blocklist entries"),
+    "loki_blocklist_hits_total": ("counter", "Packets dropped by the blocklist"),
+    "loki_enforcement_entries": ("gauge", "Offenders in the kernel drop set (pushed and not expired)"),
+    "loki_enforcement_pending": ("gauge", "Offenders waiting for the next kernel set update"),
+    "loki_enforcement_pushed_total": ("counter", "Offenders pushed to the kernel drop set"),
+    "loki_enforcement_errors_total": ("counter", "Failed kernel set updates"),
+    "loki_overload_tier": ("gauge", "Load shedding tier (0 normal, 1 degraded, 2 overloaded, 3 critical)"),
+    "loki_overload_transitions_total": ("counter", "Load shedding tier changes"),
+    "loki_overload_lag_seconds": ("gauge", "Peak lag behind the packet timestamps over the last second"),
+    "loki_overload_shed_total": ("counter", "Work skipped because of the load shedding tier"),
+    "loki_queue_depth": ("gauge", "Packets waiting in the kernel queue"),
+    "loki_queue_kernel_drops_total": ("counter", "Packets the kernel dropped or let through because the queue was full"),
+    "loki_alerts_active": ("gauge", "Attacks currently tracked by the alert aggregation"),
+    "loki_alerts_raised_total": ("counter", "Alerts raised by the detectors (before deduplication)"),
+    "loki_alerts_suppressed_total": ("counter", "Duplicate alerts suppressed by the aggregation"),
+    "loki_alert_writer_backlog": ("gauge", "Alert records waiting for the disk"),
+    "loki_alert_writer_dropped_total": ("counter", "Alert records dropped because the writer queue was full"),
+    "loki_alert_log_rotations_total": ("counter", "Segments of the alert and system logs rotated"),
+}
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class MetricsRegistry:
+    """All the ChainMetrics of this process plus the gauge collectors."""
+
+    def __init__(self):
+        self.chains = {}      # queue number -> ChainMetrics
+        self.collectors = []  # callables returning [(name, labels dict, value), ...]
+        self.started = time.time()
+        self.startup = {}     # startup stage -> seconds since the process started
+
+    def mark_startup(self, stage, process_start):
+        """Record how long after `process_start` (time.monotonic()) this startup stage was reached."""
+        elapsed = time.monotonic() - process_start
+        self.startup[stage] = elapsed
+        return elapsed
+
+    def chain(self, chain_name, queue):
+        metrics = self.chains.get(queue)
+        if metrics is None:
+            metrics = self.chains[queue] = ChainMetrics(chain_name, queue)
+        return metrics
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def gauges(self):
+        samples = []
+        for collector in self.collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                # a collector racing a packet thread must not break the whole scrape
+                logger.console_logger.debug(f"metrics collector failed: {e}")
+        return samples
+
+    def update_rates(self):
+        now = time.monotonic()
+        for metrics in list(self.chains.values()):
+            metrics.update_rate(now)
+
+    def snapshot(self):
+        gauges = {}
+        for name, labels, value in self.gauges():
+            gauges.setdefault(name, []).append({"labels": labels, "value": value})
+        return {
+            "timestamp": time.time(),
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "pid": os.getpid(),
+            "startup_seconds": {stage: round(seconds, 4) for stage, seconds in list(self.startup.items())},
+            "chains": [metrics.snapshot() for metrics in list(self.chains.values())],
+            "gauges": gauges,
+        }
+
+    def render_prometheus(self):
+        out = []
+        chains = list(self.chains.values())
+
+        def counter(name, help_text, attr):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} counter")
+            for m in chains:
+                out.append(f'{name}{{chain="{m.chain}",queue="{m.queue}"}} {getattr(m, attr)}')
+
+        counter("loki_packets_total", "Packets handed to the engine", "packets")
+        counter("loki_packet_errors_total", "Packets whose processing raised an exception", "errors")
+        counter("loki_queue_wakeups_total", "Receive loop wakeups, each handles every packet queued by then", "wakeups")
+
+        out.append("# HELP loki_verdicts_total Packets per verdict")
+        out.append("# TYPE loki_verdicts_total counter")
+        for m in chains:
+            out.append(f'loki_verdicts_total{{chain="{m.chain}",queue="{m.queue}",verdict="accept"}} {m.accepted}')
+            out.append(f'loki_verdicts_total{{chain="{m.chain}",queue="{m.queue}",verdict="drop"}} {m.dropped}')
+
+        out.append("# HELP loki_packets_per_second Packet rate over the last stats interval")
+        out.append("# TYPE loki_packets_per_second gauge")
+        for m in chains:
+            out.append(f'loki_packets_per_second{{chain="{m.chain}",queue="{m.queue}"}} {m.pps:.1f}')
+
+        out.append("# HELP loki_stage_latency_seconds Time spent per packet in each pipeline stage")
+        out.append("# TYPE loki_stage_latency_seconds histogram")
+        for m in chains:
+            for stage in STAGES:
+                hist = getattr(m, stage)
+                base = f'chain="{m.chain}",queue="{m.queue}",stage="{stage}"'
+                cumulative = 0
+                for bucket, n in enumerate(hist.counts):
+                    cumulative += n
+                    if bucket < N_BUCKETS - 1:
+                        out.append(f'loki_stage_latency_seconds_bucket{{{base},le="{(1 << bucket) / 1e9:g}"}} {cumulative}')
+                out.append(f'loki_stage_latency_seconds_bucket{{{base},le="+Inf"}} {hist.count}')
+                out.append(f'loki_stage_latency_seconds_sum{{{base}}} {hist.total_ns / 1e9:.9f}')
+                out.append(f'loki_stage_latency_seconds_count{{{base}}} {hist.count}')
+
+        out.append("# HELP loki_startup_seconds Seconds from process start to each startup stage")
+        out.append("# TYPE loki_startup_seconds gauge")
+        for stage, seconds in list(self.startup.items()):
+            out.append(f'loki_startup_seconds{{stage="{stage}"}} {seconds:.4f}')
+
+        described = set()
+        for name, labels, value in sorted(self.gauges(), key=lambda sample: sample[0]):
+            if name not in described:
+                described.add(name)
+                kind, help_text = GAUGE_HELP.get(name, ("gauge", name))
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} {kind}")
+            out.append(f"{name}{_labels(labels)} {value}")
+
+        return "\n".join(out) + "\n"
+
+
+def _handler_class(registry):
+    # http.server (and the email/ssl modules behind it) is imported here, in the
+    # exporter thread, so it never adds to the startup time.
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path in ("/metrics", "/"):
+                body = registry.render_prometheus().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/stats.json":
+                body = json.dumps(registry.snapshot(), indent=2).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # no console line per scrape
+
+    return MetricsHandler
+
+
+class MetricsExporter:
+    """Serves the registry over HTTP and rewrites the JSON stats file, both from background threads."""
+
+    def __init__(self, registry, host="127.0.0.1", port=9108, stats_path=None, interval=10.0):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.stats_path = stats_path
+        self.interval = max(1.0, interval)
+        self._server = None
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="loki-metrics", daemon=True).start()
+
+    def _serve(self):
+        from http.server import ThreadingHTTPServer
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), _handler_class(self.registry))
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, name="loki-metrics-http", daemon=True).start()
+            logger.log_system_event(f"Metrics on http://{self.host}:{self.port}/metrics", "INFO")
+        except OSError as e:
+            logger.log_system_event(f"Couldn't start the metrics endpoint on {self.host}:{self.port}: {e}", "ERROR")
+            self._server = None
+
+    def _run(self):
+        if self.port:
+            self._serve()
+        while not self._stop.wait(self.interval):
+            self.registry.update_rates()
+            self.write_stats()
+
+    def write_stats(self):
+        if not self.stats_path:
+            return
+        tmp_path = self.stats_path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.registry.snapshot(), f, indent=2)
+            os.replace(tmp_path, self.stats_path) # readers never see a half written file
+        except Exception as e:
+            logger.console_logger.error(f"[!] couldn't write the stats file {self.stats_path}: {e}")
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self.registry.update_rates()
+        self.write_stats()
+
+
+metrics_config = config["metrics"]
+
+# one registry per process, like the logger
+registry = MetricsRegistry()
+
+
+def start_exporter(port_offset=0, stats_name="loki_stats.json"):
+    """Start the HTTP endpoint / stats file of this process as configured, returns the exporter (or None)."""
+    if not metrics_config["enabled"]:
+        return None
+    port = metrics_config["port"] + port_offset if metrics_config["http"] else 0
+    stats_path = os.path.join(logger.log_dir, stats_name) if metrics_config["stats_file"] else None
+    exporter = MetricsExporter(registry, host=metrics_config["host"], port=port,
+                               stats_path=stats_path, interval=metrics_config["stats_interval"])
+    exporter.start()
+    return exporter
@@ -1,55 +1,279 @@
-from netfilterqueue import NetfilterQueue
+import argparse
+import os
+import signal
 import threading
 import time
+from config import config
 from packet_parser import scan_packet
 from detectore_engine import PortScanningDetector
 from signature_engine import SignatureScanning
-from scapy.all import IP, Raw, ICMP
-from logger import logger  # my logger module
-
-
-def process_packet(packet, IsInput, port_scanner, sig_scanner):
+from flow_cache import FlowCache, FLOW_INSPECT, FLOW_BENIGN, FLOW_DROP, TCP_ESTABLISHED
+from stream_reassembly import StreamReassembler
+from sketches import TrafficSketches
+from summary_export import SummaryExporter, default_node_name
+from packet_trace import tracer
+from blocklist import blocklist
+from enforcement import Enforcer, EnforcementError, new_backend
+from overload import OverloadMonitor, read_queue_stats, DEGRADED, TIER_NAMES
+from metrics import ChainMetrics, registry, start_exporter, perf_ns, PROCESS_START
+from logger import logger, AlertKind  # my logger module
+
+sharding_config = config["sharding"]
+nfqueue_config = config["nfqueue"]
+
+flow_config = config["flow_cache"]
+stream_config = config["stream_reassembly"]
+signature_config = config["signatures"]
+console_packets = config["trace"]["console_packets"]
+blocklist_config = config["blocklist"]
+enforcement_config = config["enforcement"]
+overload_config = config["overload"]
+heavy_config = config["heavy_hitters"]
+export_config = config["summary_export"]
+
+# queue number -> PortScanningDetector / FlowCache of the agent serving it (for stats export)
+active_detectors = {}
+active_flow_caches = {}
+active_reassemblers = {}
+active_sig_scanners = {}
+active_sketches = {}
+active_overload = {}
+
+# kernel set the automatic blocks are pushed to, set up by start_enforcement()
+enforcer = None
+
+# INPUT queues of the sharded mode, split by source: a flood on the Pi is
+# spread over all of them (set by shard_worker, 1 = not sharded)
+input_shards = 1
+
+
+# counts into nothing when the caller doesn't pass its ChainMetrics
+_unmetered = ChainMetrics("UNMETERED", -1)
+
+
+def new_flow_cache():
+    if not flow_config["enabled"]:
+        return None
+    return FlowCache(max_flows=flow_config["max_flows"], ttl=flow_config["ttl"],
+                     inspect_bytes=flow_config["inspect_bytes"])
+
+
+def raise_alert(metrics, **alert):
+    # logger.log_alert, timed into the "logging" stage
+    start = perf_ns()
+    logger.log_alert(**alert)
+    metrics.logging.observe(perf_ns() - start)
+
+
+def new_overload_monitor(queue_num):
+    if not overload_config["enabled"]:
+        return None
+    return OverloadMonitor(queue_num, nfqueue_config["max_len"], overload_config)
+
+
+def new_sketches(shards=1):
+    """`shards`: queues the traffic is split over by source, the dst / dst_port thresholds are shared."""
+    if not heavy_config["enabled"]:
+        return None
+    thresholds = dict(heavy_config["thresholds"])
+    if shards > 1:
+        for name in ("dst", "dst_port"):
+            if thresholds.get(name):
+                thresholds[name] = max(1, -(-thresholds[name] // shards))
+    return TrafficSketches(window=heavy_config["window"], width=heavy_config["width"],
+                           depth=heavy_config["depth"], k=heavy_config["top_k"],
+                           thresholds=thresholds)
+
+
+def new_summary_exporter():
+    if not (export_config["enabled"] and heavy_config["enabled"]):
+        return None
+    try:
+        return SummaryExporter(
+            node=export_config["node"] or default_node_name(),
+            mode=export_config["mode"],
+            spool_dir=export_config["spool_dir"] or os.path.join(logger.log_dir, "summaries"),
+            socket_path=export_config["socket_path"] or os.path.join(logger.log_dir, "collector.sock"),
+            error_logger=logger.console_logger,
+        )
+    except (OSError, ValueError) as e:
+        logger.log_system_event(f"Summary export disabled: {e}", "ERROR")
+        return None
+
+
+def export_summaries(summary_exporter):
+    # the complete windows of every queue, the packet threads only swap them in
+    for queue_num, sketches in list(active_sketches.items()):
+        if sketches is not None:
+            chain = registry.chains[queue_num].chain if queue_num in registry.chains else ""
+            summary_exporter.export(chain, queue_num, sketches)
+
+
+def heavy_hitter_alert(metrics, chain_name, sketches, info, dimension, key, estimate):
+    # one address / port went over its packets-per-window threshold, whoever it talks to
+    details = {"dimension": dimension, "key": key, "packets": estimate,
+               "window_seconds": heavy_config["window"], "chain": chain_name}
+    src_ip = dst_ip = "*"
+    dst_port = 0
+    if dimension == "src":
+        src_ip = key
+        message = f"Heavy Hitter Source on {chain_name} chain"
+        details["top_destinations"] = sketches.destinations.top_keys.top(5)
+    elif dimension == "dst":
+        dst_ip = key
+        message = f"Heavy Hitter Destination (DDoS) on {chain_name} chain"
+        details["top_sources"] = sketches.sources.top_keys.top(5)
+    else:
+        dst_port = info.dst_port
+        message = f"Heavy Hitter Port on {chain_name} chain"
+        details["top_sources"] = sketches.sources.top_keys.top(5)
+    raise_alert(
+        metrics,
+        alert_type=AlertKind.BEHAVIOR,
+        src_ip=src_ip,
+        dst_ip=dst_ip,
+        src_port=0,
+        dst_port=dst_port,
+        message=message,
+        details=details,
+    )
+
+
+def new_reassembler():
+    if not stream_config["enabled"]:
+        return None
+    return StreamReassembler(max_flows=stream_config["max_flows"], ttl=stream_config["ttl"],
+                             max_flow_bytes=stream_config["max_flow_bytes"],
+                             max_total_bytes=stream_config["max_total_bytes"])
+
+
+def new_sig_scanner():
+    cache_dir = os.path.join(logger.log_dir, "cache") if signature_config["cache"] else None
+    sig_object = SignatureScanning(regex_window=stream_config["regex_window"], cache_dir=cache_dir)
+    registry.mark_startup("rules", PROCESS_START)
+    return sig_object
+
+
+def queue_bound(queue_num):
+    # from here on the queue is ours, --queue-bypass no longer lets its packets through unchecked
+    elapsed = registry.mark_startup(f"queue_{queue_num}", PROCESS_START)
+    logger.log_system_event(f"Queue {queue_num} bound {elapsed:.3f}s after start", "INFO")
+
+
+def auto_block(address, ttl, reason):
+    # temporary block of a detected attacker, its next packets only cost the blocklist lookup
+    # (or nothing at all once the enforcer pushed it into the kernel set)
+    if not ttl:
+        return
+    if blocklist is not None:
+        if not blocklist.block(address, ttl, reason, automatic=True):
+            return # never_block / full, the kernel set doesn't get it either
+        logger.console_logger.debug(f"[*] Blocked {address} for {ttl}s: {reason}")
+    if enforcer is not None:
+        enforcer.offend(address, ttl, reason)
+
+
+def start_enforcement():
+    """Set up the kernel drop set if enforcement is enabled (live modes only, replay never calls it)."""
+    global enforcer
+    if not enforcement_config["enabled"]:
+        return
+    try:
+        backend = new_backend(enforcement_config, log=logger.console_logger.info)
+        backend.setup()
+    except EnforcementError as e:
+        logger.log_system_event(f"Kernel enforcement disabled: {e}", "ERROR")
+        return
+    enforcer = Enforcer(backend, max_batch=enforcement_config["max_batch"],
+                        max_entries=enforcement_config["max_entries"],
+                        never_block=blocklist_config["never_block"], error_logger=logger.console_logger)
+    queued = enforcer.sync(blocklist) if blocklist is not None and enforcement_config["sync_blocklist"] else 0
+    logger.log_system_event(f"Kernel enforcement on ({backend.name}), {queued} blocklist entries queued", "INFO")
+
+
+def process_packet(packet, IsInput, port_scanner, sig_scanner, flow_cache=None, metrics=None, reassembler=None,
+                   sketches=None, overload=None):
     
     chain_name = "INPUT" if IsInput else "FORWARD"
+    if metrics is None:
+        metrics = _unmetered
+    metrics.packets += 1
 
     try:
+        raw = packet.get_payload()
+        now = time.time()
+
+        # blocklist first, straight on the raw addresses: a known attacker
+        # costs this lookup and nothing else.
+        if blocklist is not None and blocklist.check_header(raw, now, blocklist_config["match_destination"]):
+            metrics.dropped += 1
+            packet.drop()
+            return
+
         # now we are working in the input chain packet..
-        packetInfo = scan_packet(packet)
-        src_ip = packetInfo.get("src_ip")
-        dst_ip = packetInfo.get("dst_ip")
-        src_port = packetInfo.get("src_port")
-        dst_port = packetInfo.get("dst_port")
-        raw_timestamp = packetInfo.get("rawts")
-        tcp_flags = packetInfo.get("tcp_flags")
-        port = packetInfo.get('port')
+        # one pass over the raw headers, no Scapy on the hot path.
+        start = perf_ns()
+        packetInfo = scan_packet(packet, raw)
+        metrics.parse.observe(perf_ns() - start)
+        if packetInfo is None:
+            # not IPv4 (or garbage), nothing for us to analyze.
+            packet.accept()
+            return
+
+        # how far behind the kernel we are, the overload monitor picks the tier from it
+        console = console_packets
+        sampling = False # flood counters see 1 packet in behavior_sample
+        if overload is not None:
+            lag = now - packetInfo.rawts
+            if lag > overload.lag_peak:
+                overload.lag_peak = lag
+            if overload.tier:
+                console = console and overload.console
+                sampling = overload.behavior_sample > 1
+
+        src_ip = packetInfo.src_ip
+        dst_ip = packetInfo.dst_ip
+        src_port = packetInfo.src_port
+        dst_port = packetInfo.dst_port
+        raw_timestamp = packetInfo.rawts
+        tcp_flags = packetInfo.tcp_flags
+        port = packetInfo.port
 
         #ignore some useless packets not important to us..
         if src_ip == "127.0.0.1" and dst_ip == "127.0.0.1":
             packet.accept()
             return
 
-        # safe, nfqueue always returns the IP layer not the ethernet..
-        ip_layer = IP(packet.get_payload())
-        is_icmp = ip_layer.haslayer(ICMP)
-        if is_icmp:
-            port = "ICMP"
-
-
-        # if src_ip in ip_blacklist:
-        #      logger.log_alert(
-        #         alert_type= "BLACKLIST",
-        #         src_ip= src_ip,
-        #         dst_ip= dst_ip,
-        #         src_port= src_port,
-        #         dst_port= dst_port,
-        #         message=f"Blocking packets coming from ip_blacklist on {chain_name} chain",
-        #         details={
-        #             "dst_ip": dst_ip,
-        #             "dst_port": packetInfo.get("dst_port"),
-        #             "chain": chain_name
-        #         })
-        #      packet.drop()
-        #      return
+        # compact summary into the trace ring (dumped on alert / SIGUSR1)
+        if tracer is not None:
+            tracer.record(chain_name, packetInfo)
+
+        # flow table: known flows skip what was already decided for them.
+        flow = None
+        if flow_cache is not None:
+            flow = flow_cache.lookup(packetInfo)
+            if flow.verdict == FLOW_DROP:
+                flow_cache.dropped += 1
+                metrics.dropped += 1
+                packet.drop()
+                return
+            if flow.verdict == FLOW_BENIGN and port == "TCP" and not (tcp_flags & 0x02):
+                # established connection, already inspected up to the inspection depth
+                # and a non-SYN segment means nothing for the behavior detectors either.
+                flow_cache.fast_path += 1
+                packet.accept()
+                return
+
+        # global top talkers, after the flow cache fast path: the sketch update cost more
+        # than the rest of that path. A flow stops counting once it's BENIGN (or DROP),
+        # a flood shows up through its new flows and their first inspect_bytes anyway
+        if sketches is not None:
+            start = perf_ns()
+            hits = sketches.observe(packetInfo)
+            metrics.sketches.observe(perf_ns() - start)
+            if hits:
+                for dimension, key, estimate in hits:
+                    heavy_hitter_alert(metrics, chain_name, sketches, packetInfo, dimension, key, estimate)
 
       #  print(" *** Data Captured from INPUT chain ***")
       # print()
@@ -59,7 +283,8 @@ def process_packet(packet, IsInput, port_scanner, sig_scanner):
         #print("the data are: ")
         #print(packetInfo)
         
-        logger.console_logger.info(f"[{chain_name}] Packet: {src_ip}:{src_port} -> {dst_ip}:{dst_port} ({port})")
+        if console:
+            logger.console_logger.info(f"[{chain_name}] Packet: {src_ip}:{src_port} -> {dst_ip}:{dst_port} ({port})")
         
         # let's now try to analyze it with the port scanner:
 
@@ -79,7 +304,12 @@ def process_packet(packet, IsInput, port_scanner, sig_scanner):
         # attack (again just for the moment, maybe modified latter)..
         if port == "TCP" and (tcp_flags & 0x02) and not (tcp_flags & 0x10):
 
-            analyze_result = port_scanner.analyze_tcp(src_ip, dst_ip, raw_timestamp, dst_port)
+            # flood counter weight, 0 = sampled out. Only drawn for the packets that reach a
+            # flood counter, the others would throw the 1 in N off (and make it predictable)
+            weight = overload.sample() if sampling else 1
+            start = perf_ns()
+            analyze_result = port_scanner.analyze_tcp(src_ip, dst_ip, raw_timestamp, dst_port, weight)
+            metrics.behavior.observe(perf_ns() - start)
 
             if analyze_result != 0:
                 if analyze_result == 1:
@@ -88,59 +318,74 @@ def process_packet(packet, IsInput, port_scanner, sig_scanner):
                     message = f"TCP Flood (DoS/DDoS) Detected on {chain_name} chain"
 
                 # ALERT
-                logger.log_alert(
-                    alert_type="BEHAVIOR",
+                raise_alert(
+                    metrics,
+                    alert_type=AlertKind.BEHAVIOR,
                     src_ip= src_ip,
                     dst_ip= dst_ip,
                     src_port= src_port,
                     dst_port= dst_port,
                     message= message,
+                    group_by_port=analyze_result != 1, # a port scan is one alert whatever the ports
                     details={
                         "dst_ip": dst_ip,
                         "dst_port": dst_port,
                         "chain": chain_name
                     }
                 )
+                if analyze_result == 1:
+                    # only the scan is keyed on the source, a flood is counted per victim and
+                    # whoever sent the packet over the threshold may be a spoofed or innocent client
+                    auto_block(src_ip, blocklist_config["auto_block_behavior_ttl"], message)
 
         elif port == "UDP":
+            weight = overload.sample() if sampling else 1
+            if weight:
+                start = perf_ns()
+                analyze_result = port_scanner.analyze_udp(dst_ip, raw_timestamp, dst_port, weight)
+                metrics.behavior.observe(perf_ns() - start)
+
+                if analyze_result:
+                    # ALERT:
+                    raise_alert(
+                        metrics,
+                        alert_type=AlertKind.BEHAVIOR,
+                        src_ip=src_ip,
+                        dst_ip= dst_ip,
+                        src_port= src_port,
+                        dst_port= dst_port,
+                        message=f"UDP Flood (DoS/DDoS) Detected on {chain_name} chain",
+                        details={
+                            "dst_ip": dst_ip,
+                            "dst_port": dst_port,
+                            "chain": chain_name
+                        }
+                    )
 
-            analyze_result = port_scanner.analyze_udp(dst_ip, raw_timestamp, dst_port)
-
-            if analyze_result:
-                # ALERT:
-                logger.log_alert(
-                    alert_type="BEHAVIOR",
-                    src_ip=src_ip,
-                    dst_ip= dst_ip,
-                    src_port= src_port,
-                    dst_port= dst_port,
-                    message=f"UDP Flood (DoS/DDoS) Detected on {chain_name} chain",
-                    details={
-                        "dst_ip": dst_ip,
-                        "dst_port": dst_port,
-                        "chain": chain_name
-                    }
-                )
-
-        elif is_icmp and ip_layer[ICMP].type == 8 : # echo req
-            analyze_result = port_scanner.analyze_icmp(dst_ip, raw_timestamp)
-            if analyze_result:
-                # ALERT: Port Scan Detected
-                logger.log_alert(
-                    alert_type="BEHAVIOR",
-                    src_ip=src_ip,
-                    dst_ip= dst_ip,
-                    src_port= src_port,
-                    dst_port= dst_port,
-                    message=f"ICMP Flood (DoS/DDoS) Detected on {chain_name} chain",
-                    details={
-                        "dst_ip": dst_ip,
-                        "dst_port": dst_port,
-                        "chain": chain_name
-                    }
-                )
+        elif port == "ICMP" and packetInfo.icmp_type == 8: # echo req
+            weight = overload.sample() if sampling else 1
+            if weight:
+                start = perf_ns()
+                analyze_result = port_scanner.analyze_icmp(dst_ip, raw_timestamp, weight)
+                metrics.behavior.observe(perf_ns() - start)
+                if analyze_result:
+                    # ALERT: Port Scan Detected
+                    raise_alert(
+                        metrics,
+                        alert_type=AlertKind.BEHAVIOR,
+                        src_ip=src_ip,
+                        dst_ip= dst_ip,
+                        src_port= src_port,
+                        dst_port= dst_port,
+                        message=f"ICMP Flood (DoS/DDoS) Detected on {chain_name} chain",
+                        details={
+                            "dst_ip": dst_ip,
+                            "dst_port": dst_port,
+                            "chain": chain_name
+                        }
+                    )
 
-        else : # some other packet, we may just log it to type of packets in normal conditions
+        elif console : # some other packet, we may just log it to type of packets in normal conditions
             logger.console_logger.info(f"Wierd type of packet: [{chain_name}] Packet: {src_ip}:{src_port} -> {dst_ip}:{dst_port} ({port})")
 
 
@@ -166,34 +411,77 @@ def process_packet(packet, IsInput, port_scanner, sig_scanner):
 
         # let's now test the signature based scanning..
               
-        if ip_layer.haslayer(Raw):
+        if reassembler is not None and port == "TCP" and (tcp_flags & 0x02) and not packetInfo.payload:
+            # connection setup: the stream starts right after this sequence number
+            reassembler.open(packetInfo)
+
+        scan = sig_scanner is not None and packetInfo.payload and (flow is None or flow.verdict == FLOW_INSPECT)
+        scan_limit = 0
+        if scan and overload is not None and overload.tier:
+            if overload.sheds_scan(flow):
+                scan = False # overloaded: trusted flow / no scanning at all
+                if reassembler is not None and port == "TCP":
+                    reassembler.skip(packetInfo) # no gap left behind, the stream starts over after this one
+            else:
+                scan_limit = overload.scan_limit(len(packetInfo.payload)) # large payload: only its start
+        if scan:
           # print("packet has a Raw layer..")
-            RawData = ip_layer[Raw].load
-            RuleName, RulePattern, Drop = sig_scanner.CheckPacketPayload(RawData)
-           #print(f"Rule Name: {RuleName}, Rule Pattern: {RulePattern}, Drop: {Drop}")
+            RawData = packetInfo.payload
+            start = perf_ns()
+            if reassembler is not None and port == "TCP":
+                # tail of the previous segments + this one, so split patterns are seen too
+                scan_data, min_end, seen = reassembler.feed(packetInfo, sig_scanner.stream_tail)
+            else:
+                scan_data, min_end, seen = RawData, 0, ()
+            if scan_limit:
+                # the whole segment goes into the stream, only the tail + its first bytes are scanned
+                scan_data = scan_data[:min_end + scan_limit]
+            # one pass over the payload, every rule that matched comes back.
+            matches = sig_scanner.match_payload(scan_data, min_end, seen)
+            metrics.signature.observe(perf_ns() - start)
+           #print(f"the matches are: {matches}")
             
-            if RuleName: # Match Found
+            for match in matches: # Match Found
                 # ALERT: Signature Match
-                logger.log_alert(
-                    alert_type="SIGNATURE",
+                raise_alert(
+                    metrics,
+                    alert_type=AlertKind.SIGNATURE,
                     src_ip=src_ip,
                     dst_ip= dst_ip,
                     src_port= src_port,
                     dst_port= dst_port,
-                    message=f"Signature Match: {RuleName}",
+                    message=f"Signature Match: {match.name}",
                     details={
-                        "pattern": str(RulePattern),
-                        "action": "DROP" if Drop else "ALERT",
+                        "pattern": str(match.pattern),
+                        "action": "DROP" if match.is_drop else "ALERT",
+                        "offset": match.offset - min_end, # negative: started in an earlier segment
                         "chain": chain_name
                     }
                 )
                 
-                # Check if we need to drop based on signature rule
-                # if Drop:
-                #     logger.console_logger.warning(f"[*] Dropping packet from {src_ip} due to signature match.")
-                #     ip_blacklist.append(src_ip)
-                #     packet.drop()
-                #     return 
+            # Check if we need to drop based on signature rule
+            if signature_config["enforce_drop"] and any(match.is_drop for match in matches):
+                logger.console_logger.warning(f"[*] Dropping packet from {src_ip} due to signature match.")
+                if flow is not None:
+                    # the rest of this flow is dropped straight from the flow table
+                    flow_cache.mark_drop(flow)
+                if flow is not None and flow.tcp_state == TCP_ESTABLISHED:
+                    # the handshake was verified (the SYN-ACK got acknowledged), so the
+                    # source address is not just spoofed. Never on INPUT, see flow_cache.py
+                    auto_block(src_ip, blocklist_config["auto_block_signature_ttl"],
+                               f"signature drop: {', '.join(match.name for match in matches if match.is_drop)}")
+                metrics.dropped += 1
+                packet.drop()
+                return
+
+            if reassembler is not None and port == "TCP":
+                reassembler.commit() # accepted: only now the segment is part of the stream
+
+            if flow is not None:
+                flow_cache.inspected(flow, len(RawData))
+                if flow.verdict == FLOW_BENIGN and reassembler is not None and port == "TCP":
+                    # fast path from now on, the stream isn't fed anymore
+                    reassembler.close(packetInfo)
 
        #else:
         #   print("the packet has no Raw Layer..***********")
@@ -202,48 +490,364 @@ def process_packet(packet, IsInput, port_scanner, sig_scanner):
         packet.accept()
 
     except Exception as e:
+        metrics.errors += 1
         logger.console_logger.error(f"[!] Error processing packet: {e}")
         packet.accept()
 
-def forward_agent(sig_object):
+def bind_queue(nfq, queue_num, chain_name, callback):
+    """nfq.bind() with the options of the nfqueue config section."""
+    from netfilterqueue import COPY_PACKET
+    copy_range = nfqueue_config["copy_range"]
+    if chain_name in nfqueue_config["headers_only"]:
+        copy_range = nfqueue_config["header_bytes"]
+    options = {"max_len": nfqueue_config["max_len"], "mode": COPY_PACKET, "range": copy_range}
+    if nfqueue_config["sock_rcvbuf"]:
+        options["sock_len"] = nfqueue_config["sock_rcvbuf"]
+    nfq.bind(queue_num, callback, **options)
+    queue_bound(queue_num)
+    logger.log_system_event(f"Queue {queue_num} ({chain_name}): max_len {options['max_len']}, "
+                            f"copy range {copy_range} bytes", "INFO")
+
+
+def run_queue(nfq, metrics):
+    """
+    Receive loop of an agent. With drain on, we sleep in poll() and then let
+    nfq.run(block=False) handle every packet already waiting on the socket
+    (recv with MSG_DONTWAIT until it's empty), so a flood costs one wakeup
+    per burst instead of one per packet, and metrics.wakeups tells how big
+    the bursts are. Verdicts are still sent one per packet, netfilterqueue
+    has no batch verdict call.
+    """
+    if not nfqueue_config["drain"]:
+        nfq.run()
+        return
+    import select
+    poller = select.poll()
+    poller.register(nfq.get_fd(), select.POLLIN)
+    while True:
+        if poller.poll(1000): # the GIL is released while we wait
+            metrics.wakeups += 1
+            nfq.run(block=False)
+
+
+def forward_agent(sig_object, queue_num=200):
+    from netfilterqueue import NetfilterQueue # imported here so process_packet can run without it (replay.py)
     nfq = NetfilterQueue()
     port_scanner_object_forward = PortScanningDetector(15, 10)
-    nfq.bind(200, lambda packet: process_packet(packet, False, port_scanner_object_forward, sig_object))
+    flow_cache_forward = new_flow_cache()
+    active_detectors[queue_num] = port_scanner_object_forward
+    active_flow_caches[queue_num] = flow_cache_forward
+    if "FORWARD" in nfqueue_config["headers_only"]:
+        sig_object = None # only the headers are copied, nothing to scan
+    reassembler_forward = new_reassembler() if sig_object is not None else None
+    active_reassemblers[queue_num] = reassembler_forward
+    if sig_object is not None:
+        active_sig_scanners[queue_num] = sig_object
+    sketches_forward = new_sketches()
+    active_sketches[queue_num] = sketches_forward
+    metrics_forward = registry.chain("FORWARD", queue_num)
+    overload_forward = new_overload_monitor(queue_num)
+    active_overload[queue_num] = overload_forward
+    bind_queue(nfq, queue_num, "FORWARD",
+               lambda packet: process_packet(packet, False, port_scanner_object_forward, sig_object,
+                                             flow_cache_forward, metrics_forward, reassembler_forward,
+                                             sketches_forward, overload_forward))
 
     try:
-        nfq.run()
+        run_queue(nfq, metrics_forward)
 
     except Exception as e:
-        logger.console_logger.critical(f"[!] Forward agent crashed: {e}")
+        logger.console_logger.critical(f"[!] Forward agent (queue {queue_num}) crashed: {e}")
 
 
-def input_agent(sig_object):
+def input_agent(sig_object, queue_num=100):
+    from netfilterqueue import NetfilterQueue
     nfq = NetfilterQueue()
     port_scanner_object_input = PortScanningDetector(15, 10)
+    if input_shards > 1:
+        port_scanner_object_input.share_flood_thresholds(input_shards)
+    flow_cache_input = new_flow_cache()
+    active_detectors[queue_num] = port_scanner_object_input
+    active_flow_caches[queue_num] = flow_cache_input
+    if "INPUT" in nfqueue_config["headers_only"]:
+        sig_object = None
+    reassembler_input = new_reassembler() if sig_object is not None else None
+    active_reassemblers[queue_num] = reassembler_input
+    if sig_object is not None:
+        active_sig_scanners[queue_num] = sig_object
+    sketches_input = new_sketches(input_shards)
+    active_sketches[queue_num] = sketches_input
+    metrics_input = registry.chain("INPUT", queue_num)
+    overload_input = new_overload_monitor(queue_num)
+    active_overload[queue_num] = overload_input
     #sig_scanner_object_input = SignatureScanning()
-    nfq.bind(100, lambda packet: process_packet(packet, True, port_scanner_object_input, sig_object))
+    bind_queue(nfq, queue_num, "INPUT",
+               lambda packet: process_packet(packet, True, port_scanner_object_input, sig_object,
+                                             flow_cache_input, metrics_input, reassembler_input,
+                                             sketches_input, overload_input))
         
     try:
-        nfq.run()
+        run_queue(nfq, metrics_input)
     
     except Exception as e:
-        logger.console_logger.critical(f"[!] Input agent crashed: {e}")
+        logger.console_logger.critical(f"[!] Input agent (queue {queue_num}) crashed: {e}")
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    # SIGTERM (systemd stop, supervisor) takes the same clean path as Ctrl+C
+    raise KeyboardInterrupt
+
+
+def collect_gauges():
+    """Detector / flow cache / logger numbers for the metrics endpoint."""
+    samples = []
+    for queue_num, detector in list(active_detectors.items()):
+        for table_name, table_stats in detector.state_stats().items():
+            labels = {"queue": queue_num, "table": table_name}
+            samples.append(("loki_detector_keys", labels, table_stats["live_keys"]))
+            samples.append(("loki_detector_bytes", labels, table_stats["approx_bytes"]))
+            samples.append(("loki_detector_evictions_total", dict(labels, reason="ttl"), table_stats["evicted_ttl"]))
+            samples.append(("loki_detector_evictions_total", dict(labels, reason="cap"), table_stats["evicted_cap"]))
+    for queue_num, flow_cache in list(active_flow_caches.items()):
+        if flow_cache is not None:
+            flow_stats = flow_cache.stats()
+            samples.append(("loki_flow_cache_flows", {"queue": queue_num}, flow_stats["flows"]))
+            samples.append(("loki_flow_cache_fast_path_total", {"queue": queue_num}, flow_stats["fast_path"]))
+    for queue_num, reassembler in list(active_reassemblers.items()):
+        if reassembler is not None:
+            stream_stats = reassembler.stats()
+            samples.append(("loki_stream_reassembly_streams", {"queue": queue_num}, stream_stats["streams"]))
+            samples.append(("loki_stream_reassembly_bytes", {"queue": queue_num}, stream_stats["bytes"]))
+            samples.append(("loki_stream_reassembly_out_of_order_total", {"queue": queue_num},
+                            stream_stats["out_of_order"]))
+    for queue_num, sketches in list(active_sketches.items()):
+        if sketches is not None:
+            for table in sketches.tables():
+                # the last complete window, the current one is still filling up
+                samples.append(("loki_heavy_hitter_window_packets", {"queue": queue_num, "dimension": table.name},
+                                table.last_total))
+                for rank, (key, count, error) in enumerate(table.last_top[:10], 1):
+                    labels = {"queue": queue_num, "dimension": table.name, "rank": rank, "key": key}
+                    samples.append(("loki_heavy_hitter_packets", labels, count))
+    # both agents share one SignatureScanning in the single process mode, count it once
+    for sig_object in {id(obj): obj for obj in list(active_sig_scanners.values())}.values():
+        for rule in sig_object.rule_stats():
+            labels = {"rule": rule["name"]}
+            samples.append(("loki_signature_rule_cpu_seconds_total", labels, round(rule["cpu_seconds"], 6)))
+            samples.append(("loki_signature_rule_evaluations_total", labels, rule["evaluations"]))
+            samples.append(("loki_signature_rule_matches_total", labels, rule["matches"]))
+    if blocklist is not None:
+        blocklist_stats = blocklist.stats()
+        samples.append(("loki_blocklist_entries", {"kind": "address"}, blocklist_stats["hosts"]))
+        samples.append(("loki_blocklist_entries", {"kind": "network"}, blocklist_stats["networks"]))
+        samples.append(("loki_blocklist_hits_total", {}, blocklist_stats["hits"]))
+    if enforcer is not None:
+        enforcement_stats = enforcer.stats()
+        samples.append(("loki_enforcement_entries", {"backend": enforcement_stats["backend"]},
+                        enforcement_stats["enforced"]))
+        samples.append(("loki_enforcement_pending", {}, enforcement_stats["pending"]))
+        samples.append(("loki_enforcement_pushed_total", {}, enforcement_stats["pushed"]))
+        samples.append(("loki_enforcement_errors_total", {}, enforcement_stats["errors"]))
+    stats = logger.get_stats()
+    for queue_num, monitor in list(active_overload.items()):
+        if monitor is not None:
+            overload_stats = monitor.stats()
+            labels = {"queue": queue_num}
+            samples.append(("loki_overload_tier", labels, overload_stats["tier"]))
+            samples.append(("loki_overload_transitions_total", labels, overload_stats["transitions"]))
+            samples.append(("loki_overload_lag_seconds", labels, round(overload_stats["lag"], 6)))
+            samples.append(("loki_overload_shed_total", dict(labels, what="signature_scan"),
+                            overload_stats["shed_scans"]))
+            samples.append(("loki_overload_shed_total", dict(labels, what="signature_scan_truncated"),
+                            overload_stats["truncated_scans"]))
+            samples.append(("loki_overload_shed_total", dict(labels, what="behavior_sampled_out"),
+                            overload_stats["sampled_out"]))
+            samples.append(("loki_queue_depth", labels, overload_stats["depth"]))
+            samples.append(("loki_queue_kernel_drops_total", labels, overload_stats["kernel_drops"]))
+    samples.append(("loki_alerts_active", {}, stats["active_alerts"]))
+    samples.append(("loki_alerts_raised_total", {}, stats["alerts_raised"]))
+    samples.append(("loki_alerts_suppressed_total", {}, stats["suppressed_alerts"]))
+    samples.append(("loki_alert_writer_backlog", {}, stats["writer_backlog"]))
+    samples.append(("loki_alert_writer_dropped_total", {}, stats["writer_dropped"]))
+    samples.append(("loki_alert_log_rotations_total", {}, stats["log_rotations"]))
+    return samples
+
+
+registry.add_collector(collect_gauges)
+
+
+def install_trace_signal():
+    # kill -USR1 <pid> dumps the packet trace ring
+    if tracer is not None:
+        signal.signal(signal.SIGUSR1, tracer.handle_signal)
+
+
+# set by SIGHUP, the maintenance loop does the actual reload (never inside the handler)
+reload_requested = threading.Event()
+
+
+def install_reload_signal():
+    # kill -HUP <pid> reloads the signature rules
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+
+
+def reload_signatures(sig_object, reason):
+    ok, message = sig_object.reload()
+    logger.log_system_event(f"{message} ({reason})", "INFO" if ok else "ERROR")
+
+
+def maintenance_loop(sig_object=None):
+    """Alert lifecycle management and rule reloads, runs until Ctrl+C / SIGTERM"""
+    last_check_time = time.time()
+    check_interval = 2  # Check every 2 seconds
+    last_save_time = last_check_time
+    summary_exporter = new_summary_exporter()
+    console_quiet = False
+
+    while True:
+        time.sleep(1)
+        if reload_requested.is_set() and sig_object is not None:
+            reload_requested.clear()
+            reload_signatures(sig_object, "SIGHUP")
+        if enforcer is not None:
+            enforcer.flush() # one kernel set update per second at most
+        monitors = [monitor for monitor in list(active_overload.values()) if monitor is not None]
+        if monitors:
+            queue_stats = read_queue_stats()
+            for monitor in monitors:
+                monitor.evaluate(queue_stats)
+            # the console is per process, quiet while any of our queues is shedding
+            quiet = any(monitor.tier >= DEGRADED for monitor in monitors)
+            if quiet != console_quiet:
+                logger.set_console_quiet(quiet)
+                console_quiet = quiet
+        
+        # Check for ended attacks
+        current_time = time.time()
+        if current_time - last_check_time >= check_interval:
+            ended_count = logger.check_ended_alerts()
+            if ended_count > 0:
+                stats = logger.get_stats()
+                logger.console_logger.debug(
+                    f"Closed {ended_count} attack(s) | "
+                    f"Active: {stats['active_alerts']} | "
+                    f"Suppressed: {stats['suppressed_alerts']}"
+                )
+            if sig_object is not None and signature_config["watch_file"] and sig_object.file_changed():
+                reload_signatures(sig_object, "file changed")
+            if blocklist is not None:
+                blocklist.sweep()
+                if current_time - last_save_time >= blocklist_config["save_interval"]:
+                    blocklist.save()
+                    last_save_time = current_time
+            if summary_exporter is not None:
+                export_summaries(summary_exporter)
+            last_check_time = current_time
+
+
+def shutdown(label="LOKI IDS", exporter=None):
+    # Final cleanup
+    if exporter is not None:
+        exporter.stop() # last stats file with the final counters
+    logger.check_ended_alerts()
+    stats = logger.get_stats()
+    logger.log_system_event(
+        f"Session stats - Active alerts: {stats['active_alerts']}, "
+        f"Suppressed duplicates: {stats['suppressed_alerts']}, "
+        f"Efficiency: {stats['suppression_rate']}",
+        "INFO"
+    )
+    for queue_num, detector in active_detectors.items():
+        for table_name, table_stats in detector.state_stats().items():
+            logger.log_system_event(
+                f"Detector state queue {queue_num} {table_name}: {table_stats['live_keys']} keys, "
+                f"{table_stats['evicted_ttl']} idle evictions, {table_stats['evicted_cap']} cap evictions, "
+                f"~{table_stats['approx_bytes'] // 1024} KiB",
+                "INFO"
+            )
+    for queue_num, flow_cache in active_flow_caches.items():
+        if flow_cache is not None:
+            flow_stats = flow_cache.stats()
+            logger.log_system_event(
+                f"Flow cache queue {queue_num}: {flow_stats['flows']} flows, hit rate {flow_stats['hit_rate']:.1%}, "
+                f"{flow_stats['fast_path']} fast-path packets, {flow_stats['dropped']} dropped, "
+                f"{flow_stats['evicted_ttl'] + flow_stats['evicted_cap']} evictions",
+                "INFO"
+            )
+    
+    for queue_num, reassembler in active_reassemblers.items():
+        if reassembler is not None:
+            stream_stats = reassembler.stats()
+            logger.log_system_event(
+                f"Stream reassembly queue {queue_num}: {stream_stats['streams']} streams, "
+                f"{stream_stats['bytes'] // 1024} KiB, {stream_stats['out_of_order']} out of order segments, "
+                f"{stream_stats['gaps_given_up']} gaps given up, "
+                f"{stream_stats['evicted_cap'] + stream_stats['evicted_memory']} evictions",
+                "INFO"
+            )
+    for queue_num, sketches in active_sketches.items():
+        if sketches is not None:
+            for table in sketches.tables():
+                top = ", ".join(f"{key} ({count})" for key, count, _error in table.top_keys.top(5))
+                if top:
+                    logger.log_system_event(f"Top {table.name} queue {queue_num} (current window): {top}", "INFO")
+    for queue_num, monitor in active_overload.items():
+        if monitor is not None and monitor.transitions:
+            overload_stats = monitor.stats()
+            logger.log_system_event(
+                f"Overload queue {queue_num}: {overload_stats['transitions']} tier changes, "
+                f"ended {TIER_NAMES[overload_stats['tier']]}, {overload_stats['shed_scans']} scans skipped, "
+                f"{overload_stats['truncated_scans']} truncated, "
+                f"{overload_stats['sampled_out']} packets sampled out of the flood counters",
+                "INFO"
+            )
+    for sig_object in {id(obj): obj for obj in active_sig_scanners.values()}.values():
+        for rule in sig_object.rule_stats()[:5]:
+            if rule["evaluations"]:
+                logger.log_system_event(
+                    f"Signature {rule['name']!r}: regex ran {rule['evaluations']} times, "
+                    f"{rule['cpu_seconds'] * 1000:.1f} ms CPU, {rule['matches']} matches",
+                    "INFO"
+                )
+    if blocklist is not None:
+        blocklist_stats = blocklist.stats()
+        logger.log_system_event(
+            f"Blocklist: {blocklist_stats['hosts']} addresses, {blocklist_stats['networks']} networks, "
+            f"{blocklist_stats['hits']} packets dropped, {blocklist_stats['refused']} blocks refused",
+            "INFO"
+        )
+        blocklist.save()
+    if enforcer is not None:
+        enforcer.flush()
+        enforcement_stats = enforcer.stats()
+        logger.log_system_event(
+            f"Kernel enforcement ({enforcement_stats['backend']}): {enforcement_stats['pushed']} offenders pushed "
+            f"in {enforcement_stats['batches']} updates, {enforcement_stats['enforced']} still in the set, "
+            f"{enforcement_stats['errors']} errors",
+            "INFO"
+        )
+        enforcer.close()
 
+    logger.log_system_event(f"========== Stopping {label} ==========", "INFO")
+    logger.close() # flush the alert writer before we exit
+
+
+def run_single():
+    """The classic mode: one thread per chain (queue 100 + 200) in this process"""
+    exporter = start_exporter()
+    start_enforcement()
 
-if __name__ == "__main__":
-    logger.log_system_event("========== Starting LOKI IDS ==========", "INFO")
-    
     # let's now create the 2 threads..
     try:
-        sig_object = SignatureScanning() # Load rules
+        sig_object = new_sig_scanner() # Load rules
         logger.log_system_event("Signature rules loaded successfully", "INFO")
     except Exception as e:
         logger.log_system_event(f"Failed to load signatures: {e}", "ERROR")
         sig_object = None # Handle gracefully or exit
 
     if sig_object:
-        input_thread = threading.Thread(target=input_agent, args=(sig_object,), daemon=True)
-        forward_thread = threading.Thread(target=forward_agent, args=(sig_object,), daemon=True)
+        input_thread = threading.Thread(target=input_agent, args=(sig_object, sharding_config["input_queue"]), daemon=True)
+        forward_thread = threading.Thread(target=forward_agent, args=(sig_object, sharding_config["forward_queue"]), daemon=True)
 
         # now let's start it:::
         input_thread.start()
@@ -251,40 +855,131 @@ if __name__ == "__main__":
 
         logger.log_system_event("Detection threads started successfully", "INFO")
 
-    # Alert lifecycle management
-    last_check_time = time.time()
-    check_interval = 2  # Check every 2 seconds
-    
     # let's make sure the main thread exit peacefully::
+    try:
+        maintenance_loop(sig_object)
+    except KeyboardInterrupt:
+        print()
+        logger.log_system_event("Received shutdown signal (Ctrl+C)", "WARNING")
+
+    shutdown(exporter=exporter)
+
+
+def shard_worker(queue_num, IsInput, worker_index=0, shards=1):
+    """
+    Worker process of the sharded mode, owns exactly one queue.
+    Everything (detectors, signatures, alert aggregation) is private to the
+    process, so there is no GIL or lock shared with the other shards.
+    Its metrics are served on metrics.port + 1 + worker_index.
+    """
+    # the supervisor decides when we stop, Ctrl+C on the terminal reaches us too.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    install_trace_signal()
+    install_reload_signal()
+
+    global input_shards
+    if IsInput:
+        input_shards = shards
+    chain_name = "INPUT" if IsInput else "FORWARD"
+    label = f"LOKI worker {chain_name}/{queue_num}"
+    # one set of log segments per worker, they rotate on their own
+    logger.set_log_file(f"loki_alerts_q{queue_num}.jsonl",
+                        f"loki_system_q{queue_num}.jsonl" if logger.system_filepath else None)
+    logger.log_system_event(f"========== Starting {label} (pid {os.getpid()}) ==========", "INFO")
+    exporter = start_exporter(port_offset=1 + worker_index, stats_name=f"loki_stats_q{queue_num}.json")
+    if blocklist is not None and blocklist.persist_path:
+        # the shared blocklist.json was loaded on import, the blocks this worker adds go to its own file
+        blocklist.persist_path = os.path.join(logger.log_dir, f"blocklist_q{queue_num}.json")
+        blocklist.load()
+    start_enforcement()
+
+    try:
+        sig_object = new_sig_scanner()
+    except Exception as e:
+        logger.log_system_event(f"[{label}] Failed to load signatures: {e}", "ERROR")
+        if exporter is not None:
+            exporter.stop()
+        return
+
+    agent = input_agent if IsInput else forward_agent
+    threading.Thread(target=agent, args=(sig_object, queue_num), daemon=True).start()
+
+    try:
+        maintenance_loop(sig_object)
+    except KeyboardInterrupt:
+        pass
+
+    shutdown(label, exporter)
+
+
+def run_sharded(shards):
+    """
+    Supervisor of the sharded mode: one worker process per queue.
+    iptables_up.sh (LOKI_SHARDS=N) spreads each chain over N queues. FORWARD is
+    split by destination, every scan and flood window stays in one shard. INPUT
+    is split by source (the destination is always the Pi): the scan windows stay
+    whole, but a flood on the Pi is spread over the N shards, so the INPUT
+    workers fire on 1/N of the flood thresholds (see share_flood_thresholds).
+    """
+    import multiprocessing # only the supervisor needs it
+    ctx = multiprocessing.get_context("spawn") # fresh interpreters, no threads inherited through fork
+    specs = [(sharding_config["input_queue"] + i, True, i) for i in range(shards)]
+    specs += [(sharding_config["forward_queue"] + i, False, shards + i) for i in range(shards)]
+
+    def start_worker(queue_num, IsInput, worker_index):
+        proc = ctx.Process(target=shard_worker, args=(queue_num, IsInput, worker_index, shards),
+                           name=f"loki-q{queue_num}", daemon=False)
+        proc.start()
+        return proc
+
+    workers = {spec: start_worker(*spec) for spec in specs}
+
+    def forward_signal(signum, frame):
+        # SIGUSR1 / SIGHUP on the supervisor = every worker dumps its trace / reloads its rules
+        for proc in workers.values():
+            if proc.is_alive():
+                os.kill(proc.pid, signum)
+    signal.signal(signal.SIGUSR1, forward_signal)
+    signal.signal(signal.SIGHUP, forward_signal)
+    logger.log_system_event(f"Started {len(workers)} worker processes ({shards} shard(s) per chain)", "INFO")
+
     try:
         while True:
             time.sleep(1)
-            
-            # Check for ended attacks
-            current_time = time.time()
-            if current_time - last_check_time >= check_interval:
-                ended_count = logger.check_ended_alerts()
-                if ended_count > 0:
-                    stats = logger.get_stats()
-                    logger.console_logger.debug(
-                        f"Closed {ended_count} attack(s) | "
-                        f"Active: {stats['active_alerts']} | "
-                        f"Suppressed: {stats['suppressed_alerts']}"
-                    )
-                last_check_time = current_time
-                
+            for spec, proc in list(workers.items()):
+                if not proc.is_alive():
+                    logger.log_system_event(
+                        f"Worker for queue {spec[0]} exited (code {proc.exitcode}), restarting it", "WARNING")
+                    workers[spec] = start_worker(*spec)
+                    
     except KeyboardInterrupt:
         print()
-        logger.log_system_event("Received shutdown signal (Ctrl+C)", "WARNING")
-        
-        # Final cleanup
-        logger.check_ended_alerts()
-        stats = logger.get_stats()
-        logger.log_system_event(
-            f"Session stats - Active alerts: {stats['active_alerts']}, "
-            f"Suppressed duplicates: {stats['suppressed_alerts']}, "
-            f"Efficiency: {stats['suppression_rate']}",
-            "INFO"
-        )
-        
-        logger.log_system_event("========== Stopping LOKI IDS ==========", "INFO")
\ No newline at end of file
+        logger.log_system_event("Received shutdown signal, stopping the workers", "WARNING")
+
+    for proc in workers.values():
+        if proc.is_alive():
+            proc.terminate()
+    for proc in workers.values():
+        proc.join(10)
+
+    logger.log_system_event("========== Stopping LOKI IDS ==========", "INFO")
+    logger.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loki IDS - NFQUEUE inspection engine")
+    parser.add_argument("--shards", type=int, default=sharding_config["shards"],
+                        help="queues per chain, each one served by its own process (must match LOKI_SHARDS of iptables_up.sh)")
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    registry.mark_startup("imports", PROCESS_START)
+    logger.log_system_event("========== Starting LOKI IDS ==========", "INFO")
+
+    if args.shards > 1:
+        run_sharded(args.shards)
+    else:
+        install_trace_signal()
+        install_reload_signal()
+        run_single()
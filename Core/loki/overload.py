@@ -0,0 +1,196 @@
+import time
+
+from logger import logger
+
+# Overload detection and load shedding.
+#
+# When process_packet falls behind, the kernel queue fills up and with
+# --queue-bypass the packets past max_len go through uninspected, silently.
+# Every queue gets an OverloadMonitor that measures how far behind we are:
+#   - lag: now - the packet's kernel timestamp, the peak since the last check
+#     (0 when the kernel doesn't timestamp the packets, then only the depth counts)
+#   - depth: packets waiting in the queue, from /proc/net/netfilter/nfnetlink_queue,
+#     as a share of nfqueue.max_len, and the packets the kernel dropped / let through
+#     because the queue was full
+# and switches the pipeline between tiers, each one sheds more work:
+#   0 normal      everything
+#   1 degraded    no console output (files still get everything), flows that were
+#                 clean for trusted_bytes skip the signature scan
+#   2 overloaded  + only the first large_payload bytes of a payload are scanned
+#                 (not skipped: padding a payload mustn't hide it), the flood
+#                 counters see 1 packet in behavior_sample (weighted, the port scan
+#                 check still sees every SYN)
+#   3 critical    + no signature scanning at all, 1 in critical_behavior_sample
+# A tier is entered as soon as one of its thresholds is crossed, and left (one
+# tier at a time) only after everything stayed under hysteresis x its
+# thresholds for `hold` seconds, so a bursty load doesn't flap between tiers.
+
+NORMAL, DEGRADED, OVERLOADED, CRITICAL = 0, 1, 2, 3
+TIER_NAMES = ("normal", "degraded", "overloaded", "critical")
+
+PROC_QUEUES = "/proc/net/netfilter/nfnetlink_queue"
+
+
+def read_queue_stats(path=PROC_QUEUES):
+    """
+    queue number -> (packets waiting, dropped by the kernel, dropped on the netlink socket)
+    Empty when the file isn't there (not Linux, module not loaded, replay).
+    """
+    queues = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                # queue_number peer_portid queue_total copy_mode copy_range queue_dropped user_dropped id_sequence 1
+                if len(fields) >= 7:
+                    queues[int(fields[0])] = (int(fields[2]), int(fields[5]), int(fields[6]))
+    except (OSError, ValueError):
+        pass
+    return queues
+
+
+class OverloadMonitor:
+    """
+    Tier of one queue. process_packet reads the shedding switches below and
+    bumps lag_peak / the shed counters, evaluate() runs in the maintenance loop.
+    """
+
+    def __init__(self, queue_num, max_len, overload_config):
+        self.queue_num = queue_num
+        self.max_len = max(1, max_len)
+        self.lag_thresholds = overload_config["lag"]
+        self.depth_thresholds = overload_config["depth"]
+        self.hysteresis = overload_config["hysteresis"]
+        self.hold = overload_config["hold"]
+        self.config = overload_config
+
+        self.tier = NORMAL
+        self._calm_since = None
+        self._last_drops = None
+
+        # shedding switches, only written by evaluate()
+        self.console = True
+        self.trusted_bytes = 0    # flows clean for this many bytes aren't scanned, 0 = off
+        self.max_scan_bytes = 0   # only this many bytes of a payload are scanned, 0 = no limit
+        self.behavior_sample = 1  # flood counters see 1 packet in N
+        self.scan = True
+        self._sample_tick = 0
+
+        # measurements
+        self.lag_peak = 0.0       # written by the packet thread, reset by evaluate()
+        self.lag = 0.0            # peak of the last interval
+        self.depth = 0
+        self.kernel_drops = 0
+
+        # Statistics
+        self.transitions = 0
+        self.shed_scans = 0       # payloads not scanned because of the tier
+        self.truncated_scans = 0  # payloads only scanned up to max_scan_bytes
+        self.sampled_out = 0      # packets the flood counters didn't see
+
+    def sample(self):
+        """Flood counter weight of this packet: 1 normally, 0 (skip) or N (counts for N) when sampling."""
+        n = self.behavior_sample
+        if n == 1:
+            return 1
+        self._sample_tick += 1
+        if self._sample_tick >= n:
+            self._sample_tick = 0
+            return n
+        self.sampled_out += 1
+        return 0
+
+    def sheds_scan(self, flow):
+        """True if this payload skips the signature scan at the current tier (only called when tier > 0)."""
+        if not self.scan or (self.trusted_bytes and flow is not None and flow.inspected_bytes >= self.trusted_bytes):
+            self.shed_scans += 1
+            return True
+        return False
+
+    def scan_limit(self, payload_len):
+        """Bytes of this payload to scan at the current tier, 0 = all of it (only called when tier > 0)."""
+        if self.max_scan_bytes and payload_len > self.max_scan_bytes:
+            self.truncated_scans += 1
+            return self.max_scan_bytes
+        return 0
+
+    def _level(self, value, thresholds, scale=1.0):
+        level = NORMAL
+        for tier, threshold in enumerate(thresholds, 1):
+            if threshold and value >= threshold * scale:
+                level = tier
+        return level
+
+    def evaluate(self, queue_stats, now=None):
+        """Take the measurements of the last interval and move between tiers. Returns the tier."""
+        now = time.time() if now is None else now
+        self.lag, self.lag_peak = self.lag_peak, 0.0
+        drops = 0
+        stats = queue_stats.get(self.queue_num)
+        if stats is not None:
+            self.depth = stats[0]
+            total_drops = stats[1] + stats[2]
+            if self._last_drops is not None:
+                drops = max(0, total_drops - self._last_drops)
+            self._last_drops = total_drops
+            self.kernel_drops = total_drops
+        fill = self.depth / self.max_len
+
+        level = max(self._level(self.lag, self.lag_thresholds), self._level(fill, self.depth_thresholds))
+        if drops:
+            level = max(level, OVERLOADED) # the queue overflowed, packets went by uninspected
+
+        if level > self.tier:
+            self._calm_since = None
+            reason = f"lag {self.lag * 1000:.0f} ms, queue {self.depth}/{self.max_len}"
+            if drops:
+                reason += f", {drops} packets dropped/bypassed by the kernel"
+            self._switch(level, reason)
+        elif level < self.tier and self._calm(fill, drops):
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.hold:
+                self._calm_since = now # the next step down waits another hold
+                self._switch(self.tier - 1, f"calm for {self.hold}s, lag {self.lag * 1000:.0f} ms, "
+                                            f"queue {self.depth}/{self.max_len}")
+        else:
+            self._calm_since = None
+        return self.tier
+
+    def _calm(self, fill, drops):
+        # clearly under the current tier's thresholds, not just under them
+        scale = self.hysteresis
+        return (not drops and self._level(self.lag, self.lag_thresholds, scale) < self.tier
+                and self._level(fill, self.depth_thresholds, scale) < self.tier)
+
+    def _switch(self, tier, reason):
+        previous = self.tier
+        self.tier = tier
+        self.transitions += 1
+        self.console = tier < DEGRADED
+        self.trusted_bytes = self.config["trusted_bytes"] if tier >= DEGRADED else 0
+        self.max_scan_bytes = self.config["large_payload"] if tier >= OVERLOADED else 0
+        if tier >= CRITICAL:
+            self.behavior_sample = max(1, self.config["critical_behavior_sample"])
+        elif tier >= OVERLOADED:
+            self.behavior_sample = max(1, self.config["behavior_sample"])
+        else:
+            self.behavior_sample = 1
+        self.scan = tier < CRITICAL
+        self._sample_tick = 0
+        logger.log_system_event(
+            f"Queue {self.queue_num} overload tier {TIER_NAMES[previous]} -> {TIER_NAMES[tier]} ({reason})",
+            "WARNING" if tier > previous else "INFO")
+
+    def stats(self):
+        return {
+            "tier": self.tier,
+            "tier_name": TIER_NAMES[self.tier],
+            "lag": self.lag,
+            "depth": self.depth,
+            "kernel_drops": self.kernel_drops,
+            "transitions": self.transitions,
+            "shed_scans": self.shed_scans,
+            "truncated_scans": self.truncated_scans,
+            "sampled_out": self.sampled_out,
+        }
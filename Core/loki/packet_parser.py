@@ -1,52 +1,167 @@
-from scapy.all import TCP, UDP, IP
-import datetime
+import os
+import socket
+import struct
 import time
 
-def scan_packet(packet):
+# Single-pass IPv4 header decoder.
+# NFQUEUE always hands us the packet starting at the IP header, so instead of
+# building a full Scapy dissection (twice..) we read the few fields we need
+# straight out of the buffer with precompiled struct offsets.
+
+PROTO_ICMP = 1
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+PROTO_NAMES = {PROTO_TCP: "TCP", PROTO_UDP: "UDP", PROTO_ICMP: "ICMP"}
+
+# version/ihl, tos, total length, id, flags/frag offset, ttl, proto, checksum, src, dst
+_IPV4_HEADER = struct.Struct("!BBHHHBBH4s4s")
+# src port, dst port, seq, ack, data offset, flags
+_TCP_HEADER = struct.Struct("!HHIIBB")
+# src port, dst port
+_UDP_HEADER = struct.Struct("!HH")
+
+_inet_ntoa = socket.inet_ntoa
+
+# set LOKI_SCAPY_PARSER=1 to dissect every packet with Scapy instead (debug only, slow).
+USE_SCAPY_PARSER = os.environ.get("LOKI_SCAPY_PARSER") == "1"
+
+
+class PacketInfo:
+    """Decoded header fields of one packet, payload kept as a memoryview slice."""
+
+    __slots__ = ("src_ip", "dst_ip", "src_port", "dst_port", "port", "proto",
+                 "tcp_flags", "icmp_type", "rawts", "packetID", "payloadLen", "payload", "seq", "ack")
+
+    def __init__(self, src_ip, dst_ip, src_port, dst_port, port, proto,
+                 tcp_flags, icmp_type, rawts, packetID, payloadLen, payload, seq=0, ack=0):
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.port = port            # "TCP", "UDP", "ICMP" or "" (same labels the detectors use)
+        self.proto = proto          # raw IP protocol number
+        self.tcp_flags = tcp_flags
+        self.icmp_type = icmp_type  # -1 when the packet is not ICMP
+        self.rawts = rawts
+        self.packetID = packetID
+        self.payloadLen = payloadLen
+        self.payload = payload      # application payload (memoryview, may be empty)
+        self.seq = seq              # TCP sequence number (0 when not TCP)
+        self.ack = ack              # TCP acknowledgment number (0 when not TCP)
+
+    def __repr__(self):
+        return (f"PacketInfo({self.src_ip}:{self.src_port} -> {self.dst_ip}:{self.dst_port} "
+                f"{self.port or self.proto}, flags={self.tcp_flags:#x}, payload={len(self.payload)}B)")
+
+
+def decode_packet(buf, timestamp=0.0, packet_id=0):
+    """
+    Decode an IPv4 packet (starting at the IP header) in a single pass.
+
+    Returns a PacketInfo, or None if the buffer is not a valid IPv4 packet.
+    The payload is a zero-copy memoryview slice of `buf`.
+    """
+    view = memoryview(buf)
+    buf_len = len(view)
+    if buf_len < 20:
+        return None
+
+    (ver_ihl, _tos, total_len, _ident, frag, _ttl, proto, _csum,
+     src, dst) = _IPV4_HEADER.unpack_from(view)
+    if ver_ihl >> 4 != 4:
+        return None
+    ihl = (ver_ihl & 0x0F) << 2
+    if ihl < 20 or ihl > buf_len:
+        return None
+
+    # the copy range may have truncated the packet, never read past what we got.
+    end = total_len if ihl <= total_len <= buf_len else buf_len
+
+    src_port = 0
+    dst_port = 0 # incase the packet has no TCP or UDP layer.
+    port = ""
+    tcp_flags = 0
+    icmp_type = -1
+    seq = 0
+    ack = 0
+    offset = ihl
+
+    # only the first fragment carries the transport header.
+    if not frag & 0x1FFF:
+        if proto == PROTO_TCP and end - ihl >= 20:
+            src_port, dst_port, seq, ack, data_off, flags = _TCP_HEADER.unpack_from(view, ihl)
+            tcp_flags = ((data_off & 0x01) << 8) | flags
+            offset = ihl + max(20, (data_off >> 4) << 2)
+            port = "TCP"
+        elif proto == PROTO_UDP and end - ihl >= 8:
+            src_port, dst_port = _UDP_HEADER.unpack_from(view, ihl)
+            offset = ihl + 8
+            port = "UDP"
+        elif proto == PROTO_ICMP and end - ihl >= 8:
+            icmp_type = view[ihl]
+            offset = ihl + 8
+            port = "ICMP"
+
+    if offset > end:
+        offset = end
+
+    return PacketInfo(_inet_ntoa(src), _inet_ntoa(dst), src_port, dst_port, port, proto,
+                      tcp_flags, icmp_type, timestamp, packet_id, buf_len, view[offset:end], seq, ack)
+
+
+def scan_packet(packet, buf=None):
+    """
+    Decode an NFQUEUE packet object into a PacketInfo (None if it's not IPv4).
+    `buf` is the packet's get_payload() when the caller already fetched it.
+    """
+    if USE_SCAPY_PARSER:
+        return scapy_scan_packet(packet)
+
+    timestamp = packet.get_timestamp()
+    if not timestamp:
+        timestamp = time.time()
+    if buf is None:
+        buf = packet.get_payload()
+    return decode_packet(buf, timestamp, packet.id)
+
+
+def scapy_scan_packet(packet):
+    """
+    Debug fallback: same result as scan_packet but dissected with Scapy.
+    Scapy is imported lazily so the normal path never pays for it.
+    """
+    from scapy.all import IP, TCP, UDP, ICMP, Raw
+
     pkt = IP(packet.get_payload()) # get the IP layerrr.
-    src_ip = pkt[IP].src
-    dst_ip = pkt[IP].dst
     timestamp = packet.get_timestamp()
     if not timestamp:
         timestamp = time.time()
 
-    packetID = packet.id
-    payloadLen = packet.get_payload_len()
+    src_port = 0
     dst_port = 0
-    src_port = 0 # incase the packet has no TCP or UDP layer.
     port = ""
     tcp_flags = 0
-    
+    icmp_type = -1
+    seq = 0
+    ack = 0
+
     if pkt.haslayer(TCP):
         dst_port = pkt[TCP].dport
         src_port = pkt[TCP].sport
         tcp_flags = int(pkt[TCP].flags)
-        is_syn = bool(tcp_flags & 0x02)
-        is_ack = bool(tcp_flags & 0x10)
-        is_rst = bool(tcp_flags & 0x04)
-        is_fin = bool(tcp_flags & 0x01)
-
+        seq = pkt[TCP].seq
+        ack = pkt[TCP].ack
         port = "TCP"
-
     elif pkt.haslayer(UDP):
         dst_port = pkt[UDP].dport
         src_port = pkt[UDP].sport
         port = "UDP"
+    elif pkt.haslayer(ICMP):
+        icmp_type = pkt[ICMP].type
+        port = "ICMP"
+
+    payload = memoryview(pkt[Raw].load if pkt.haslayer(Raw) else b"")
 
-    # now calc the timestamp to be in a good format..
-    finalTimeStamp = datetime.datetime.fromtimestamp(timestamp, datetime.UTC).strftime('%Y-%m-%d %H:%M:%S')
-
-    Result = {
-            "src_ip" : src_ip,
-            "dst_ip" : dst_ip,
-            "timestamp" : finalTimeStamp,
-            "packetID" : packetID,
-            "payloadLen" : payloadLen,
-            "src_port" : src_port,
-            "dst_port" : dst_port,
-            "port" : port,
-            "rawts" : timestamp,
-            "tcp_flags": tcp_flags,
-            }
-    return Result # finaly returning the dictionary..
-    
+    return PacketInfo(pkt[IP].src, pkt[IP].dst, src_port, dst_port, port, pkt[IP].proto,
+                      tcp_flags, icmp_type, timestamp, packet.id, packet.get_payload_len(), payload, seq, ack)
@@ -0,0 +1,123 @@
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from config import config
+from logger import logger
+
+# Packet tracing for forensics.
+# Instead of formatting a console line for every packet, a compact summary
+# tuple of (sampled) packets goes into a fixed-size ring buffer in memory.
+# The ring is dumped to logs/traces/ on SIGUSR1 or when a new alert starts,
+# so we still have the packets that led to an attack without paying for
+# per-packet output the rest of the time.
+
+TRACE_FIELDS = ("ts", "chain", "src_ip", "src_port", "dst_ip", "dst_port", "proto", "tcp_flags", "length")
+
+
+class PacketTracer:
+    def __init__(self, ring_size=4096, sample_every=1, per_source=False, dump_dir=None,
+                 dump_on_alert=True, dump_cooldown=60):
+        """
+        Args:
+            ring_size (int): how many packet summaries are kept (oldest overwritten).
+            sample_every (int): keep 1 packet in N (1 = all of them).
+            per_source (bool): sample by source instead of by packet: all the packets
+                of 1 source in N are kept, so a sampled host has a complete trace
+                (the same sources in every worker process).
+            dump_on_alert (bool): dump the ring when a new alert starts..
+            dump_cooldown (float): ..but at most once every this many seconds.
+        """
+        self.ring_size = max(1, ring_size)
+        self.sample_every = max(1, sample_every)
+        self.per_source = per_source
+        self.dump_dir = dump_dir
+        self.dump_on_alert = dump_on_alert
+        self.dump_cooldown = dump_cooldown
+
+        self._ring = [None] * self.ring_size
+        self._written = itertools.count()   # next() is atomic, both agent threads share the ring
+        self._seen = itertools.count()
+        self._last_index = -1
+        self._last_dump = None
+        self._dump_lock = threading.Lock()
+
+        # Statistics
+        self.dumps = 0
+
+    def record(self, chain_name, info):
+        """Hot path: store a summary of the packet if it's sampled."""
+        if self.sample_every > 1:
+            if self.per_source:
+                # crc32, not hash(): str hashes change with every process, the sharded
+                # workers (and a restart) must keep tracing the same sources
+                if zlib.crc32(info.src_ip.encode()) % self.sample_every:
+                    return
+            elif next(self._seen) % self.sample_every:
+                return
+        index = next(self._written)
+        self._ring[index % self.ring_size] = (
+            info.rawts, chain_name, info.src_ip, info.src_port, info.dst_ip, info.dst_port,
+            info.proto, info.tcp_flags, info.payloadLen)
+        self._last_index = index
+
+    def snapshot(self):
+        """The ring content, oldest first."""
+        ring = list(self._ring)
+        start = (self._last_index + 1) % self.ring_size
+        ordered = ring[start:] + ring[:start]
+        return [entry for entry in ordered if entry is not None]
+
+    def dump(self, reason="manual"):
+        """Write the ring to a JSONL file in the background, returns the file path."""
+        entries = self.snapshot()
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.dump_dir, f"trace_{stamp}_{os.getpid()}_{reason}.jsonl")
+        threading.Thread(target=self._write_dump, args=(path, entries, reason),
+                         name="loki-trace-dump", daemon=True).start()
+        return path
+
+    def _write_dump(self, path, entries, reason):
+        try:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            with open(path, 'w') as f:
+                for entry in entries:
+                    f.write(json.dumps(dict(zip(TRACE_FIELDS, entry))) + "\n")
+            self.dumps += 1
+            logger.log_system_event(f"Packet trace ({len(entries)} packets, {reason}) written to {path}", "INFO")
+        except Exception as e:
+            logger.log_system_event(f"Failed to write the packet trace {path}: {e}", "ERROR")
+
+    def on_new_alert(self, record):
+        """Logger hook: dump the packets that led to the first alert of an attack."""
+        if not self.dump_on_alert:
+            return
+        now = time.monotonic()
+        with self._dump_lock:
+            if self._last_dump is not None and now - self._last_dump < self.dump_cooldown:
+                return
+            self._last_dump = now
+        self.dump("alert")
+
+    def handle_signal(self, signum, frame):
+        self.dump("signal")
+
+
+trace_config = config["trace"]
+
+# one tracer per process (both chains of this process share it), like the logger
+tracer = None
+if trace_config["enabled"]:
+    tracer = PacketTracer(
+        ring_size=trace_config["ring_size"],
+        sample_every=trace_config["sample_every"],
+        per_source=trace_config["per_source"],
+        dump_dir=os.path.join(logger.log_dir, "traces"),
+        dump_on_alert=trace_config["dump_on_alert"],
+        dump_cooldown=trace_config["dump_cooldown"],
+    )
+    logger.new_alert_hooks.append(tracer.on_new_alert)
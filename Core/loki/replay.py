@@ -0,0 +1,455 @@
+"""
+Offline replay driver for Loki IDS.
+
+Feeds pcap/pcapng files through the real process_packet pipeline using a
+stand-in for the NFQUEUE packet object, so detector/parser changes can be
+measured on identical traffic without root, iptables or a live queue.
+
+Usage (from Core/loki):
+    python3 replay.py run capture.pcap [more.pcap ...] [--speed 0] [--chain input]
+    python3 replay.py synth syn-scan ../../tests/pcaps/syn_scan.pcap
+    python3 replay.py synth udp-flood ../../tests/pcaps/udp_flood.pcap
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import struct
+import sys
+import time
+
+from detectore_engine import PortScanningDetector
+from signature_engine import SignatureScanning
+import nfqueue_app
+from nfqueue_app import process_packet, new_flow_cache, new_reassembler, new_sketches, stream_config
+from blocklist import IPBlocklist, blocklist_config
+from metrics import ChainMetrics, STAGES
+from logger import logger
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_RULES = os.path.join(PROJECT_ROOT, "Configs", "test_yaml_file.yaml")
+
+# link types we know how to strip down to the IP header
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+ETH_P_IP = 0x0800
+ETH_P_8021Q = 0x8100
+ETH_P_8021AD = 0x88A8
+
+
+class ReplayPacket:
+    """Stand-in for netfilterqueue.Packet, only what the pipeline touches."""
+
+    __slots__ = ("id", "_payload", "_timestamp", "verdict")
+
+    def __init__(self, packet_id, payload, timestamp):
+        self.id = packet_id
+        self._payload = payload
+        self._timestamp = timestamp
+        self.verdict = None
+
+    def get_payload(self):
+        return self._payload
+
+    def get_payload_len(self):
+        return len(self._payload)
+
+    def get_timestamp(self):
+        return self._timestamp
+
+    def accept(self):
+        self.verdict = "ACCEPT"
+
+    def drop(self):
+        self.verdict = "DROP"
+
+
+# ---------------------------------------------------------------- pcap reading
+
+def _strip_link_layer(linktype, frame):
+    """Return the IPv4 packet inside a captured frame, or None if it isn't IPv4."""
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        ip = frame
+    elif linktype == LINKTYPE_ETHERNET:
+        if len(frame) < 14:
+            return None
+        offset = 12
+        ethertype = struct.unpack_from("!H", frame, offset)[0]
+        while ethertype in (ETH_P_8021Q, ETH_P_8021AD) and len(frame) >= offset + 6:
+            offset += 4
+            ethertype = struct.unpack_from("!H", frame, offset)[0]
+        if ethertype != ETH_P_IP:
+            return None
+        ip = frame[offset + 2:]
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(frame) < 16 or struct.unpack_from("!H", frame, 14)[0] != ETH_P_IP:
+            return None
+        ip = frame[16:]
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(frame) < 20 or struct.unpack_from("!H", frame, 0)[0] != ETH_P_IP:
+            return None
+        ip = frame[20:]
+    else:
+        return None
+
+    if not ip or ip[0] >> 4 != 4:
+        return None
+    return ip
+
+
+def _read_pcap(f, header):
+    magic = header[:4]
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+        endian = "<"
+    else:
+        endian = ">"
+    nano = magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d")
+    rest = f.read(16)
+    linktype = struct.unpack(endian + "HHiIII", header[4:] + rest)[5] & 0x0FFFFFFF
+    record = struct.Struct(endian + "IIII")
+    divisor = 1e9 if nano else 1e6
+
+    while True:
+        rec = f.read(16)
+        if len(rec) < 16:
+            return
+        ts_sec, ts_frac, incl_len, _orig_len = record.unpack(rec)
+        frame = f.read(incl_len)
+        if len(frame) < incl_len:
+            return
+        yield ts_sec + ts_frac / divisor, linktype, frame
+
+
+def _read_pcapng(f, header):
+    # minimal pcapng: section header, interface descriptions and (enhanced/simple) packet blocks.
+    endian = "<"
+    interfaces = []   # (linktype, ticks per second)
+    block = header
+    while True:
+        if len(block) < 8:
+            return
+        block_type = struct.unpack_from(endian + "I", block)[0]
+        if block_type == 0x0A0D0D0A:
+            bom = f.read(4)
+            endian = "<" if bom == b"\x4d\x3c\x2b\x1a" else ">"
+            total_len = struct.unpack_from(endian + "I", block, 4)[0]
+            f.read(total_len - 12)
+            interfaces = []
+        else:
+            total_len = struct.unpack_from(endian + "I", block, 4)[0]
+            body = f.read(total_len - 8)
+            if len(body) < total_len - 8:
+                return
+            if block_type == 1: # interface description
+                linktype = struct.unpack_from(endian + "H", body, 0)[0]
+                ticks = 1e6
+                pos = 8
+                while pos + 4 <= len(body) - 4:
+                    code, length = struct.unpack_from(endian + "HH", body, pos)
+                    if code == 0:
+                        break
+                    if code == 9 and length >= 1: # if_tsresol
+                        res = body[pos + 4]
+                        ticks = float(2 ** (res & 0x7F)) if res & 0x80 else float(10 ** res)
+                    pos += 4 + ((length + 3) & ~3)
+                interfaces.append((linktype, ticks))
+            elif block_type == 6: # enhanced packet
+                iface, ts_high, ts_low, cap_len, _orig = struct.unpack_from(endian + "IIIII", body, 0)
+                if iface < len(interfaces):
+                    linktype, ticks = interfaces[iface]
+                    yield ((ts_high << 32) | ts_low) / ticks, linktype, body[20:20 + cap_len]
+            elif block_type == 3 and interfaces: # simple packet, no timestamp
+                linktype, _ticks = interfaces[0]
+                yield 0.0, linktype, body[4:]
+        block = f.read(8)
+
+
+def read_packets(path):
+    """Yield (timestamp, ip_bytes) for every IPv4 packet in a pcap or pcapng file."""
+    with open(path, "rb") as f:
+        header = f.read(8)
+        if header[:4] == b"\x0a\x0d\x0d\x0a":
+            frames = _read_pcapng(f, header)
+        elif header[:4] in (b"\xd4\xc3\xb2\xa1", b"\xa1\xb2\xc3\xd4", b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d"):
+            frames = _read_pcap(f, header)
+        else:
+            raise ValueError(f"{path}: not a pcap/pcapng file")
+
+        for timestamp, linktype, frame in frames:
+            ip = _strip_link_layer(linktype, frame)
+            if ip is not None:
+                yield timestamp, ip
+
+
+# ---------------------------------------------------------------- replay
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def replay(paths, is_input=True, speed=0.0, wall_clock=False, rules_path=DEFAULT_RULES,
+           port_scanner=None, sig_scanner=None, counter_slices=None, flow_cache=None, use_blocklist=True,
+           reassembler=None, sketches=None):
+    """
+    Push every packet of `paths` through process_packet and return a report dict.
+
+    Args:
+        speed (float): 0 = as fast as possible, 1 = original pacing, N = N times faster.
+        wall_clock (bool): hand the pipeline timestamp 0 (so it uses time.time(), like a
+            kernel that doesn't stamp packets) instead of the capture timestamps.
+        counter_slices (int): override detector_state.counter_slices (0 = exact deques).
+        use_blocklist (bool): run with a fresh, in-memory blocklist (the live logs/blocklist.json
+            is never read or written), False = no blocklist / automatic blocks at all.
+    """
+    if port_scanner is None:
+        port_scanner = PortScanningDetector(15, 10, counter_slices=counter_slices)
+    if sig_scanner is None:
+        sig_scanner = SignatureScanning(rules_path, regex_window=stream_config["regex_window"])
+    if flow_cache is None:
+        flow_cache = new_flow_cache()
+    if reassembler is None:
+        reassembler = new_reassembler()
+    if sketches is None:
+        sketches = new_sketches()
+
+    replay_blocklist = None
+    if use_blocklist and blocklist_config["enabled"]:
+        replay_blocklist = IPBlocklist(max_entries=blocklist_config["max_entries"],
+                                       never_block=blocklist_config["never_block"])
+        for address in blocklist_config["static"]:
+            replay_blocklist.block(address, reason="static")
+    nfqueue_app.blocklist = replay_blocklist
+
+    metrics = ChainMetrics("INPUT" if is_input else "FORWARD", 0)
+    alerts_before = logger.alert_counts.copy()
+    verdicts = {"ACCEPT": 0, "DROP": 0, "NONE": 0}
+    latencies = []
+    packet_id = 0
+    first_ts = None
+    perf_ns = time.perf_counter_ns
+
+    start = time.perf_counter()
+    for path in paths:
+        for timestamp, ip in read_packets(path):
+            packet_id += 1
+            if speed > 0:
+                if first_ts is None:
+                    first_ts = timestamp
+                delay = (timestamp - first_ts) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            packet = ReplayPacket(packet_id, ip, 0.0 if wall_clock else timestamp)
+            t0 = perf_ns()
+            process_packet(packet, is_input, port_scanner, sig_scanner, flow_cache, metrics, reassembler,
+                           sketches)
+            latencies.append(perf_ns() - t0)
+            verdicts[packet.verdict or "NONE"] += 1
+    elapsed = time.perf_counter() - start
+
+    alerts = logger.alert_counts - alerts_before
+    latencies.sort()
+    busy = sum(latencies) / 1e9
+    return {
+        "files": list(paths),
+        "packets": packet_id,
+        "elapsed_seconds": round(elapsed, 3),
+        "pps": round(packet_id / elapsed, 1) if elapsed > 0 else 0,
+        "pipeline_pps": round(packet_id / busy, 1) if busy > 0 else 0,
+        "latency_us": {
+            "p50": round(_percentile(latencies, 50) / 1000, 2),
+            "p99": round(_percentile(latencies, 99) / 1000, 2),
+            "max": round(latencies[-1] / 1000, 2) if latencies else 0,
+        },
+        "stages": {stage: getattr(metrics, stage).summary() for stage in STAGES},
+        "verdicts": verdicts,
+        "alerts": sum(alerts.values()),
+        "alerts_by_message": dict(alerts),
+        "active_alerts": len(logger.active_alerts),
+        "flow_cache": flow_cache.stats() if flow_cache is not None else None,
+        "stream_reassembly": reassembler.stats() if reassembler is not None else None,
+        "blocklist": replay_blocklist.stats() if replay_blocklist is not None else None,
+        "heavy_hitters": sketches.stats(5) if sketches is not None else None,
+    }
+
+
+# ---------------------------------------------------------------- synthetic traffic
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def build_ipv4(src, dst, proto, l4, ident=0):
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(l4), ident & 0xFFFF, 0, 64, proto, 0,
+                         bytes(map(int, src.split("."))), bytes(map(int, dst.split("."))))
+    header = header[:10] + struct.pack("!H", _checksum(header)) + header[12:]
+    return header + l4
+
+
+def build_tcp(src, dst, sport, dport, flags, payload=b"", seq=0, ident=0, ack=0):
+    l4 = struct.pack("!HHIIBBHHH", sport, dport, seq, ack, 5 << 4, flags, 64240, 0, 0) + payload
+    return build_ipv4(src, dst, 6, l4, ident)
+
+
+def build_udp(src, dst, sport, dport, payload=b"", ident=0):
+    l4 = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+    return build_ipv4(src, dst, 17, l4, ident)
+
+
+def write_pcap(path, packets):
+    """Write (timestamp, ip_bytes) pairs as a LINKTYPE_RAW pcap."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, LINKTYPE_RAW))
+        for timestamp, ip in packets:
+            sec = int(timestamp)
+            usec = int(round((timestamp - sec) * 1e6))
+            if usec >= 1000000:
+                sec, usec = sec + 1, usec - 1000000
+            f.write(struct.pack("<IIII", sec, usec, len(ip), len(ip)))
+            f.write(ip)
+
+
+def synth_syn_scan(count=1000, rate=1000.0, src="10.0.0.66", dst="10.0.0.1", start=1700000000.0):
+    """One scanner sweeping `count` destination ports with bare SYNs."""
+    for i in range(count):
+        yield start + i / rate, build_tcp(src, dst, 40000 + i % 20000, 1 + i % 65535, 0x02, ident=i)
+
+
+def synth_udp_flood(count=20000, rate=5000.0, dst="10.0.0.1", dport=53, sources=256, start=1700000000.0):
+    """`sources` spoofed clients hammering one UDP port."""
+    rng = random.Random(1)
+    for i in range(count):
+        src = f"172.16.{i % sources // 256}.{i % sources % 256}"
+        yield start + i / rate, build_udp(src, dst, rng.randrange(1024, 65535), dport, b"x" * 64, ident=i)
+
+
+def synth_split_attack(count=100, rate=100.0, src="10.0.0.7", dst="10.0.0.1", start=1700000000.0):
+    """
+    `count` HTTP connections (full handshake) whose request has /etc/passwd cut over two
+    segments, every other one with the segments swapped (out of order).
+    Only a stream-level scan finds them.
+    """
+    t = start
+    for i in range(count):
+        sport = 30000 + i
+        isn = (i * 7919) & 0xFFFFFFFF
+        first = b"GET /../../etc/pa"
+        second = b"sswd HTTP/1.1\r\nHost: x\r\n\r\n"
+        segments = [(isn + 1, first), (isn + 1 + len(first), second)]
+        if i % 2:
+            segments.reverse()
+        server_isn = (isn * 31 + 12345) & 0xFFFFFFFF
+        yield t, build_tcp(src, dst, sport, 80, 0x02, seq=isn, ident=i)
+        t += 0.25 / rate
+        yield t, build_tcp(dst, src, 80, sport, 0x12, seq=server_isn, ident=i, ack=isn + 1)
+        t += 0.125 / rate
+        yield t, build_tcp(src, dst, sport, 80, 0x10, seq=isn + 1, ident=i, ack=server_isn + 1)
+        t += 0.125 / rate
+        for seq, data in segments:
+            yield t, build_tcp(src, dst, sport, 80, 0x18, data, seq=seq, ident=i)
+            t += 0.25 / rate
+
+
+SYNTHETIC = {
+    "syn-scan": synth_syn_scan,
+    "udp-flood": synth_udp_flood,
+    "split-attack": synth_split_attack,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay pcaps through the Loki IDS pipeline.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="replay pcap/pcapng files and print a report")
+    run.add_argument("pcaps", nargs="+")
+    run.add_argument("--chain", choices=("input", "forward"), default="input")
+    run.add_argument("--speed", type=float, default=0.0,
+                     help="0 = as fast as possible (default), 1 = original timing, N = N times faster")
+    run.add_argument("--wall-clock", action="store_true",
+                     help="ignore capture timestamps and let the pipeline use time.time()")
+    run.add_argument("--rules", default=DEFAULT_RULES)
+    run.add_argument("--counter-slices", type=int,
+                     help="flood counter resolution, 0 = exact deques (compare both on the same capture)")
+    run.add_argument("--alerts-file", default="replay_alerts.jsonl",
+                     help="alert log written under logs/ (kept apart from the live loki_alerts.jsonl)")
+    run.add_argument("--no-blocklist", action="store_true",
+                     help="no blocklist / automatic blocks (compare detector output packet for packet)")
+    run.add_argument("--verbose", action="store_true", help="keep the per-packet console output")
+    run.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    synth = sub.add_parser("synth", help="write a synthetic pcap")
+    synth.add_argument("kind", choices=sorted(SYNTHETIC))
+    synth.add_argument("output")
+    synth.add_argument("--count", type=int)
+    synth.add_argument("--rate", type=float)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "synth":
+        kwargs = {}
+        if args.count:
+            kwargs["count"] = args.count
+        if args.rate:
+            kwargs["rate"] = args.rate
+        write_pcap(args.output, SYNTHETIC[args.kind](**kwargs))
+        print(f"[*] wrote {args.kind} capture to {args.output}")
+        return 0
+
+    if not args.verbose:
+        logger.console_logger.setLevel(logging.WARNING)
+    logger.set_log_file(args.alerts_file, "replay_system.jsonl" if logger.system_filepath else None)
+
+    report = replay(args.pcaps, is_input=(args.chain == "input"), speed=args.speed,
+                    wall_clock=args.wall_clock, rules_path=args.rules,
+                    counter_slices=args.counter_slices, use_blocklist=not args.no_blocklist)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"[*] packets: {report['packets']} in {report['elapsed_seconds']}s "
+              f"({report['pps']} pps, pipeline only {report['pipeline_pps']} pps)")
+        print(f"[*] latency: p50 {report['latency_us']['p50']}us, p99 {report['latency_us']['p99']}us, "
+              f"max {report['latency_us']['max']}us")
+        for stage, summary in report["stages"].items():
+            if summary["count"]:
+                print(f"      {stage:<10} {summary['count']:>8} calls, mean {summary['mean_us']}us, "
+                      f"p99 <= {summary['p99_us']}us")
+        print(f"[*] verdicts: {report['verdicts']}")
+        if report["flow_cache"]:
+            flows = report["flow_cache"]
+            print(f"[*] flow cache: {flows['flows']} flows, hit rate {flows['hit_rate']:.1%}, "
+                  f"{flows['fast_path']} fast path, {flows['dropped']} dropped by flow verdict")
+        if report["stream_reassembly"]:
+            streams = report["stream_reassembly"]
+            print(f"[*] stream reassembly: {streams['streams']} streams, {streams['in_order']} in order, "
+                  f"{streams['out_of_order']} out of order, {streams['retransmits']} retransmitted segments")
+        if report["blocklist"]:
+            blocks = report["blocklist"]
+            print(f"[*] blocklist: {blocks['hosts']} addresses blocked, {blocks['hits']} packets dropped by it")
+        if report["heavy_hitters"]:
+            for name, table in report["heavy_hitters"].items():
+                top = ", ".join(f"{key} ({count})" for key, count, _error in table["top"])
+                print(f"[*] top {name} (current window): {top}")
+        print(f"[*] alerts: {report['alerts']}")
+        for message, count in sorted(report["alerts_by_message"].items()):
+            print(f"      {count:>8}  {message}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
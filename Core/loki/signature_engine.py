@@ -1,48 +1,490 @@
 # nowwww let's detect the content itself..
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from array import array
+from re import _constants as sre_constants, _parser as sre_parse
+
 import yaml
+from aho_corasick import AhoCorasick
+
+
+class SignatureMatch:
+    """One rule that matched a payload."""
+
+    __slots__ = ("name", "pattern", "action", "offset")
+
+    def __init__(self, name, pattern, action, offset):
+        self.name = name
+        self.pattern = pattern
+        self.action = action    # "drop" or "alert", as written in the yaml file
+        self.offset = offset    # where the match starts in the scanned payload
+
+    @property
+    def is_drop(self):
+        return str(self.action).lower() == "drop"
+
+    def __repr__(self):
+        return f"SignatureMatch({self.name!r}, action={self.action!r}, offset={self.offset})"
+
+
+VALID_ACTIONS = ("drop", "alert")
+
+# shortest literal worth a prefilter entry, a regex with nothing longer runs on every payload
+MIN_PREFILTER_LEN = 2
+
+
+def _literal_runs(parsed, runs, current):
+    """
+    Collect the runs of consecutive literal bytes every match of the parsed
+    regex must contain. Anything that can vary (classes, alternations,
+    optional parts) ends the current run.
+    """
+    for op, arg in parsed:
+        if op is sre_constants.LITERAL:
+            current.append(arg)
+        elif op is sre_constants.SUBPATTERN:
+            _literal_runs(arg[-1], runs, current) # a group is just its content
+        elif op is sre_constants.AT:
+            pass # anchors / \b don't consume anything
+        elif (op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and arg[0] >= 1
+              and len(arg[2]) == 1 and arg[2][0][0] is sre_constants.LITERAL):
+            # x{n,m}: n copies of x for sure (a NOP sled, padding..)
+            current.extend([arg[2][0][1]] * min(arg[0], 16))
+            if arg[1] != arg[0] or arg[0] > 16:
+                runs.append(bytes(current))
+                current.clear()
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and arg[0] >= 1:
+            # the body is there at least once, but not next to what's around it
+            runs.append(bytes(current))
+            current.clear()
+            _literal_runs(arg[2], runs, current)
+            runs.append(bytes(current))
+            current.clear()
+        else:
+            runs.append(bytes(current))
+            current.clear()
+
+
+def required_literal(regex_bytes, flags=0):
+    """Longest literal every match of the regex contains (lower case), or b"" if there is none worth it."""
+    runs = []
+    current = []
+    _literal_runs(sre_parse.parse(regex_bytes, flags), runs, current)
+    runs.append(bytes(current))
+    best = max(runs, key=len)
+    return best.lower() if len(best) >= MIN_PREFILTER_LEN else b""
+
+
+class RuleSet:
+    """
+    A compiled set of rules: the rule list and its automaton, never modified
+    after it's built. Reloading builds a new RuleSet and swaps the reference,
+    so a packet always scans with one consistent (rules, matcher) pair.
+
+    Literal rules and the required literal of every regex rule go into one
+    case-insensitive automaton: one scan of the payload gives the literal
+    matches (case checked on the hit for case-sensitive rules) and the regex
+    rules worth running. Regex rules without a usable literal run on every
+    payload. Per-rule CPU time of the regex evaluations is counted here.
+    """
+
+    __slots__ = ("rules", "matcher", "key_rule", "always", "source", "version", "stream_tail", "from_cache",
+                 "cpu_ns", "evaluations", "matches")
+
+    def __init__(self, rules, source=None, version=0, regex_window=0, matcher=None):
+        self.rules = tuple(rules)
+        keys = []
+        self.key_rule = []  # automaton pattern id -> rule index
+        self.always = []    # regex rules with no prefilter literal
+        for rule_id, rule in enumerate(self.rules):
+            key = rule['pattern_bytes'] if rule['regex'] is None else rule['prefilter']
+            if key:
+                keys.append(key)
+                self.key_rule.append(rule_id)
+            else:
+                self.always.append(rule_id)
+        # an automaton loaded from the rule cache was built from these same keys
+        self.matcher = AhoCorasick(keys, nocase=True) if matcher is None else matcher
+        # bytes of the previous segment to keep in front of the next one so that no
+        # literal is missed at the boundary. A regex match has no length limit, it
+        # gets regex_window bytes (matches spanning more than that can be missed).
+        self.stream_tail = max(0, self.matcher.max_pattern_len - 1)
+        if any(rule['regex'] is not None for rule in self.rules):
+            self.stream_tail = max(self.stream_tail, regex_window)
+        self.source = source
+        self.version = version
+        self.from_cache = False
+
+        # Statistics (per rule index)
+        self.cpu_ns = [0] * len(self.rules)       # time spent in the regex of the rule
+        self.evaluations = [0] * len(self.rules)  # times the regex had to run
+        self.matches = [0] * len(self.rules)
+
+
+def parse_rules(all_rules):
+    """Validate the content of a rules yaml file, returns the rule dicts or raises ValueError."""
+    if not isinstance(all_rules, dict) or not isinstance(all_rules.get('signatures'), list):
+        raise ValueError("the file has no 'signatures' list")
+
+    rules = []
+    for index, block in enumerate(all_rules['signatures']):
+        if not isinstance(block, dict):
+            raise ValueError(f"signature #{index} is not a mapping")
+        name = block.get('name')
+        pattern = block.get('pattern')
+        regex = block.get('regex')
+        action = str(block.get('action', '')).lower()
+        if not name:
+            raise ValueError(f"signature #{index} has no name")
+        if (pattern is None) == (regex is None):
+            raise ValueError(f"signature {name!r} needs exactly one of 'pattern' or 'regex'")
+        if not isinstance(pattern or regex, str) or not (pattern or regex):
+            raise ValueError(f"signature {name!r} has an empty pattern")
+        if action not in VALID_ACTIONS:
+            raise ValueError(f"signature {name!r} has an unknown action {block.get('action')!r}")
+        block = dict(block)
+        block['nocase'] = bool(block.get('nocase', False))
+        if regex is None:
+            block['pattern_bytes'] = pattern.encode('utf-8')
+            block['regex'] = None
+        else:
+            block['pattern'] = regex # what the alerts show
+            flags = re.IGNORECASE if block['nocase'] else 0
+            try:
+                block['regex'] = re.compile(regex.encode('utf-8'), flags)
+                block['prefilter'] = required_literal(regex.encode('utf-8'), flags)
+            except re.error as e:
+                raise ValueError(f"signature {name!r} has a bad regex: {e}")
+            block['pattern_bytes'] = block['prefilter']
+        rules.append(block)
+    return rules
+
+
+# the C loader when PyYAML was built with libyaml, several times faster
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# bump when RuleSet / AhoCorasick change shape, old cache files are then ignored
+CACHE_FORMAT = 2
+CACHE_KEEP = 4 # compiled rule sets kept in the cache directory
+CACHE_ARRAYS = ("delta", "out_start", "out_ids") # array('I') tables, in file order after the classes
+
+# A cache file is data only, never code: one line of JSON (the rule dicts, regexes
+# as their source, bytes as hex, and the automaton sizes) then the automaton
+# tables as raw bytes. The regexes are compiled again on load, the slow part
+# (required literals + automaton build) is what the cache saves.
+
+
+def _cache_path(cache_dir, raw, regex_window):
+    key = hashlib.sha256(raw)
+    key.update(f"|{regex_window}|{CACHE_FORMAT}|{sys.version_info[0]}.{sys.version_info[1]}|{sys.byteorder}".encode())
+    return os.path.join(cache_dir, f"ruleset-{key.hexdigest()}.rules")
+
+
+def _dump_rule(rule):
+    rule = dict(rule)
+    rule['regex'] = rule['regex'] is not None # compiled again from 'pattern'
+    for field in ('pattern_bytes', 'prefilter'):
+        if field in rule:
+            rule[field] = rule[field].hex()
+    return rule
+
+
+def _load_rule(rule):
+    for field in ('pattern_bytes', 'prefilter'):
+        if field in rule:
+            rule[field] = bytes.fromhex(rule[field])
+    if rule['regex']:
+        rule['regex'] = re.compile(rule['pattern'].encode('utf-8'), re.IGNORECASE if rule['nocase'] else 0)
+    else:
+        rule['regex'] = None
+    return rule
+
+
+def _trusted(st):
+    # written by us and nobody else could have changed it
+    return st.st_uid == os.geteuid() and not st.st_mode & 0o022
+
+
+def _read_cache(path):
+    try:
+        with open(path, 'rb') as f:
+            if not (_trusted(os.fstat(f.fileno())) and _trusted(os.stat(os.path.dirname(path)))):
+                print(f"[!] ignoring the rule cache {path}: not ours or writable by others")
+                return None
+            header, _, blob = f.read().partition(b"\n")
+        meta = json.loads(header)
+        if meta.get("format") != CACHE_FORMAT:
+            return None
+        tables = dict(meta["matcher"])
+        tables["patterns"] = [bytes.fromhex(p) for p in tables["patterns"]]
+        tables["classes"] = blob[:256]
+        offset = 256
+        for name in CACHE_ARRAYS:
+            table = array('I')
+            size = tables.pop(f"{name}_len") * table.itemsize
+            table.frombytes(blob[offset:offset + size])
+            tables[name] = table
+            offset += size
+        if offset != len(blob):
+            raise ValueError("wrong size")
+        matcher = AhoCorasick.from_tables(**tables)
+        return RuleSet([_load_rule(rule) for rule in meta["rules"]], regex_window=meta["regex_window"],
+                       matcher=matcher)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[!] ignoring the broken rule cache {path}: {e}")
+        return None
+
+
+def _write_cache(path, ruleset, regex_window):
+    try:
+        tables = ruleset.matcher.tables()
+        matcher = {name: tables[name] for name in ("nocase", "n_states", "n_classes", "out_limit")}
+        matcher["patterns"] = [p.hex() for p in tables["patterns"]]
+        for name in CACHE_ARRAYS:
+            matcher[f"{name}_len"] = len(tables[name])
+        header = json.dumps({"format": CACHE_FORMAT, "regex_window": regex_window, "matcher": matcher,
+                             "rules": [_dump_rule(rule) for rule in ruleset.rules]})
+
+        cache_dir = os.path.dirname(path)
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.encode('utf-8') + b"\n")
+            f.write(tables["classes"])
+            for name in CACHE_ARRAYS:
+                f.write(tables[name].tobytes())
+        os.replace(tmp_path, path)
+
+        # only keep the most recent few (and nothing of the old pickle format)
+        for stale in glob.glob(os.path.join(cache_dir, "ruleset-*.pickle")):
+            os.remove(stale)
+        old = sorted(glob.glob(os.path.join(cache_dir, "ruleset-*.rules")), key=os.path.getmtime, reverse=True)
+        for stale in old[CACHE_KEEP:]:
+            os.remove(stale)
+    except Exception as e:
+        print(f"[!] couldn't write the rule cache {path}: {e}")
+
+
+def _check_matcher(ruleset):
+    # every key must find itself, or the automaton is broken
+    for key_id, key in enumerate(ruleset.matcher.patterns):
+        if not any(found == key_id for found, _end in ruleset.matcher.findall(key)):
+            rule = ruleset.rules[ruleset.key_rule[key_id]]
+            raise ValueError(f"signature {rule.get('name')!r} doesn't match its own pattern")
+
+
+def compile_rules(file_path, version=0, regex_window=0, cache_dir=None):
+    """
+    Read, validate and compile a rules file into a RuleSet. Raises on any problem.
+    With a cache_dir, the compiled RuleSet is stored there under the sha256 of
+    the file content, and an unchanged file is loaded back instead of parsed
+    and compiled again.
+    """
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+
+    cache_path = _cache_path(cache_dir, raw, regex_window) if cache_dir else None
+    if cache_path:
+        ruleset = _read_cache(cache_path)
+        if ruleset is not None:
+            try:
+                _check_matcher(ruleset)
+            except ValueError as e:
+                print(f"[!] ignoring the broken rule cache {cache_path}: {e}")
+            else:
+                ruleset.source = file_path
+                ruleset.version = version
+                ruleset.from_cache = True
+                return ruleset
+
+    all_rules = yaml.load(raw, Loader=_YamlLoader)
+    ruleset = RuleSet(parse_rules(all_rules), source=file_path, version=version, regex_window=regex_window)
+
+    # sanity check of the new automaton before anybody uses it
+    _check_matcher(ruleset)
+
+    if cache_path:
+        _write_cache(cache_path, ruleset, regex_window)
+    return ruleset
+
+
+def _within(spans, start, end):
+    """True if [start, end) lies inside one of the (start, end) spans."""
+    for span_start, span_end in spans:
+        if span_start <= start and end <= span_end:
+            return True
+    return False
 
 
 class SignatureScanning:
-    def __init__(self, yaml_file_path="../../Configs/test_yaml_file.yaml"):
-        # the dict will be : RULE_ID -> (description, data, action, rule id)
-        self.rule = {"TEST_RULE" : ("test malicious rule", b"ATTACK_TEST", True, "ID1 TEST_RULE")} # just for testing..
-        self.rules = []
+    def __init__(self, yaml_file_path="../../Configs/test_yaml_file.yaml", regex_window=128, cache_dir=None):
+        self.file_path = yaml_file_path
+        self.regex_window = regex_window # stream tail kept for regex rules, see RuleSet
+        self.cache_dir = cache_dir       # compiled rule sets are cached here (None = no cache)
+        self.ruleset = RuleSet([])
+        self._file_stamp = None
+        self._reload_lock = threading.Lock()
+
+        # Statistics
+        self.reloads = 0
+        self.reload_errors = 0
+
         self.load_rules(yaml_file_path)
 
+    # the current rule list / automaton (read-only views of self.ruleset)
+    @property
+    def rules(self):
+        return self.ruleset.rules
+
+    @property
+    def matcher(self):
+        return self.ruleset.matcher
+
+    @property
+    def stream_tail(self):
+        return self.ruleset.stream_tail
+
+    def _stat(self, file_path):
+        try:
+            st = os.stat(file_path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
     def load_rules(self, file_path):
         try:
-            with open(file_path, 'r') as f:
-                all_rules = yaml.safe_load(f)
-                #print("opening the file path is done.")
-
-            # now we have all the rules organized as a dictionaries..
-            # let's add them to the rules variable
-            
-            for block in all_rules.get('signatures'):
-               # print(f"current block is : {block}")
-                block['pattern_bytes'] = block['pattern'].encode('utf-8')
-                self.rules.append(block)
-
-            print(f"[*] loading of the rules from {file_path} is done.")
+            stamp = self._stat(file_path)
+            self.ruleset = compile_rules(file_path, regex_window=self.regex_window, cache_dir=self.cache_dir)
+            self.file_path = file_path
+            self._file_stamp = stamp
+
+            print(f"[*] loading of the rules from {file_path} is done{' (compiled rule cache)' if self.ruleset.from_cache else ''}.")
             print(f"[*] number of rules loaded is {len(self.rules)}.")
+            print(f"[*] signature automaton: {self.matcher.n_states} states, {self.matcher.table_bytes} bytes.")
+            for rule_id in self.ruleset.always:
+                print(f"[!] regex of {self.rules[rule_id].get('name')!r} has no literal to prefilter on, "
+                      f"it runs on every payload.")
            # print(f"the rules are : \n{self.rules}")
            # print("================***==============")
 
         except Exception as e:
             print(f"[!]ERROR while loading the yaml file: {e}")
 
-    def CheckPacketPayload(self, payload):
-        # we should get the payload itself like pkt[Raw].load
-        # it won't matter if it's tcp or udp
-        Rule = self.rule.get("TEST_RULE")
+    def reload(self):
+        """
+        Build the rule set again from the file and swap it in. Runs off the
+        packet path (maintenance thread); the packet threads keep scanning with
+        the old RuleSet until the single reference assignment. A file that
+        doesn't load or validate leaves the old rules active.
+        Returns (ok, message).
+        """
+        with self._reload_lock:
+            stamp = self._stat(self.file_path)
+            try:
+                new_ruleset = compile_rules(self.file_path, version=self.ruleset.version + 1,
+                                            regex_window=self.regex_window, cache_dir=self.cache_dir)
+            except Exception as e:
+                self.reload_errors += 1
+                self._file_stamp = stamp # don't retry the same broken file every check
+                return False, f"rules reload from {self.file_path} failed, keeping the {len(self.rules)} current rules: {e}"
+
+            old_count = len(self.rules)
+            self.ruleset = new_ruleset # the atomic swap
+            self._file_stamp = stamp
+            self.reloads += 1
+            return True, (f"rules reloaded from {self.file_path}: {old_count} -> {len(new_ruleset.rules)} rules "
+                          f"(version {new_ruleset.version}, {new_ruleset.matcher.n_states} states)")
+
+    def file_changed(self):
+        """True when the rules file was modified (or replaced) since it was last loaded."""
+        return self._stat(self.file_path) != self._file_stamp
+
+    def match_payload(self, payload, min_end=0, seen=()):
+        """
+        Scan the payload once and return a SignatureMatch for every rule that
+        matches (first occurrence of each rule, ordered by offset).
+        Matches ending at or before `min_end`, or lying inside one of the
+        `seen` (start, end) spans, are ignored (stream reassembly: those bytes
+        were scanned already, with the previous segment or on their own).
+        """
         try:
-            for rule in self.rules:
-                if rule.get('pattern_bytes') in payload:
-                    return rule.get('name'), rule.get('pattern'), rule.get('action')
-                    # note that if the packet matches many ruless, then now this code will return
-                    # only the first rule that matches, keep in mind that we need to modify it.
-            
+            ruleset = self.ruleset # one rule set for the whole packet, even if a reload swaps it meanwhile
+            rules = ruleset.rules
+            key_rule = ruleset.key_rule
+            found = {}
+            candidates = []
+            for key_id, end in ruleset.matcher.findall(payload):
+                rule_id = key_rule[key_id]
+                if rule_id in found:
+                    continue
+                rule = rules[rule_id]
+                if rule['regex'] is not None:
+                    if rule_id not in candidates:
+                        candidates.append(rule_id)
+                    continue
+                if end <= min_end:
+                    continue
+                pattern_bytes = rule['pattern_bytes']
+                start = end - len(pattern_bytes)
+                if seen and _within(seen, start, end):
+                    continue
+                # the automaton ignores case, case-sensitive rules check the bytes
+                if rule['nocase'] or payload[start:end] == pattern_bytes:
+                    found[rule_id] = SignatureMatch(rule.get('name'), rule.get('pattern'), rule.get('action'), start)
+
+            if candidates or ruleset.always:
+                perf_ns = time.perf_counter_ns
+                for rule_id in candidates + ruleset.always:
+                    rule = rules[rule_id]
+                    t0 = perf_ns()
+                    m = rule['regex'].search(payload)
+                    while m is not None and (m.end() <= min_end or (seen and _within(seen, m.start(), m.end()))):
+                        m = rule['regex'].search(payload, m.start() + 1)
+                    ruleset.cpu_ns[rule_id] += perf_ns() - t0
+                    ruleset.evaluations[rule_id] += 1
+                    if m is not None:
+                        found[rule_id] = SignatureMatch(rule.get('name'), rule.get('pattern'), rule.get('action'),
+                                                        m.start())
+
+            for rule_id in found:
+                ruleset.matches[rule_id] += 1
+            return sorted(found.values(), key=lambda match: match.offset)
+
         except Exception as e:
             print(f"[-] ERROR while checking the packet : {e}")
-            
+
+        return []
+
+    def rule_stats(self):
+        """Per rule counters of the current rule set, the most expensive rules first."""
+        ruleset = self.ruleset
+        stats = []
+        for rule_id, rule in enumerate(ruleset.rules):
+            stats.append({
+                "name": rule.get('name'),
+                "type": "literal" if rule['regex'] is None else "regex",
+                "prefilter": rule['pattern_bytes'].decode('latin-1') if rule['regex'] is not None else None,
+                "cpu_seconds": ruleset.cpu_ns[rule_id] / 1e9,
+                "evaluations": ruleset.evaluations[rule_id],
+                "matches": ruleset.matches[rule_id],
+            })
+        stats.sort(key=lambda item: item["cpu_seconds"], reverse=True)
+        return stats
+
+    def CheckPacketPayload(self, payload):
+        # we should get the payload itself like pkt[Raw].load
+        # it won't matter if it's tcp or udp
+        # kept for the old callers, returns only the first match. use match_payload to get all of them.
+        matches = self.match_payload(payload)
+        if matches:
+            return matches[0].name, matches[0].pattern, matches[0].action
         return 0,0,0
@@ -0,0 +1,230 @@
+import zlib
+from heapq import heappush, heapreplace
+
+# Heavy hitter sketches: who sends / receives the most packets, in constant memory.
+#
+# The behavior detectors keep one window per (src, dst) or (dst, port) key, so
+# a flood from thousands of spoofed sources is spread over thousands of small
+# windows that each stay under the threshold. Here every packet (but the ones
+# the flow cache fast path takes, see process_packet) is counted per
+# source, per destination and per destination port in a Count-Min sketch
+# (fixed width x depth counters, never underestimates) for the thresholds, and
+# a Space-Saving summary (the k biggest keys, with their max error) for the
+# top talker lists. Both are reset every window, the last complete window is
+# kept as a WindowSummary for the stats and the cross-sensor export
+# (summary_export.py). Windows are aligned on multiples of the window length
+# and the sketch hash is deterministic, so the summaries of every node can be
+# added up by the collector.
+
+class CountMinSketch:
+    """
+    Approximate per-key counts, `depth` rows of `width` counters (width is rounded up to a power of 2).
+    Keys are str, hashed with crc32 (not hash(), which changes with every process) so two
+    sketches of the same size built anywhere can be merged.
+    """
+
+    __slots__ = ("width", "depth", "mask", "offsets", "cells", "total")
+
+    def __init__(self, width=2048, depth=4):
+        self.width = 1 << max(1, (width - 1).bit_length())
+        self.depth = depth
+        self.mask = self.width - 1
+        self.offsets = tuple(row * self.width for row in range(depth))
+        self.cells = [0] * (self.width * depth)
+        self.total = 0
+
+    def _slots(self, key):
+        # one hash per key, spread by a multiply, the rows use h1 + i * h2 (double hashing)
+        h = zlib.crc32(key.encode()) * 0x9E3779B97F4A7C15
+        x = h & 0xFFFFFFFF
+        h2 = ((h >> 32) & 0xFFFFFFFF) | 1
+        mask = self.mask
+        slots = []
+        for offset in self.offsets:
+            slots.append(offset + (x & mask))
+            x += h2
+        return slots
+
+    def add(self, key, count=1):
+        """Count `key`, return its estimated count. Conservative update: only the smallest counters grow."""
+        cells = self.cells
+        slots = self._slots(key)
+        estimate = min([cells[slot] for slot in slots]) + count
+        for slot in slots:
+            if cells[slot] < estimate:
+                cells[slot] = estimate
+        self.total += count
+        return estimate
+
+    def estimate(self, key):
+        cells = self.cells
+        return min([cells[slot] for slot in self._slots(key)])
+
+    def clear(self):
+        self.cells = [0] * (self.width * self.depth)
+        self.total = 0
+
+    def merge(self, other):
+        """Add the counts of another sketch of the same size into this one."""
+        if other.width != self.width or other.depth != self.depth:
+            raise ValueError(f"can't merge a {other.depth}x{other.width} sketch into a {self.depth}x{self.width} one")
+        self.cells = [a + b for a, b in zip(self.cells, other.cells)]
+        self.total += other.total
+
+
+class SpaceSaving:
+    """
+    The (at most) `k` most frequent keys. A key that isn't monitored takes the
+    place of the smallest one and inherits its count as error, so for every
+    monitored key: count - error <= true count <= count.
+    """
+
+    __slots__ = ("k", "counts", "heap")
+
+    def __init__(self, k=20):
+        self.k = max(1, k)
+        self.counts = {} # key -> [count, error]
+        # (count, key) min-heap, one entry per monitored key. Counts only go up, so
+        # an entry may be lower than the real count, it's fixed when it reaches the top.
+        self.heap = []
+
+    def add(self, key, count=1):
+        entry = self.counts.get(key)
+        if entry is not None:
+            entry[0] += count
+            return entry[0]
+        counts, heap = self.counts, self.heap
+        if len(counts) < self.k:
+            counts[key] = [count, 0]
+            heappush(heap, (count, key))
+            return count
+        # find the real minimum
+        while True:
+            low, low_key = heap[0]
+            current = counts[low_key][0]
+            if current == low:
+                break
+            heapreplace(heap, (current, low_key))
+        del counts[low_key]
+        counts[key] = [low + count, low]
+        heapreplace(heap, (low + count, key))
+        return low + count
+
+    def top(self, n=None):
+        """[(key, count, error), ...] biggest first."""
+        items = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, count, error) for key, (count, error) in items[:n]]
+
+
+class WindowSummary:
+    """A complete window of one WindowedHeavyHitters: what gets exported and merged."""
+
+    __slots__ = ("name", "window_start", "window", "counts", "top")
+
+    def __init__(self, name, window_start, window, counts, top):
+        self.name = name                 # "src", "dst" or "dst_port"
+        self.window_start = window_start
+        self.window = window
+        self.counts = counts             # CountMinSketch
+        self.top = top                   # [(key, count, error), ...] biggest first
+
+    @property
+    def total(self):
+        return self.counts.total
+
+
+class WindowedHeavyHitters:
+    """Count-Min + Space-Saving over tumbling windows of `window` seconds, for one kind of key."""
+
+    def __init__(self, name, window=10.0, width=2048, depth=4, k=20, threshold=0):
+        self.name = name
+        self.window = window
+        self.width = width
+        self.depth = depth
+        self.threshold = threshold # packets per window, 0 = no alert
+        self.counts = CountMinSketch(width, depth)
+        self.top_keys = SpaceSaving(k)
+        self.alerted = set()       # keys already reported this window
+        self.window_start = None
+        self.last_window = None    # WindowSummary of the last complete window (swapped in whole)
+
+    @property
+    def last_top(self):
+        return self.last_window.top if self.last_window is not None else []
+
+    @property
+    def last_total(self):
+        return self.last_window.total if self.last_window is not None else 0
+
+    def _rotate(self, timestamp):
+        if self.window_start is not None:
+            self.last_window = WindowSummary(self.name, self.window_start, self.window,
+                                             self.counts, self.top_keys.top())
+        self.window_start = timestamp - timestamp % self.window
+        self.counts = CountMinSketch(self.width, self.depth)
+        self.top_keys = SpaceSaving(self.top_keys.k)
+        self.alerted.clear()
+
+    def add(self, key, timestamp):
+        """Count one packet of `key`, return its estimate the first time it goes over the threshold (else 0)."""
+        start = self.window_start
+        # (a clock jumping back more than a window starts over too)
+        if start is None or timestamp >= start + self.window or timestamp < start - self.window:
+            self._rotate(timestamp)
+        estimate = self.counts.add(key)
+        self.top_keys.add(key)
+        if self.threshold and estimate > self.threshold and key not in self.alerted:
+            self.alerted.add(key)
+            return estimate
+        return 0
+
+    def stats(self, n=None):
+        return {
+            "window_start": self.window_start,
+            "packets": self.counts.total,
+            "top": self.top_keys.top(n),
+            "last_packets": self.last_total,
+            "last_top": self.last_top[:n],
+        }
+
+
+def _port_key(info):
+    return f"{info.port}/{info.dst_port}"
+
+
+class TrafficSketches:
+    """Top sources, destinations and destination ports of one queue."""
+
+    DIMENSIONS = ("src", "dst", "dst_port")
+
+    def __init__(self, window=10.0, width=2048, depth=4, k=20, thresholds=None):
+        thresholds = thresholds or {}
+        self.sources = WindowedHeavyHitters("src", window, width, depth, k, thresholds.get("src", 0))
+        self.destinations = WindowedHeavyHitters("dst", window, width, depth, k, thresholds.get("dst", 0))
+        self.ports = WindowedHeavyHitters("dst_port", window, width, depth, k, thresholds.get("dst_port", 0))
+
+    def observe(self, info):
+        """
+        Count a packet (PacketInfo). Returns None, or the [(dimension, key, estimate), ...]
+        that just went over their threshold.
+        """
+        timestamp = info.rawts
+        hits = None
+        estimate = self.sources.add(info.src_ip, timestamp)
+        if estimate:
+            hits = [("src", info.src_ip, estimate)]
+        estimate = self.destinations.add(info.dst_ip, timestamp)
+        if estimate:
+            hits = (hits or []) + [("dst", info.dst_ip, estimate)]
+        if info.dst_port:
+            key = _port_key(info)
+            estimate = self.ports.add(key, timestamp)
+            if estimate:
+                hits = (hits or []) + [("dst_port", key, estimate)]
+        return hits
+
+    def tables(self):
+        return (self.sources, self.destinations, self.ports)
+
+    def stats(self, n=None):
+        return {table.name: table.stats(n) for table in self.tables()}
@@ -0,0 +1,382 @@
+import itertools
+import math
+import sys
+from array import array
+from collections import OrderedDict, deque
+
+# Bounded per-key state for the detectors.
+# The old defaultdict(deque) tables never forgot a key, so a spoofed-source
+# flood (or just a long uptime) made them grow until the Pi ran out of memory.
+
+
+class _Entry:
+    __slots__ = ("last_seen", "value")
+
+    def __init__(self, last_seen, value):
+        self.last_seen = last_seen
+        self.value = value
+
+
+class BoundedStateTable:
+    """
+    Key -> state table with idle-TTL eviction and a hard cap on the number of keys.
+
+    Keys are kept in LRU order (least recently touched first), which is also
+    "oldest window first". Every get/put expires at most `sweep_batch` idle
+    keys from the front, so eviction is amortized over the packets instead of
+    a full sweep. When the table is full, the least recently touched key goes.
+    Timestamps are the packet timestamps the detectors already work with.
+    """
+
+    SIZE_SAMPLE = 256 # keys looked at by approx_bytes()
+
+    def __init__(self, name, ttl, max_keys, sweep_batch=8, value_size=None, on_evict=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_keys = max(1, max_keys)
+        self.sweep_batch = max(1, sweep_batch)
+        self.value_size = value_size or sys.getsizeof
+        self.on_evict = on_evict # called with the value of every key evicted by TTL or cap
+        self._data = OrderedDict()
+
+        # Statistics
+        self.evicted_ttl = 0
+        self.evicted_cap = 0
+        self._last_bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, now):
+        """Return the state of `key` (and mark it as used), or None if there is none."""
+        self._expire(now)
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        entry.last_seen = now
+        self._data.move_to_end(key)
+        return entry.value
+
+    def put(self, key, value, now):
+        """Store new state for `key`, evicting the least recently used key if we're full."""
+        self._expire(now)
+        data = self._data
+        if key in data:
+            entry = data[key]
+            entry.last_seen = now
+            entry.value = value
+            data.move_to_end(key)
+            return
+        data[key] = _Entry(now, value)
+        if len(data) > self.max_keys:
+            _, evicted = data.popitem(last=False)
+            self.evicted_cap += 1
+            if self.on_evict is not None:
+                self.on_evict(evicted.value)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry.value
+
+    def pop_oldest(self):
+        """Remove the least recently used key, returns its value (None when empty). Counted as a cap eviction."""
+        if not self._data:
+            return None
+        _, entry = self._data.popitem(last=False)
+        self.evicted_cap += 1
+        return entry.value
+
+    def items(self):
+        """(key, value) pairs, least recently used first. Don't mutate the table while iterating."""
+        return ((key, entry.value) for key, entry in self._data.items())
+
+    def _expire(self, now):
+        data = self._data
+        limit = now - self.ttl
+        for _ in range(self.sweep_batch):
+            if not data:
+                return
+            entry = next(iter(data.values()))
+            if entry.last_seen >= limit:
+                return
+            data.popitem(last=False)
+            self.evicted_ttl += 1
+            if self.on_evict is not None:
+                self.on_evict(entry.value)
+
+    def expire_all(self, now):
+        """Full sweep, for the maintenance thread / shutdown, not for the packet path."""
+        while self._data:
+            before = self.evicted_ttl
+            self._expire(now)
+            if self.evicted_ttl == before:
+                return
+
+    def approx_bytes(self):
+        """
+        Rough memory used by the table: dict overhead plus the size of a
+        sample of entries scaled to the number of keys.
+        """
+        try:
+            count = len(self._data)
+            if not count:
+                self._last_bytes = sys.getsizeof(self._data)
+                return self._last_bytes
+            sample = 0
+            seen = 0
+            for key, entry in itertools.islice(self._data.items(), self.SIZE_SAMPLE):
+                sample += sys.getsizeof(key) + sys.getsizeof(entry) + self.value_size(entry.value)
+                seen += 1
+            self._last_bytes = sys.getsizeof(self._data) + sample * count // max(1, seen)
+        except RuntimeError:
+            # the packet thread changed the table under us, keep the previous estimate.
+            pass
+        return self._last_bytes
+
+    def stats(self):
+        return {
+            "live_keys": len(self._data),
+            "evicted_ttl": self.evicted_ttl,
+            "evicted_cap": self.evicted_cap,
+            "approx_bytes": self.approx_bytes(),
+        }
+
+
+class SlidingWindowCounter:
+    """
+    Packets seen in the last `window` seconds, in constant memory.
+
+    The window is split into `slices` time slices kept in a small ring (plus
+    the slice being filled). Adding a packet is O(1): bump the current slice,
+    zero the slices we moved past. The count is the sum of the ring, with the
+    oldest slice weighted by how much of it is still inside the window, so a
+    steady rate is counted the same as the old per-packet deque. It is an
+    estimate though: it's off by at most the packets of one slice around the
+    window edge, so bursty traffic near a threshold can alert on different
+    packets than the exact counter. Opt-in (counter_slices > 0), more slices =
+    closer to the exact count, at 4 bytes per slice.
+    """
+
+    __slots__ = ("slice_width", "ring_size", "counts", "current", "total")
+
+    def __init__(self, window, slices, timestamp):
+        self.slice_width = window / slices
+        self.ring_size = slices + 1
+        self.counts = array('I', bytes(4 * self.ring_size))
+        self.current = int(timestamp // self.slice_width) # absolute index of the slice being filled
+        self.total = 0
+
+    def add(self, timestamp, weight=1):
+        """Count `weight` packets at `timestamp` (1 unless sampled), return the estimated count in the window."""
+        width = self.slice_width
+        index = int(timestamp // width)
+        counts = self.counts
+        ring_size = self.ring_size
+
+        if index > self.current:
+            steps = index - self.current
+            if steps >= ring_size:
+                for slot in range(ring_size):
+                    counts[slot] = 0
+                self.total = 0
+            else:
+                for step in range(1, steps + 1):
+                    slot = (self.current + step) % ring_size
+                    self.total -= counts[slot]
+                    counts[slot] = 0
+            self.current = index
+        # a late (out of order) packet is simply counted in the current slice
+
+        counts[self.current % ring_size] += weight
+        self.total += weight
+
+        # the oldest slice only partly overlaps the window
+        oldest = counts[(self.current + 1) % ring_size]
+        if not oldest:
+            return self.total
+        inside = 1.0 - (timestamp / width - self.current)
+        if inside < 0.0:
+            inside = 0.0
+        elif inside > 1.0:
+            inside = 1.0
+        return self.total - oldest + oldest * inside
+
+    def size_bytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.counts)
+
+
+class ExactWindowCounter:
+    """
+    The original per-packet deque (one timestamp per packet), exact but O(window)
+    memory. Same interface as SlidingWindowCounter, used when counter_slices is 0.
+    """
+
+    __slots__ = ("window", "history")
+
+    def __init__(self, window, timestamp):
+        self.window = window
+        self.history = deque()
+
+    def add(self, timestamp, weight=1):
+        history = self.history
+        # check if there's already an item there and the difference in time is not big..
+        while history and ((timestamp - history[0]) > self.window):
+            history.popleft()
+        history.append(timestamp)
+        if weight > 1:
+            history.extend(itertools.repeat(timestamp, weight - 1))
+        return len(history)
+
+    def size_bytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.history) + len(self.history) * sys.getsizeof(1.0)
+
+
+def new_window_counter(window, slices, timestamp):
+    """Bucketed counter with `slices` slices, or the exact deque when slices is 0."""
+    if slices and slices > 0:
+        return SlidingWindowCounter(window, slices, timestamp)
+    return ExactWindowCounter(window, timestamp)
+
+
+class DistinctPortWindow:
+    """
+    Distinct destination ports seen in the last `window` seconds, exact.
+
+    Instead of one (timestamp, port) entry per packet we keep the last time
+    each port was hit, in hit order (OrderedDict). A port is "in the window"
+    exactly when its latest hit is, so expiring means popping ports from the
+    cold end, and the distinct count is just len(). O(1) per packet and the
+    memory is bounded by the number of distinct ports, not by the packet rate.
+    """
+
+    __slots__ = ("window", "last_hit")
+
+    def __init__(self, window):
+        self.window = window
+        self.last_hit = OrderedDict() # port -> timestamp of its last packet
+
+    def add(self, timestamp, port):
+        """Record a hit on `port`, return the number of distinct ports in the window."""
+        last_hit = self.last_hit
+        while last_hit:
+            oldest_port, oldest_ts = next(iter(last_hit.items()))
+            if timestamp - oldest_ts <= self.window:
+                break
+            del last_hit[oldest_port]
+
+        last_hit[port] = timestamp
+        last_hit.move_to_end(port)
+        return len(last_hit)
+
+    def size_bytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.last_hit) + len(self.last_hit) * 100
+
+
+# register index / rank of every port, shared by all the HLL windows (built on first use)
+_hll_tables = {}
+
+
+def port_hash_tables(precision):
+    tables = _hll_tables.get(precision)
+    if tables is None:
+        mask = 0xFFFFFFFF
+        rest_bits = 32 - precision
+        index = bytearray(65536)
+        rank = bytearray(65536)
+        for port in range(65536):
+            # murmur3 finalizer, good enough to spread the port numbers
+            h = (port * 0x9E3779B1) & mask
+            h ^= h >> 16
+            h = (h * 0x85EBCA6B) & mask
+            h ^= h >> 13
+            h = (h * 0xC2B2AE35) & mask
+            h ^= h >> 16
+            index[port] = h >> rest_bits
+            rank[port] = rest_bits - (h & ((1 << rest_bits) - 1)).bit_length() + 1
+        tables = _hll_tables[precision] = (bytes(index), bytes(rank))
+    return tables
+
+
+class WindowedPortHLL:
+    """
+    Approximate distinct-port count over a sliding window, fixed memory.
+
+    HyperLogLog with 2**precision one-byte registers per time slice, `slices`
+    slices per window in a ring (like SlidingWindowCounter). The max over the
+    live slices is kept incrementally together with its harmonic sum, so an
+    update and an estimate are O(1); the merged registers are only rebuilt
+    when a slice expires. Memory is (slices + 2) * 2**precision bytes per key.
+    """
+
+    __slots__ = ("slice_width", "ring_size", "m", "registers", "merged", "current",
+                 "inverse_sum", "zeros", "index", "rank")
+
+    def __init__(self, window, slices, precision, timestamp):
+        self.slice_width = window / slices
+        self.ring_size = slices + 1
+        self.m = 1 << precision
+        self.registers = bytearray(self.ring_size * self.m)
+        self.merged = bytearray(self.m)
+        self.current = int(timestamp // self.slice_width)
+        self.inverse_sum = float(self.m) # sum of 2**-register over merged, all zero for now
+        self.zeros = self.m
+        self.index, self.rank = port_hash_tables(precision)
+
+    def _rebuild(self):
+        m = self.m
+        registers = self.registers
+        merged = bytearray(m)
+        for base in range(0, len(registers), m):
+            for j in range(m):
+                if registers[base + j] > merged[j]:
+                    merged[j] = registers[base + j]
+        self.merged = merged
+        self.inverse_sum = sum(2.0 ** -r for r in merged)
+        self.zeros = merged.count(0)
+
+    def add(self, timestamp, port):
+        """Record a hit on `port`, return the estimated distinct ports in the window."""
+        m = self.m
+        index = int(timestamp // self.slice_width)
+        if index > self.current:
+            steps = min(index - self.current, self.ring_size)
+            for step in range(1, steps + 1):
+                base = ((self.current + step) % self.ring_size) * m
+                self.registers[base:base + m] = bytes(m)
+            self.current = index
+            self._rebuild()
+
+        j = self.index[port]
+        r = self.rank[port]
+        slot = (self.current % self.ring_size) * m + j
+        if self.registers[slot] < r:
+            self.registers[slot] = r
+        old = self.merged[j]
+        if old < r:
+            self.inverse_sum += 2.0 ** -r - 2.0 ** -old
+            if old == 0:
+                self.zeros -= 1
+            self.merged[j] = r
+
+        return self.estimate()
+
+    def estimate(self):
+        m = self.m
+        alpha = 0.673 if m == 16 else 0.697 if m == 32 else 0.709 if m == 64 else 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / self.inverse_sum
+        if raw <= 2.5 * m and self.zeros:
+            return m * math.log(m / self.zeros) # small range: linear counting
+        return raw
+
+    def size_bytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.registers) + sys.getsizeof(self.merged)
+
+
+def new_port_window(window, mode, timestamp, hll_slices=5, hll_precision=6):
+    """Exact distinct-port window, or the HyperLogLog one when mode is "hll"."""
+    if mode == "hll":
+        return WindowedPortHLL(window, hll_slices, hll_precision, timestamp)
+    return DistinctPortWindow(window)
@@ -0,0 +1,236 @@
+from state import BoundedStateTable
+
+# Bounded TCP stream reassembly for the signature scan.
+#
+# We don't buffer streams. Per direction of a connection we only keep the
+# last `tail_len` bytes already scanned (the longest pattern minus one), and
+# every new in-order segment is scanned as tail + new bytes. A pattern split
+# over two segments is then seen whole, and matches that lie entirely in the
+# tail (already reported with the previous segment) are skipped.
+#
+# Out-of-order segments are scanned on their own right away (so nothing is
+# ever missed compared to the per-packet scan) and parked until the gap is
+# filled, within a per-flow and a global byte budget. For retransmitted bytes
+# the first copy wins in the stream, only the new part is added to it.
+#
+# A segment only becomes part of the stream once its packet is accepted
+# (feed() stages it, commit() applies it): when a segment is dropped, its
+# retransmission is scanned after the same tail again instead of alone.
+
+SEQ_MOD = 1 << 32
+SEQ_HALF = 1 << 31
+
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+# what feed() staged for commit()
+PARK = "park"
+APPEND = "append"
+
+
+class StreamState:
+    """One direction of a TCP connection."""
+
+    __slots__ = ("next_seq", "tail", "pending", "pending_bytes")
+
+    def __init__(self, next_seq):
+        self.next_seq = next_seq  # sequence number of the next byte we expect
+        self.tail = b""           # last bytes of the contiguous stream, already scanned
+        self.pending = {}         # seq -> bytes of segments that arrived ahead of a gap
+        self.pending_bytes = 0
+
+    def memory(self):
+        return len(self.tail) + self.pending_bytes
+
+
+class StreamReassembler:
+    def __init__(self, max_flows=32768, ttl=120, max_flow_bytes=16384, max_total_bytes=32 * 1024 * 1024,
+                 sweep_batch=8):
+        """
+        Args:
+            max_flows (int): directions tracked at most (least recently used evicted first).
+            ttl (float): idle seconds before a direction is forgotten.
+            max_flow_bytes (int): out-of-order bytes parked per direction, past it the parked
+                segments are given up (they were scanned on their own already).
+            max_total_bytes (int): tails + parked segments of every direction together,
+                least recently used directions are evicted to stay under it.
+        """
+        self.max_flow_bytes = max_flow_bytes
+        self.max_total_bytes = max_total_bytes
+        self.streams = BoundedStateTable("streams", ttl, max_flows, sweep_batch,
+                                         value_size=lambda stream: 96 + stream.memory(),
+                                         on_evict=self._forget)
+        self.total_bytes = 0
+        self._staged = None # the last feed(), applied by commit()
+
+        # Statistics
+        self.in_order = 0       # segments appended to their stream
+        self.out_of_order = 0   # segments parked ahead of a gap
+        self.retransmits = 0    # segments with nothing new in them
+        self.gaps_given_up = 0  # times the parked segments of a flow were thrown away
+        self.evicted_memory = 0 # directions evicted by the global byte budget
+
+    def _forget(self, stream):
+        self.total_bytes -= stream.memory()
+
+    def open(self, info):
+        """A SYN (or SYN-ACK): start the stream of this direction from its initial sequence number."""
+        key = (info.src_ip, info.src_port, info.dst_ip, info.dst_port)
+        old = self.streams.pop(key)
+        if old is not None:
+            self._forget(old) # same 4-tuple reused by a new connection
+        stream = StreamState((info.seq + 1) % SEQ_MOD) # the SYN itself takes one sequence number
+        self.streams.put(key, stream, info.rawts)
+        return stream
+
+    def feed(self, info, tail_len):
+        """
+        Stage the payload of a TCP packet in its stream.
+
+        Returns (data, min_end, seen): scan `data`, and ignore matches ending at
+        or before `min_end` (they are in the tail and were reported already) or
+        lying inside one of the `seen` (start, end) spans (parked segments, they
+        were scanned on their own when they arrived).
+        The stream only moves on with commit(), once the packet is accepted: a
+        dropped segment is retransmitted and scanned again after the same tail.
+        """
+        self._staged = None
+        payload = info.payload
+        key = (info.src_ip, info.src_port, info.dst_ip, info.dst_port)
+        now = info.rawts
+
+        if info.tcp_flags & TCP_RST:
+            stream = self.streams.pop(key)
+            if stream is not None:
+                self._forget(stream)
+            return payload, 0, ()
+
+        seq = info.seq
+        if info.tcp_flags & TCP_SYN:
+            stream = self.open(info) # data on a SYN (TCP fast open)
+            seq = stream.next_seq
+        else:
+            stream = self.streams.get(key, now)
+        if stream is None:
+            # new stream, or one we picked up in the middle: start from this segment
+            stream = StreamState(seq)
+            self.streams.put(key, stream, now)
+
+        ahead = (seq - stream.next_seq) % SEQ_MOD
+        if ahead == 0:
+            self.in_order += 1
+            return self._stage_append(stream, bytes(payload), tail_len)
+        if ahead < SEQ_HALF:
+            # a gap before this segment: scan it alone now, keep it for when the gap is filled
+            self.out_of_order += 1
+            self._staged = (PARK, stream, seq, bytes(payload))
+            return payload, 0, ()
+        # starts before next_seq: retransmission, maybe with some new bytes at the end
+        behind = SEQ_MOD - ahead
+        if behind >= len(payload):
+            # nothing new for the stream, but scan it alone: a retransmission
+            # carrying different bytes must not slip through
+            self.retransmits += 1
+            return payload, 0, ()
+        self.in_order += 1
+        return self._stage_append(stream, bytes(payload[behind:]), tail_len)
+
+    def commit(self):
+        """The packet of the last feed() was accepted: move its stream on."""
+        staged, self._staged = self._staged, None
+        if staged is None:
+            return
+        if staged[0] is PARK:
+            _kind, stream, seq, segment = staged
+            self._park(stream, seq, segment)
+        else:
+            _kind, stream, next_seq, new_tail, used = staged
+            for seq in used:
+                segment = stream.pending.pop(seq, None)
+                if segment is not None:
+                    stream.pending_bytes -= len(segment)
+                    self.total_bytes -= len(segment)
+            self.total_bytes += len(new_tail) - len(stream.tail)
+            stream.tail = new_tail
+            stream.next_seq = next_seq
+        self._enforce_budget()
+
+    def skip(self, info):
+        """
+        The payload of this packet isn't scanned (load shedding): forget its
+        direction, the next segment starts the stream over from its own
+        sequence number instead of waiting behind a gap that never fills.
+        """
+        self._staged = None
+        stream = self.streams.pop((info.src_ip, info.src_port, info.dst_ip, info.dst_port))
+        if stream is not None:
+            self._forget(stream)
+
+    def close(self, info):
+        """Forget both directions of this packet's connection (flow cleared for the fast path)."""
+        for key in ((info.src_ip, info.src_port, info.dst_ip, info.dst_port),
+                    (info.dst_ip, info.dst_port, info.src_ip, info.src_port)):
+            stream = self.streams.pop(key)
+            if stream is not None:
+                self._forget(stream)
+
+    def _stage_append(self, stream, new, tail_len):
+        """In-order bytes (plus whatever parked segments they connect to), returns (data, min_end, seen)."""
+        tail = stream.tail
+        next_seq = (stream.next_seq + len(new)) % SEQ_MOD
+        parts = [tail, new]
+        seen = []
+        used = []
+        position = len(tail) + len(new)
+
+        # the gap may be filled now
+        while stream.pending:
+            segment = stream.pending.get(next_seq)
+            if not segment or next_seq in used:
+                break
+            used.append(next_seq)
+            parts.append(segment)
+            seen.append((position, position + len(segment)))
+            position += len(segment)
+            next_seq = (next_seq + len(segment)) % SEQ_MOD
+
+        data = b"".join(parts)
+        new_tail = data[-tail_len:] if tail_len > 0 else b""
+        self._staged = (APPEND, stream, next_seq, new_tail, used)
+        return data, len(tail), seen
+
+    def _park(self, stream, seq, segment):
+        if seq in stream.pending:
+            return
+        if stream.pending_bytes + len(segment) > self.max_flow_bytes:
+            # too much missing data for this flow, the parked segments were scanned alone already
+            self.gaps_given_up += 1
+            self.total_bytes -= stream.pending_bytes + len(stream.tail)
+            stream.pending.clear()
+            stream.pending_bytes = 0
+            stream.next_seq = (seq + len(segment)) % SEQ_MOD
+            stream.tail = b""
+            return
+        stream.pending[seq] = segment
+        stream.pending_bytes += len(segment)
+        self.total_bytes += len(segment)
+
+    def _enforce_budget(self):
+        while self.total_bytes > self.max_total_bytes and len(self.streams):
+            stream = self.streams.pop_oldest()
+            self._forget(stream)
+            self.evicted_memory += 1
+
+    def stats(self):
+        table_stats = self.streams.stats()
+        return {
+            "streams": table_stats["live_keys"],
+            "bytes": self.total_bytes,
+            "in_order": self.in_order,
+            "out_of_order": self.out_of_order,
+            "retransmits": self.retransmits,
+            "gaps_given_up": self.gaps_given_up,
+            "evicted_ttl": table_stats["evicted_ttl"],
+            "evicted_cap": table_stats["evicted_cap"],
+            "evicted_memory": self.evicted_memory,
+        }
@@ -0,0 +1,232 @@
+import os
+import socket
+import struct
+import sys
+import zlib
+from array import array
+
+from sketches import CountMinSketch, WindowSummary
+
+# Cross-sensor export of the heavy hitter windows (see sketches.py).
+#
+# Every node sends the summary of each complete window (Count-Min counters +
+# top keys, per source / destination / destination port) to a collector
+# (collector.py) which adds up the summaries of the same window from every
+# node and queue and applies global thresholds. No packet ever leaves the node.
+#
+# Wire format, version 1, all big endian:
+#
+#   header  "LKSM" | version u8 | flags u8 | tables u16 | window_start f64 | window f32
+#           | queue i32 | node: len u16 + utf-8 | chain: len u16 + utf-8
+#   table   name: len u8 + ascii | total u64 | width u32 | depth u16 | top entries u16
+#           | counters: len u32 + zlib(depth * width u32)
+#           | top entries: count u32 | error u32 | key: len u16 + utf-8
+#
+# A reader rejects versions newer than its own, flags are reserved (0).
+
+MAGIC = b"LKSM"
+VERSION = 1
+
+_HEADER = struct.Struct("!4sBBHdfi")
+_TABLE = struct.Struct("!QIHH")
+_TOP = struct.Struct("!II")
+_LEN16 = struct.Struct("!H")
+_LEN32 = struct.Struct("!I")
+_U32_MAX = 0xFFFFFFFF
+
+SPOOL_SUFFIX = ".lksm"
+
+
+class SummaryFormatError(ValueError):
+    pass
+
+
+class NodeSummary:
+    """The window summaries one node/queue sends for one window."""
+
+    __slots__ = ("node", "chain", "queue", "window_start", "window", "tables")
+
+    def __init__(self, node, chain, queue, window_start, window, tables):
+        self.node = node
+        self.chain = chain
+        self.queue = queue
+        self.window_start = window_start
+        self.window = window
+        self.tables = tables # name -> WindowSummary
+
+
+def _str16(text):
+    data = text.encode()
+    return _LEN16.pack(len(data)) + data
+
+
+def _cells_bytes(cells):
+    packed = array("I", (min(cell, _U32_MAX) for cell in cells))
+    if sys.byteorder == "little":
+        packed.byteswap()
+    return zlib.compress(packed.tobytes(), 6)
+
+
+def encode_summary(summary):
+    """NodeSummary -> bytes"""
+    parts = [_HEADER.pack(MAGIC, VERSION, 0, len(summary.tables), summary.window_start, summary.window,
+                          summary.queue),
+             _str16(summary.node), _str16(summary.chain)]
+    for name, table in summary.tables.items():
+        name_bytes = name.encode("ascii")
+        counts = table.counts
+        top = table.top[:0xFFFF]
+        cells = _cells_bytes(counts.cells)
+        parts.append(bytes([len(name_bytes)]) + name_bytes)
+        parts.append(_TABLE.pack(counts.total, counts.width, counts.depth, len(top)))
+        parts.append(_LEN32.pack(len(cells)) + cells)
+        for key, count, error in top:
+            parts.append(_TOP.pack(min(count, _U32_MAX), min(error, _U32_MAX)) + _str16(str(key)))
+    return b"".join(parts)
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def take(self, size):
+        if self.pos + size > len(self.data):
+            raise SummaryFormatError("truncated summary")
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return chunk
+
+    def unpack(self, fmt):
+        return fmt.unpack(self.take(fmt.size))
+
+    def str16(self):
+        (length,) = self.unpack(_LEN16)
+        return bytes(self.take(length)).decode()
+
+
+def decode_summary(data):
+    """bytes -> NodeSummary, SummaryFormatError if it's not one we can read."""
+    reader = _Reader(data)
+    magic, version, _flags, table_count, window_start, window, queue = reader.unpack(_HEADER)
+    if magic != MAGIC:
+        raise SummaryFormatError("not a Loki summary")
+    if version > VERSION:
+        raise SummaryFormatError(f"summary version {version} is newer than ours ({VERSION})")
+    node = reader.str16()
+    chain = reader.str16()
+
+    tables = {}
+    for _ in range(table_count):
+        name_len = reader.take(1)[0]
+        name = bytes(reader.take(name_len)).decode("ascii")
+        total, width, depth, top_count = reader.unpack(_TABLE)
+        (cells_len,) = reader.unpack(_LEN32)
+        try:
+            raw = zlib.decompress(reader.take(cells_len))
+        except zlib.error as e:
+            raise SummaryFormatError(f"bad counters for {name}: {e}")
+        if len(raw) != 4 * width * depth:
+            raise SummaryFormatError(f"{name}: {len(raw)} bytes of counters for a {depth}x{width} sketch")
+        cells = array("I")
+        cells.frombytes(raw)
+        if sys.byteorder == "little":
+            cells.byteswap()
+        counts = CountMinSketch(width, depth)
+        if counts.width != width:
+            raise SummaryFormatError(f"{name}: sketch width {width} is not a power of 2")
+        counts.cells = cells.tolist()
+        counts.total = total
+        top = []
+        for _ in range(top_count):
+            count, error = reader.unpack(_TOP)
+            top.append((reader.str16(), count, error))
+        tables[name] = WindowSummary(name, window_start, window, counts, top)
+    return NodeSummary(node, chain, queue, window_start, window, tables)
+
+
+class SummaryExporter:
+    """
+    Sends the complete windows of a TrafficSketches, called from the maintenance
+    loop (never from the packet threads). Target is a spool directory (one file
+    per summary, written atomically) or the collector's unix datagram socket.
+    """
+
+    def __init__(self, node, mode="spool", spool_dir=None, socket_path=None, error_logger=None):
+        if mode not in ("spool", "socket"):
+            raise ValueError(f"unknown summary export mode: {mode}")
+        self.node = node
+        self.mode = mode
+        self.spool_dir = spool_dir
+        self.socket_path = socket_path
+        self.error_logger = error_logger
+        self._sock = None
+        self._exported = {} # queue -> window_start of the last window sent
+
+        # Statistics
+        self.sent = 0
+        self.bytes_sent = 0
+        self.errors = 0
+
+        if mode == "spool":
+            os.makedirs(spool_dir, exist_ok=True)
+
+    def export(self, chain, queue, sketches):
+        """Send the last complete window of `sketches` if it wasn't sent yet. Returns True if it was sent."""
+        tables = {}
+        for table in sketches.tables():
+            last = table.last_window
+            if last is not None:
+                tables[table.name] = last
+        if not tables:
+            return False
+        window_start = max(table.window_start for table in tables.values())
+        # only the tables of that window (one may not have rotated yet if it saw no packet)
+        tables = {name: table for name, table in tables.items() if table.window_start == window_start}
+        if self._exported.get(queue) == window_start:
+            return False
+        self._exported[queue] = window_start
+        window = next(iter(tables.values())).window
+        data = encode_summary(NodeSummary(self.node, chain, queue, window_start, window, tables))
+        try:
+            if self.mode == "spool":
+                name = f"{self.node}-q{queue}-{int(window_start)}{SPOOL_SUFFIX}"
+                path = os.path.join(self.spool_dir, name)
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+            else:
+                if self._sock is None:
+                    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self._sock.sendto(data, self.socket_path)
+        except OSError as e:
+            # no collector running (yet) is not our problem, the next window tries again
+            self.errors += 1
+            if self.error_logger and (self.errors in (1, 10, 100) or self.errors % 1000 == 0):
+                self.error_logger.warning(f"Summary export to {self.spool_dir or self.socket_path} failed: {e}")
+            return False
+        self.sent += 1
+        self.bytes_sent += len(data)
+        return True
+
+    def stats(self):
+        return {"sent": self.sent, "bytes": self.bytes_sent, "errors": self.errors}
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def default_node_name():
+    return socket.gethostname()
+
+
+def spool_files(spool_dir):
+    """Summaries waiting in a spool directory, oldest first."""
+    try:
+        names = [name for name in os.listdir(spool_dir) if name.endswith(SPOOL_SUFFIX)]
+    except FileNotFoundError:
+        return []
+    paths = [os.path.join(spool_dir, name) for name in names]
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
@@ -1,22 +1,27 @@
 #!/bin/bash
 
-QUEUE_NUM_INPUT="100"
-QUEUE_NUM_FORWARD="200"
-
 echo "======================================================"
 echo "    LOKI IDS: SAFELY FLUSHING NFQUEUE RULES"
 echo "======================================================"
 
 # 1. IDENTIFY AND DELETE NFQUEUE RULES
-# Delete the NFQUEUE rule from the FORWARD chain
-echo "[+] Deleting NFQUEUE rule from FORWARD chain..."
-sudo iptables -D FORWARD -j NFQUEUE --queue-num $QUEUE_NUM_FORWARD 2>/dev/null 
+# Every NFQUEUE rule we installed is deleted, whatever the number of shards
+# (single queue, or one rule per source / destination address split).
+for CHAIN in FORWARD INPUT; do
+    echo "[+] Deleting NFQUEUE rules from $CHAIN chain..."
+    sudo iptables -S $CHAIN | grep -- "-j NFQUEUE" | while read -r RULE; do
+        # "-A CHAIN ..." -> "-D CHAIN ..."
+        eval "sudo iptables -D ${RULE#-A }" 2>/dev/null
+    done
+done
 
-# Delete the NFQUEUE rule from the INPUT chain
-echo "[+] Deleting NFQUEUE rule from INPUT chain..."
-sudo iptables -D INPUT -j NFQUEUE --queue-num $QUEUE_NUM_INPUT 2>/dev/null
+# 2. KERNEL DROP SET (enforcement.py), whichever backend made it
+echo "[+] Removing the Loki drop sets (if any)..."
+sudo iptables -t raw -D PREROUTING -m set --match-set "${LOKI_SET:-blocked}" src -j DROP 2>/dev/null
+sudo ipset destroy "${LOKI_SET:-blocked}" 2>/dev/null
+sudo nft delete table inet "${LOKI_TABLE:-loki}" 2>/dev/null
 
-# 2. VERIFICATION
+# 3. VERIFICATION
 echo "[+] Remaining NFQUEUE rules (should be empty):"
 sudo iptables -L --line-numbers | grep NFQUEUE
 echo "------------------------------------------------------"
@@ -2,6 +2,23 @@
 QUEUE_NUM_INPUT="100" # for the input chain
 QUEUE_NUM_FORWARD="200" # for the forward chain
 
+# Number of queues per chain (must match `--shards` / sharding.shards of nfqueue_app.py).
+# With more than 1 shard every queue gets its own worker process:
+#  - FORWARD is split on the low bits of the destination address (u32 match), so both
+#    the (src, dst) scan windows and the per-destination flood windows stay whole.
+#  - INPUT is split on the low bits of the source address. The destination is always
+#    the Pi, splitting on it would put everything in one queue. A scanner always lands
+#    in the same shard, but a flood on the Pi (spoofed sources) is spread over all N:
+#    each shard sees ~1/N of it, so the INPUT workers fire on 1/N of the flood and
+#    dst/dst_port heavy hitter thresholds. Trade-off: a flood from a few sources that
+#    all hash to one shard fires at ~1/N of the configured rate.
+LOKI_SHARDS="${LOKI_SHARDS:-1}"
+
+if ! [[ "$LOKI_SHARDS" =~ ^[0-9]+$ ]] || [ "$LOKI_SHARDS" -lt 1 ] || [ $(( LOKI_SHARDS & (LOKI_SHARDS - 1) )) -ne 0 ]; then
+    echo "[!] LOKI_SHARDS must be a power of two (1, 2, 4, 8...), got '$LOKI_SHARDS'"
+    exit 1
+fi
+
 echo "======================================================"
 echo "    LOKI IDS: SETTING UP IPTABLES FOR ROUTING"
 echo "======================================================"
@@ -11,16 +28,42 @@ echo "[1/3] Enabling IP forwarding..."
 sudo sysctl -w net.ipv4.ip_forward=1
 
 # 2. ADD NFQUEUE RULES (Insert at the top of the chain: -I)
-# We target the FORWARD chain for traffic passing through the Pi.
-echo "[2/3] Inserting NFQUEUE rule to FORWARD chain with bypass..."
-sudo iptables -I FORWARD -j NFQUEUE --queue-num $QUEUE_NUM_FORWARD --queue-bypass
+if [ "$LOKI_SHARDS" -eq 1 ]; then
+    # We target the FORWARD chain for traffic passing through the Pi.
+    echo "[2/3] Inserting NFQUEUE rule to FORWARD chain with bypass..."
+    sudo iptables -I FORWARD -j NFQUEUE --queue-num $QUEUE_NUM_FORWARD --queue-bypass
+
+    # We also insert the rule into the INPUT chain to inspect traffic aimed at the Pi itself.
+    echo "[2/3] Inserting NFQUEUE rule to INPUT chain (for traffic to the Pi itself) with bypass also..."
+    sudo iptables -I INPUT -j NFQUEUE --queue-num $QUEUE_NUM_INPUT --queue-bypass
+
+    QUEUES_FORWARD="$QUEUE_NUM_FORWARD"
+    QUEUES_INPUT="$QUEUE_NUM_INPUT"
+else
+    LAST_INPUT=$(( QUEUE_NUM_INPUT + LOKI_SHARDS - 1 ))
+    LAST_FORWARD=$(( QUEUE_NUM_FORWARD + LOKI_SHARDS - 1 ))
+    MASK=$(( LOKI_SHARDS - 1 ))
+
+    echo "[2/3] Inserting $LOKI_SHARDS NFQUEUE rules to FORWARD chain (split by destination address) with bypass..."
+    for (( i = 0; i < LOKI_SHARDS; i++ )); do
+        # offset 16 of the IP header is the destination address
+        sudo iptables -I FORWARD -m u32 --u32 "16&0x$(printf '%08x' $MASK)=0x$(printf '%x' $i)" \
+            -j NFQUEUE --queue-num $(( QUEUE_NUM_FORWARD + i )) --queue-bypass
+    done
+
+    echo "[2/3] Inserting $LOKI_SHARDS NFQUEUE rules to INPUT chain (split by source address) with bypass..."
+    for (( i = 0; i < LOKI_SHARDS; i++ )); do
+        # offset 12 of the IP header is the source address
+        sudo iptables -I INPUT -m u32 --u32 "12&0x$(printf '%08x' $MASK)=0x$(printf '%x' $i)" \
+            -j NFQUEUE --queue-num $(( QUEUE_NUM_INPUT + i )) --queue-bypass
+    done
 
-# We also insert the rule into the INPUT chain to inspect traffic aimed at the Pi itself.
-echo "[2/3] Inserting NFQUEUE rule to INPUT chain (for traffic to the Pi itself) with bypass also..."
-sudo iptables -I INPUT -j NFQUEUE --queue-num $QUEUE_NUM_INPUT --queue-bypass
+    QUEUES_FORWARD="$QUEUE_NUM_FORWARD-$LAST_FORWARD"
+    QUEUES_INPUT="$QUEUE_NUM_INPUT-$LAST_INPUT"
+fi
 
 # 3. VERIFICATION
-echo "[3/3] Rules set. Packets will now be sent to Queue $QUEUE_NUM_FORWARD & $QUEUE_NUM_INPUT."
+echo "[3/3] Rules set. Packets will now be sent to Queue(s) $QUEUES_FORWARD & $QUEUES_INPUT."
 
 echo " *** Printing the iptables rules *** "
 
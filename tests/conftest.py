@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# the Loki modules import each other flat (from logger import logger), like when run from Core/loki
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LOKI_DIR = os.path.join(os.path.dirname(TESTS_DIR), "Core", "loki")
+sys.path.insert(0, LOKI_DIR)
+os.environ.setdefault("LOKI_CONFIG", os.path.join(TESTS_DIR, "loki_test_config.yaml"))
+
+from logger import logger  # noqa: E402
+
+# alerts / system events raised by the tests go to a throwaway directory, not logs/
+logger.log_dir = tempfile.mkdtemp(prefix="loki-tests-")
+logger.set_log_file("test_alerts.jsonl", "test_system.jsonl")
@@ -0,0 +1,56 @@
+import random
+
+from aho_corasick import AhoCorasick
+
+
+def naive_findall(patterns, data, nocase=False):
+    if nocase:
+        patterns = [p.lower() for p in patterns]
+        data = data.lower()
+    matches = []
+    for pattern_id, pattern in enumerate(patterns):
+        if not pattern:
+            continue
+        start = data.find(pattern)
+        while start != -1:
+            matches.append((pattern_id, start + len(pattern)))
+            start = data.find(pattern, start + 1)
+    return sorted(matches, key=lambda m: (m[1], m[0]))
+
+
+def test_overlapping_and_nested_patterns():
+    patterns = [b"he", b"she", b"his", b"hers"]
+    matcher = AhoCorasick(patterns)
+    data = b"ushers and his shed"
+    assert sorted(matcher.findall(data), key=lambda m: (m[1], m[0])) == naive_findall(patterns, data)
+
+
+def test_end_offsets():
+    matcher = AhoCorasick([b"/etc/passwd"])
+    data = b"GET /../../etc/passwd HTTP/1.1"
+    assert matcher.findall(data) == [(0, data.index(b"passwd") + len(b"passwd"))]
+
+
+def test_nocase_shares_byte_classes():
+    patterns = [b"SELECT", b"union"]
+    matcher = AhoCorasick(patterns, nocase=True)
+    data = b"id=1 UnIoN sElEcT *"
+    assert sorted(p for p, _end in matcher.findall(data)) == [0, 1]
+    assert AhoCorasick(patterns).findall(data) == []
+
+
+def test_empty_patterns_and_data():
+    assert AhoCorasick([]).findall(b"anything") == []
+    assert AhoCorasick([b""]).findall(b"anything") == []
+    assert AhoCorasick([b"abc"]).findall(b"") == []
+
+
+def test_matches_the_naive_search_on_random_input():
+    rng = random.Random(7)
+    alphabet = b"abcd\x00\xff"
+    for _ in range(50):
+        patterns = [bytes(rng.choice(alphabet) for _ in range(rng.randint(1, 5))) for _ in range(rng.randint(1, 8))]
+        data = bytes(rng.choice(alphabet) for _ in range(rng.randint(0, 300)))
+        matcher = AhoCorasick(patterns)
+        found = sorted(set(matcher.findall(data)), key=lambda m: (m[1], m[0]))
+        assert found == sorted(set(naive_findall(patterns, data)), key=lambda m: (m[1], m[0]))
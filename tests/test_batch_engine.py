@@ -0,0 +1,20 @@
+import pytest
+
+import replay
+
+np = pytest.importorskip("numpy") # batch_engine is the only numpy user
+import batch_engine  # noqa: E402
+
+
+@pytest.mark.parametrize("name, packets, code", [
+    ("syn_scan", lambda: replay.synth_syn_scan(count=600), batch_engine.PORT_SCAN),
+    ("udp_flood", lambda: replay.synth_udp_flood(count=3000), batch_engine.UDP_FLOOD),
+])
+def test_cross_check_matches_the_live_detectors(tmp_path, name, packets, code):
+    path = str(tmp_path / f"{name}.pcap")
+    replay.write_pcap(path, packets())
+    result = batch_engine.analyze([path])
+    check = batch_engine.cross_check([path], result)
+    assert check["identical"], check
+    assert check["batch_hits"] == check["live_hits"] > 0
+    assert set(result.codes.tolist()) == {code}
@@ -0,0 +1,138 @@
+import time
+
+import replay
+from blocklist import IPBlocklist, FOREVER
+
+
+def ip(address):
+    a, b, c, d = map(int, address.split("."))
+    return (a << 24) | (b << 16) | (c << 8) | d
+
+
+def header(src, dst):
+    return replay.build_udp(src, dst, 1234, 53, b"x")
+
+
+def test_host_and_cidr_lookups():
+    blocklist = IPBlocklist()
+    blocklist.block("198.51.100.7")
+    blocklist.block("203.0.113.0/24")
+    now = time.time()
+
+    assert blocklist.lookup(ip("198.51.100.7"), now) is not None
+    assert blocklist.lookup(ip("198.51.100.8"), now) is None
+    assert blocklist.lookup(ip("203.0.113.0"), now) is not None
+    assert blocklist.lookup(ip("203.0.113.255"), now) is not None
+    assert blocklist.lookup(ip("203.0.114.0"), now) is None
+    assert blocklist.lookup(ip("203.0.112.255"), now) is None
+
+
+def test_nested_cidrs_keep_the_longer_block():
+    blocklist = IPBlocklist()
+    blocklist.block("10.0.0.0/8", ttl=60, reason="outer")
+    blocklist.block("10.1.0.0/16", reason="inner")     # permanent, outlives the /8
+    blocklist.block("10.2.0.0/16", ttl=10, reason="short") # covered by the /8 anyway
+    now = time.time()
+
+    assert blocklist.lookup(ip("10.1.2.3"), now).reason == "inner"
+    assert blocklist.lookup(ip("10.2.2.3"), now).reason == "outer"
+    assert blocklist.lookup(ip("10.3.2.3"), now).reason == "outer"
+    # past the /8's TTL only the permanent /16 is left
+    assert blocklist.lookup(ip("10.1.2.3"), now + 120).reason == "inner"
+    assert blocklist.lookup(ip("10.3.2.3"), now + 120) is None
+
+
+def test_ttl_expiry_and_sweep():
+    blocklist = IPBlocklist()
+    blocklist.block("192.0.2.1", ttl=30)
+    blocklist.block("192.0.2.0/28", ttl=30)
+    later = time.time() + 60
+    assert blocklist.lookup(ip("192.0.2.1"), later) is None
+    assert blocklist.lookup(ip("192.0.2.5"), later) is None
+
+    for entry in list(blocklist.hosts.values()) + list(blocklist.networks.values()):
+        entry.expires = time.time() - 1
+    assert blocklist.sweep() == 2
+    assert len(blocklist) == 0
+
+
+def test_blocks_are_extended_never_shortened():
+    blocklist = IPBlocklist()
+    blocklist.block("192.0.2.1", ttl=600)
+    expires = blocklist.hosts[ip("192.0.2.1")].expires
+    blocklist.block("192.0.2.1", ttl=10)
+    assert blocklist.hosts[ip("192.0.2.1")].expires == expires
+    blocklist.block("192.0.2.1")
+    assert blocklist.hosts[ip("192.0.2.1")].expires == FOREVER
+
+
+def test_never_block_and_cap_refuse_automatic_blocks():
+    blocklist = IPBlocklist(max_entries=1, never_block=["192.168.0.0/16"])
+    assert not blocklist.block("192.168.1.1", ttl=60, automatic=True)
+    assert not blocklist.block("192.0.0.0/8", ttl=60, automatic=True) # would cover the LAN
+    assert blocklist.block("198.51.100.1", ttl=60, automatic=True)
+    assert not blocklist.block("198.51.100.2", ttl=60, automatic=True) # full
+    assert blocklist.refused == 3
+
+
+def test_unblock():
+    blocklist = IPBlocklist()
+    blocklist.block("203.0.113.0/24")
+    assert blocklist.unblock("203.0.113.0/24")
+    assert blocklist.lookup(ip("203.0.113.9"), time.time()) is None
+    assert not blocklist.unblock("203.0.113.0/24")
+
+
+def test_check_header_source_and_destination():
+    blocklist = IPBlocklist()
+    blocklist.block("198.51.100.7")
+    now = time.time()
+    assert blocklist.check_header(header("198.51.100.7", "192.0.2.1"), now) is not None
+    # traffic *to* a blocked address only when asked for
+    assert blocklist.check_header(header("192.0.2.1", "198.51.100.7"), now) is None
+    assert blocklist.check_header(header("192.0.2.1", "198.51.100.7"), now, match_destination=True) is not None
+    assert blocklist.check_header(b"\x60" + bytes(39), now) is None # IPv6
+
+
+def _replay(tmp_path, name, packets):
+    path = tmp_path / f"{name}.pcap"
+    replay.write_pcap(str(path), packets)
+    return replay.replay([str(path)])
+
+
+def test_floods_never_block_their_sources(tmp_path):
+    report = _replay(tmp_path, "flood", replay.synth_udp_flood(count=3000, sources=64))
+    assert any("UDP Flood" in message for message in report["alerts_by_message"])
+    assert report["blocklist"]["hosts"] == 0
+    assert report["verdicts"]["DROP"] == 0
+
+
+def test_signature_drop_blocks_an_established_source(tmp_path):
+    report = _replay(tmp_path, "split", replay.synth_split_attack(count=4))
+    assert report["blocklist"]["hosts"] == 1
+
+
+def test_signature_drop_without_handshake_does_not_block(tmp_path):
+    # one spoofable segment out of nowhere: dropped, but its source isn't trusted enough to block
+    packets = [(1700000000.0, replay.build_tcp("198.51.100.9", "10.0.0.1", 40000, 80, 0x18,
+                                               b"GET /../../etc/passwd HTTP/1.1\r\n\r\n", seq=1000))]
+    report = _replay(tmp_path, "midstream", packets)
+    assert report["verdicts"]["DROP"] == 1
+    assert report["blocklist"]["hosts"] == 0
+
+
+def test_forged_handshake_does_not_block(tmp_path):
+    # a blind spoofer: SYN, then an ACK + payload without ever seeing the SYN-ACK
+    src, dst = "198.51.100.9", "10.0.0.1"
+    payload = b"GET /../../etc/passwd HTTP/1.1\r\n\r\n"
+    packets = [(1700000000.0, replay.build_tcp(src, dst, 40000, 80, 0x02, seq=1000)),
+               (1700000000.1, replay.build_tcp(src, dst, 40000, 80, 0x18, payload, seq=1001, ack=777))]
+    report = _replay(tmp_path, "forged", packets)
+    assert report["verdicts"]["DROP"] == 1
+    assert report["blocklist"]["hosts"] == 0
+
+    # same thing with the responder's SYN-ACK acknowledged: a real client
+    packets[1:1] = [(1700000000.01, replay.build_tcp(dst, src, 80, 40000, 0x12, seq=5000, ack=1001)),
+                    (1700000000.02, replay.build_tcp(src, dst, 40000, 80, 0x10, seq=1001, ack=5001))]
+    report = _replay(tmp_path, "handshake", packets)
+    assert report["blocklist"]["hosts"] == 1
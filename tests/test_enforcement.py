@@ -0,0 +1,106 @@
+from enforcement import DryRunBackend, Enforcer, EnforcementError, NftablesBackend
+
+
+class Clock:
+    def __init__(self, now=1700000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def enforcer(**options):
+    clock = Clock()
+    backend = DryRunBackend(clock=clock)
+    return Enforcer(backend, clock=clock, **options), backend, clock
+
+
+def test_offenders_are_pushed_in_batches():
+    enforce, backend, _clock = enforcer(max_batch=4)
+    for i in range(10):
+        assert enforce.offend(f"198.51.100.{i}", 60)
+    assert enforce.backlog == 10
+    # nothing reaches the backend before flush
+    assert backend.batches == []
+    assert enforce.flush() == 10
+    assert [len(entries) for kind, entries in backend.batches] == [4, 4, 2]
+    assert enforce.backlog == 0 and enforce.stats()["enforced"] == 10
+    # already in the set: not pushed again
+    enforce.offend("198.51.100.3", 30)
+    assert enforce.flush() == 0
+
+
+def test_entries_expire_with_their_ttl():
+    enforce, backend, clock = enforcer()
+    enforce.offend("198.51.100.7", 60)
+    enforce.offend("192.0.2.0/24", 0) # permanent
+    enforce.flush()
+    clock.now += 61
+    assert not backend.contains("198.51.100.7")
+    assert backend.contains("192.0.2.0/24")
+    enforce.flush()
+    assert list(enforce.enforced) == ["192.0.2.0/24"]
+    # gone from the kernel, so it's pushed again
+    enforce.offend("198.51.100.7", 60)
+    assert enforce.flush() == 1 and backend.contains("198.51.100.7")
+
+
+def test_extending_an_entry_replaces_its_timeout():
+    enforce, backend, clock = enforcer()
+    enforce.offend("198.51.100.7", 60)
+    enforce.flush()
+    enforce.offend("198.51.100.7", 600)
+    assert enforce.flush() == 1
+    assert backend.entries["198.51.100.7"] == clock.now + 600
+    assert enforce.enforced["198.51.100.7"] == clock.now + 600
+    # the kernel and the Enforcer agree on when it goes
+    clock.now += 300
+    assert backend.contains("198.51.100.7")
+
+
+def test_refresh_is_one_nft_transaction():
+    backend = NftablesBackend()
+    assert backend.add_script([("198.51.100.7", 600), ("192.0.2.1", 0)], ["198.51.100.7"]) == (
+        "delete element inet loki blocked { 198.51.100.7 }\n"
+        "add element inet loki blocked { 198.51.100.7 timeout 600s, 192.0.2.1 }\n")
+    assert backend.add_script([("192.0.2.1", 60)]) == "add element inet loki blocked { 192.0.2.1 timeout 60s }\n"
+
+
+def test_failed_refresh_falls_back_to_a_plain_add():
+    class Forgetful(DryRunBackend):
+        # the entry was deleted behind our back, nft refuses to delete it again
+        def add(self, entries, refresh=()):
+            if refresh:
+                raise EnforcementError("No such file or directory")
+            super().add(entries, refresh)
+
+    clock = Clock()
+    backend = Forgetful(clock=clock)
+    enforce = Enforcer(backend, clock=clock)
+    enforce.offend("198.51.100.7", 60)
+    enforce.flush()
+    backend.entries.clear()
+    enforce.offend("198.51.100.7", 600)
+    assert enforce.flush() == 1
+    assert backend.entries["198.51.100.7"] == clock.now + 600
+    assert enforce.errors == 1
+
+
+def test_never_block_is_refused():
+    enforce, backend, _clock = enforcer(never_block=["10.0.0.0/8", "192.0.2.1"])
+    assert not enforce.offend("10.1.2.3", 60)
+    assert not enforce.offend("192.0.2.0/24", 60) # overlaps a never_block address
+    assert not enforce.offend("not an address", 60)
+    assert enforce.offend("192.0.2.2", 60)
+    enforce.flush()
+    assert list(backend.active()) == ["192.0.2.2"]
+    assert enforce.refused == 3
+
+
+def test_setup_can_run_twice():
+    script = NftablesBackend(table="loki", set_name="blocked").setup_script()
+    lines = script.splitlines()
+    # "add" of what exists is a no-op, the rule goes into a flushed chain: no list-then-create race
+    assert all(line.startswith(("add ", "flush chain")) for line in lines)
+    assert lines.index("flush chain inet loki prerouting") < lines.index(
+        "add rule inet loki prerouting ip saddr @blocked drop")
@@ -0,0 +1,146 @@
+import pytest
+
+import nfqueue_app
+import replay
+from flow_cache import (FLOW_BENIGN, FLOW_DROP, FLOW_INSPECT, TCP_CLOSING, TCP_ESTABLISHED, TCP_MIDSTREAM, TCP_NEW,
+                        FlowCache)
+from packet_parser import decode_packet
+from signature_engine import SignatureScanning
+
+RULES = """
+signatures:
+  - name: "passwd"
+    pattern: "/etc/passwd"
+    action: "drop"
+"""
+
+START = 1700000000.0
+CLIENT = ("198.51.100.9", "10.0.0.1", 40000, 80)
+SERVER = ("10.0.0.1", "198.51.100.9", 80, 40000)
+
+
+def tcp(ends, flags, payload=b"", seq=0, ack=0, ts=START):
+    return decode_packet(replay.build_tcp(*ends, flags, payload, seq=seq, ack=ack), ts)
+
+
+def handshake(cache, server_isn=5000):
+    flow = cache.lookup(tcp(CLIENT, 0x02, seq=999))
+    cache.lookup(tcp(SERVER, 0x12, seq=server_isn, ack=1000))
+    return flow
+
+
+def test_verified_handshake_is_established():
+    cache = FlowCache()
+    flow = handshake(cache)
+    assert flow.tcp_state == TCP_NEW
+    cache.lookup(tcp(CLIENT, 0x10, seq=1000, ack=5001))
+    assert flow.tcp_state == TCP_ESTABLISHED
+    cache.lookup(tcp(SERVER, 0x11, seq=5001, ack=1000))
+    assert flow.tcp_state == TCP_CLOSING
+
+
+def test_responder_data_establishes_the_flow():
+    cache = FlowCache()
+    flow = handshake(cache)
+    cache.lookup(tcp(SERVER, 0x18, b"220 ready\r\n", seq=5001, ack=1000))
+    assert flow.tcp_state == TCP_ESTABLISHED
+
+
+def test_spoofed_handshake_stays_new():
+    cache = FlowCache()
+    # a blind spoofer: no SYN-ACK seen, then an ACK with data
+    flow = cache.lookup(tcp(CLIENT, 0x02, seq=999))
+    cache.lookup(tcp(CLIENT, 0x18, b"GET / HTTP/1.1\r\n", seq=1000, ack=1))
+    assert flow.tcp_state == TCP_NEW
+    # the SYN-ACK went to the real owner of the address, the guess is wrong
+    cache.lookup(tcp(SERVER, 0x12, seq=5000, ack=1000))
+    cache.lookup(tcp(CLIENT, 0x10, seq=1016, ack=4242))
+    assert flow.tcp_state == TCP_NEW
+    # and the client can't pass its own packets off as the responder's SYN-ACK
+    other = cache.lookup(tcp(CLIENT[:2] + (40001, 80), 0x02, seq=1))
+    cache.lookup(tcp(CLIENT[:2] + (40001, 80), 0x12, seq=7))
+    cache.lookup(tcp(CLIENT[:2] + (40001, 80), 0x10, seq=2, ack=8))
+    assert other.tcp_state == TCP_NEW
+
+
+def test_midstream_flow():
+    cache = FlowCache()
+    flow = cache.lookup(tcp(CLIENT, 0x18, b"data", seq=1000, ack=5001))
+    assert flow.tcp_state == TCP_MIDSTREAM
+    cache.lookup(tcp(SERVER, 0x18, b"more", seq=5001, ack=1004))
+    assert flow.tcp_state == TCP_MIDSTREAM
+
+
+def test_verdicts():
+    cache = FlowCache(inspect_bytes=100)
+    flow = cache.lookup(tcp(CLIENT, 0x02, seq=999))
+    assert flow.verdict == FLOW_INSPECT
+    cache.inspected(flow, 60)
+    assert flow.verdict == FLOW_INSPECT
+    cache.inspected(flow, 60)
+    assert flow.verdict == FLOW_BENIGN
+    # a RST forgets a flow, unless it's marked DROP
+    cache.lookup(tcp(SERVER, 0x14, seq=5001))
+    assert len(cache.flows) == 0
+    flow = cache.lookup(tcp(CLIENT, 0x02, seq=999))
+    cache.mark_drop(flow)
+    cache.lookup(tcp(CLIENT, 0x04, seq=1000))
+    assert cache.lookup(tcp(CLIENT, 0x02, seq=999)).verdict == FLOW_DROP
+
+
+def test_lru_cap_and_ttl():
+    cache = FlowCache(max_flows=3, ttl=10)
+    for port in (1, 2, 3):
+        cache.lookup(tcp(("198.51.100.9", "10.0.0.1", port, 80), 0x02))
+    cache.lookup(tcp(("198.51.100.9", "10.0.0.1", 1, 80), 0x10)) # 1 is used again, 2 is the oldest now
+    cache.lookup(tcp(("198.51.100.9", "10.0.0.1", 4, 80), 0x02))
+    assert [port for port in (1, 2, 3, 4)
+            if FlowCache.flow_key(tcp(("198.51.100.9", "10.0.0.1", port, 80), 0x10)) in cache.flows] == [1, 3, 4]
+    assert cache.stats()["evicted_cap"] == 1
+    # idle past the TTL
+    cache.lookup(tcp(("198.51.100.9", "10.0.0.1", 5, 80), 0x02, ts=START + 11))
+    stats = cache.stats()
+    assert stats["flows"] == 1 and stats["evicted_ttl"] == 3
+
+
+def test_hit_miss_statistics():
+    cache = FlowCache()
+    handshake(cache)
+    cache.lookup(tcp(CLIENT, 0x10, seq=1000, ack=5001))
+    cache.lookup(tcp(("192.0.2.1", "10.0.0.1", 1234, 80), 0x02))
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["flows"]) == (2, 2, 2)
+    assert stats["hit_rate"] == 0.5
+
+
+@pytest.fixture
+def scanner(tmp_path):
+    path = tmp_path / "rules.yaml"
+    path.write_text(RULES)
+    return SignatureScanning(str(path))
+
+
+def test_pipeline_fast_path_and_drop(scanner, monkeypatch):
+    monkeypatch.setattr(nfqueue_app, "blocklist", None)
+    cache = FlowCache(inspect_bytes=32)
+    detector = nfqueue_app.PortScanningDetector(15, 10)
+    metrics = nfqueue_app.ChainMetrics("FORWARD", 0)
+
+    def send(ends, flags, payload=b"", seq=0, ack=0):
+        packet = replay.ReplayPacket(seq, replay.build_tcp(*ends, flags, payload, seq=seq, ack=ack), START)
+        nfqueue_app.process_packet(packet, False, detector, scanner, cache, metrics=metrics)
+        return packet.verdict
+
+    send(CLIENT, 0x02, seq=999)
+    send(SERVER, 0x12, seq=5000, ack=1000)
+    assert send(CLIENT, 0x18, b"A" * 40, seq=1000, ack=5001) == "ACCEPT"
+    # inspected enough: BENIGN, the rest takes the fast path (even a payload that would match)
+    assert send(CLIENT, 0x18, b"/etc/passwd", seq=1040, ack=5001) == "ACCEPT"
+    assert cache.fast_path == 1
+
+    other = ("198.51.100.9", "10.0.0.1", 40001, 80)
+    send(other, 0x02, seq=1)
+    assert send(other, 0x18, b"GET /etc/passwd", seq=2) == "DROP"
+    # the flow is DROP now: dropped before any analysis
+    assert send(other, 0x18, b"harmless", seq=17) == "DROP"
+    assert cache.dropped == 1
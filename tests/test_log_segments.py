@@ -0,0 +1,97 @@
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+from log_segments import SegmentedLog, all_segments, closed_segments, read_index, read_range
+
+START = 1700000000.0
+
+
+def record(ts, i):
+    stamp = datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat()
+    return {"timestamp": stamp, "i": i}
+
+
+def write_log(path, count=400, every=10.0, batch=5, **options):
+    log = SegmentedLog(str(path), **options)
+    for first in range(0, count, batch):
+        lines = b"".join(json.dumps(record(START + i * every, i)).encode() + b"\n"
+                         for i in range(first, first + batch))
+        log.write(lines, START + first * every)
+    log.close()
+    return log
+
+
+def test_rotation_keeps_every_record_in_order(tmp_path):
+    path = tmp_path / "loki-alerts.jsonl" # dashes in the base name
+    log = write_log(path, segment_bytes=4096, index_interval=512, retention_bytes=0)
+    assert log.rotations > 3
+    segments = all_segments(str(path))
+    assert segments[-1] == str(path)
+    assert all(segment.endswith(".jsonl.gz") for segment in segments[:-1])
+    assert [r["i"] for r in read_range(str(path))] == list(range(400))
+
+
+def test_segment_names_sort_by_time_then_sequence(tmp_path):
+    names = ["loki-alerts-20240102-000000.jsonl.gz", "loki-alerts-20240101-120000-10.jsonl.gz",
+             "loki-alerts-20240101-120000-9.jsonl", "loki-alerts-20240101-120000.jsonl.gz",
+             "loki-alerts-old.jsonl", "loki-alerts-x-20240101-000000.jsonl"]
+    for name in names:
+        (tmp_path / name).write_bytes(b"")
+    assert [os.path.basename(s) for s in closed_segments(str(tmp_path / "loki-alerts.jsonl"))] == [
+        "loki-alerts-20240101-120000.jsonl.gz", "loki-alerts-20240101-120000-9.jsonl",
+        "loki-alerts-20240101-120000-10.jsonl.gz", "loki-alerts-20240102-000000.jsonl.gz"]
+    # another log whose name starts with ours isn't one of our segments
+    assert [os.path.basename(s) for s in closed_segments(str(tmp_path / "loki-alerts-x.jsonl"))] == [
+        "loki-alerts-x-20240101-000000.jsonl"]
+
+
+def test_index_points_at_line_starts(tmp_path):
+    path = tmp_path / "loki_alerts.jsonl"
+    write_log(path, count=100, index_interval=256, compress=False)
+    entries = read_index(str(path))
+    assert len(entries) > 2
+    data = path.read_bytes()
+    for ts, offset, stored in entries:
+        assert offset == stored
+        assert offset == 0 or data[offset - 1:offset] == b"\n"
+        first = json.loads(data[offset:data.index(b"\n", offset)])
+        assert START + first["i"] * 10.0 == ts
+
+
+def test_compressed_segments_stay_plain_gzip(tmp_path):
+    path = tmp_path / "loki_alerts.jsonl"
+    write_log(path, segment_bytes=4096, index_interval=512, retention_bytes=0)
+    segment = closed_segments(str(path))[0]
+    lines = gzip.decompress(open(segment, "rb").read()).splitlines()
+    assert json.loads(lines[0])["i"] == 0
+
+
+def test_read_range_by_time(tmp_path):
+    path = tmp_path / "loki-alerts.jsonl"
+    write_log(path, segment_bytes=4096, index_interval=512, retention_bytes=0)
+    records = list(read_range(str(path), since=START + 1000, until=START + 2000))
+    assert [r["i"] for r in records] == list(range(100, 200))
+
+
+def test_retention_deletes_the_oldest(tmp_path):
+    path = tmp_path / "loki_alerts.jsonl"
+    log = write_log(path, segment_bytes=2048, index_interval=512, compress=False, retention_bytes=6000)
+    assert log.deleted > 0
+    remaining = [r["i"] for r in read_range(str(path))]
+    assert remaining == list(range(remaining[0], 400)) # only the start is gone
+
+
+def test_segment_names_are_utc(tmp_path, monkeypatch):
+    # a local timezone mustn't leak into the names, the records are UTC too
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        path = tmp_path / "loki_alerts.jsonl"
+        write_log(path, segment_bytes=4096, index_interval=512, compress=False, retention_bytes=0)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert os.path.basename(closed_segments(str(path))[0]) == "loki_alerts-20231114-221320.jsonl"
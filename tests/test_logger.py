@@ -0,0 +1,21 @@
+from logger import logger, AlertKind
+
+
+def test_started_record_does_not_share_the_details_dict():
+    records = []
+    logger.new_alert_hooks.append(records.append)
+    try:
+        details = {"chain": "INPUT", "dst_port": 80}
+        logger.log_alert(AlertKind.BEHAVIOR, "198.51.100.1", "192.0.2.1", 1234, 80,
+                         "test details copy", details=details)
+        # the ongoing path merges into the alert state while the writer may still be serializing
+        logger.log_alert(AlertKind.BEHAVIOR, "198.51.100.1", "192.0.2.1", 1234, 80,
+                         "test details copy", details={"extra": 1})
+    finally:
+        logger.new_alert_hooks.remove(records.append)
+
+    assert len(records) == 1
+    assert records[0]["details"] == {"chain": "INPUT", "dst_port": 80}
+    state = next(state for key, state in logger.active_alerts.items() if key[1] == "test details copy")
+    assert state.details["extra"] == 1
+    assert records[0]["details"] is not state.details
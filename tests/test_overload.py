@@ -0,0 +1,151 @@
+import pytest
+
+import nfqueue_app
+import replay
+from overload import OverloadMonitor, NORMAL, DEGRADED, OVERLOADED, CRITICAL
+from signature_engine import SignatureScanning
+from stream_reassembly import StreamReassembler
+
+CONFIG = {
+    "lag": [0.05, 0.25, 1.0],
+    "depth": [0.25, 0.5, 0.8],
+    "hysteresis": 0.5,
+    "hold": 5,
+    "trusted_bytes": 4096,
+    "large_payload": 64,
+    "behavior_sample": 4,
+    "critical_behavior_sample": 16,
+}
+
+RULES = """
+signatures:
+  - name: "passwd"
+    pattern: "/etc/passwd"
+    action: "drop"
+"""
+
+
+class Flow:
+    def __init__(self, inspected_bytes):
+        self.inspected_bytes = inspected_bytes
+
+
+def monitor_at(tier):
+    monitor = OverloadMonitor(100, 1000, CONFIG)
+    monitor._switch(tier, "test")
+    return monitor
+
+
+def test_tiers_go_up_at_once_and_down_one_at_a_time():
+    monitor = OverloadMonitor(100, 1000, CONFIG)
+
+    def evaluate(lag, now):
+        monitor.lag_peak = lag
+        return monitor.evaluate({}, now=now)
+
+    assert evaluate(0.3, 0) == OVERLOADED
+    # under the thresholds but not under half of them: stays
+    assert evaluate(0.2, 1) == OVERLOADED
+    assert evaluate(0.2, 20) == OVERLOADED
+    # calm, but only for `hold` seconds, one step at a time
+    assert evaluate(0.0, 30) == OVERLOADED
+    assert evaluate(0.0, 34) == OVERLOADED
+    assert evaluate(0.0, 35) == DEGRADED
+    assert evaluate(0.0, 39) == DEGRADED
+    assert evaluate(0.0, 40) == NORMAL
+
+
+def test_queue_depth_and_kernel_drops():
+    monitor = OverloadMonitor(100, 1000, CONFIG)
+    assert monitor.evaluate({100: (300, 0, 0)}, now=0) == DEGRADED
+    assert monitor.evaluate({100: (850, 0, 0)}, now=1) == CRITICAL
+    monitor = OverloadMonitor(100, 1000, CONFIG)
+    monitor.evaluate({100: (0, 5, 0)}, now=0)
+    # packets went by uninspected since the last check
+    assert monitor.evaluate({100: (0, 9, 0)}, now=1) == OVERLOADED
+
+
+def test_behavior_sampling_keeps_the_count():
+    monitor = monitor_at(OVERLOADED)
+    weights = [monitor.sample() for _ in range(400)]
+    assert sum(weights) == 400
+    assert weights.count(0) == 300
+    assert monitor_at(NORMAL).sample() == 1
+
+
+def test_sampling_only_counts_flood_packets(monkeypatch):
+    monkeypatch.setattr(nfqueue_app, "blocklist", None)
+    weights = []
+
+    class Detector(nfqueue_app.PortScanningDetector):
+        def analyze_udp(self, dst_ip, timestamp, port, weight=1):
+            weights.append(weight)
+            return False
+
+    detector = Detector(15, 10)
+    metrics = nfqueue_app.ChainMetrics("INPUT", 0)
+    overload = monitor_at(OVERLOADED)
+    # every other packet is a flood packet: with one tick per packet of any kind
+    # (N = 4) the flood would land on the skipped ticks every time
+    for i in range(400):
+        if i % 2:
+            ip = replay.build_udp("198.51.100.9", "10.0.0.1", 40000, 53, b"x")
+        else:
+            ip = replay.build_tcp("192.0.2.1", "10.0.0.1", 40001, 80, 0x10, seq=i)
+        nfqueue_app.process_packet(replay.ReplayPacket(i, ip, 0.0), True, detector, None, metrics=metrics,
+                                   overload=overload)
+    assert sum(weights) == 200
+    assert overload.sampled_out == 150
+
+
+def test_scan_shedding_per_tier():
+    trusted = Flow(5000)
+    fresh = Flow(100)
+    assert not monitor_at(DEGRADED).sheds_scan(fresh)
+    assert monitor_at(DEGRADED).sheds_scan(trusted)
+    assert monitor_at(CRITICAL).sheds_scan(fresh)
+    assert monitor_at(DEGRADED).scan_limit(5000) == 0
+    # large payloads get their start scanned, not nothing
+    overloaded = monitor_at(OVERLOADED)
+    assert overloaded.scan_limit(5000) == 64
+    assert overloaded.scan_limit(64) == 0
+    assert overloaded.stats()["truncated_scans"] == 1
+
+
+@pytest.fixture
+def scanner(tmp_path):
+    path = tmp_path / "rules.yaml"
+    path.write_text(RULES)
+    return SignatureScanning(str(path))
+
+
+def run(packets, scanner, overload, reassembler=None):
+    detector = nfqueue_app.PortScanningDetector(15, 10)
+    metrics = nfqueue_app.ChainMetrics("INPUT", 0)
+    verdicts = []
+    for seq, flags, payload in packets:
+        packet = replay.ReplayPacket(seq, replay.build_tcp("198.51.100.9", "10.0.0.1", 40000, 80, flags, payload,
+                                                           seq=seq), 0.0)
+        nfqueue_app.process_packet(packet, True, detector, scanner, metrics=metrics, reassembler=reassembler,
+                                   overload=overload)
+        verdicts.append(packet.verdict)
+    return verdicts
+
+
+def test_padding_does_not_hide_a_payload(scanner, monkeypatch):
+    monkeypatch.setattr(nfqueue_app, "blocklist", None)
+    overload = monitor_at(OVERLOADED)
+    assert run([(1000, 0x18, b"GET /../../etc/passwd HTTP/1.1\r\n" + b"A" * 4000)], scanner, overload) == ["DROP"]
+    # past the first large_payload bytes it isn't seen anymore, that's the shedding
+    assert run([(1000, 0x18, b"A" * 4000 + b"/etc/passwd")], scanner, overload) == ["ACCEPT"]
+
+
+def test_shed_scan_keeps_the_stream_in_sync(scanner, monkeypatch):
+    monkeypatch.setattr(nfqueue_app, "blocklist", None)
+    reassembler = StreamReassembler()
+    overload = monitor_at(CRITICAL)
+    run([(999, 0x02, b""), (1000, 0x18, b"hello")], scanner, overload, reassembler)
+    overload._switch(NORMAL, "test")
+    assert run([(1005, 0x18, b"GET /etc/pa"), (1016, 0x18, b"sswd")], scanner, overload, reassembler) == [
+        "ACCEPT", "DROP"]
+    assert reassembler.out_of_order == 0
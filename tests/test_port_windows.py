@@ -0,0 +1,60 @@
+import random
+from collections import deque
+
+from state import DistinctPortWindow, WindowedPortHLL, new_port_window
+
+
+def reference_distinct(entries, timestamp, window):
+    # the original list of (timestamp, port) entries, rebuilt into a set per packet
+    while entries and timestamp - entries[0][0] > window:
+        entries.popleft()
+    return len({port for _ts, port in entries})
+
+
+def test_exact_window_matches_the_per_packet_set():
+    rng = random.Random(5)
+    window = DistinctPortWindow(5)
+    entries = deque()
+    t = 0.0
+    for _ in range(5000):
+        t += rng.expovariate(40)
+        port = rng.randrange(1, 200)
+        entries.append((t, port))
+        assert window.add(t, port) == reference_distinct(entries, t, 5)
+
+
+def test_exact_window_forgets_ports_past_the_window():
+    window = DistinctPortWindow(5)
+    for port in range(1, 31):
+        window.add(100.0, port)
+    assert window.add(104.0, 1) == 30
+    assert window.add(106.0, 2) == 2 # ports 3..30 were last hit 6s ago
+
+
+def test_hll_estimate_is_close_on_wide_scans():
+    for distinct in (30, 300, 3000):
+        hll = WindowedPortHLL(5, 5, 6, 0.0)
+        estimate = 0
+        for i in range(distinct):
+            estimate = hll.add(i * 0.0001, 1 + i)
+        assert abs(estimate - distinct) <= 0.3 * distinct, (distinct, estimate)
+
+
+def test_hll_repeated_ports_count_once():
+    hll = WindowedPortHLL(5, 5, 6, 0.0)
+    for i in range(1000):
+        estimate = hll.add(i * 0.001, 80 + i % 10)
+    assert estimate < 15
+
+
+def test_hll_slices_expire():
+    hll = WindowedPortHLL(5, 5, 6, 0.0)
+    for port in range(1, 501):
+        hll.add(0.5, port)
+    # one window and one slice later only the new port is left
+    assert hll.add(7.0, 1) < 3
+
+
+def test_new_port_window_mode():
+    assert isinstance(new_port_window(5, "exact", 0.0), DistinctPortWindow)
+    assert isinstance(new_port_window(5, "hll", 0.0), WindowedPortHLL)
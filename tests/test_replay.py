@@ -0,0 +1,32 @@
+import replay
+
+
+def test_pcap_round_trip(tmp_path):
+    packets = list(replay.synth_syn_scan(count=50))
+    path = tmp_path / "scan.pcap"
+    replay.write_pcap(str(path), packets)
+
+    read = list(replay.read_packets(str(path)))
+    assert [ip for _ts, ip in read] == [ip for _ts, ip in packets]
+    assert all(abs(a[0] - b[0]) < 1e-6 for a, b in zip(read, packets))
+
+
+def test_syn_scan_raises_a_port_scan(tmp_path):
+    path = tmp_path / "scan.pcap"
+    replay.write_pcap(str(path), replay.synth_syn_scan(count=200))
+
+    report = replay.replay([str(path)], use_blocklist=False)
+
+    assert report["packets"] == 200
+    assert report["verdicts"]["ACCEPT"] == 200
+    assert any("Port Scan" in message for message in report["alerts_by_message"])
+
+
+def test_udp_flood_raises_a_flood_alert(tmp_path):
+    path = tmp_path / "flood.pcap"
+    replay.write_pcap(str(path), replay.synth_udp_flood(count=2000, sources=4))
+
+    report = replay.replay([str(path)], use_blocklist=False)
+
+    assert report["packets"] == 2000
+    assert any("UDP Flood" in message for message in report["alerts_by_message"])
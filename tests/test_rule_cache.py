@@ -0,0 +1,72 @@
+import glob
+import os
+
+from signature_engine import compile_rules
+
+RULES = """
+signatures:
+  - name: "literal"
+    pattern: "ATTACK_TEST"
+    action: "drop"
+  - name: "sqli"
+    regex: "union\\\\s+(all\\\\s+)?select"
+    nocase: true
+    action: "alert"
+    id: 1042
+"""
+
+PAYLOADS = (b"xxATTACK_TEST", b"attack_test", b"id=1 UNION ALL select *", b"nothing here")
+
+
+def setup(tmp_path):
+    rules = tmp_path / "rules.yaml"
+    rules.write_text(RULES)
+    return str(rules), str(tmp_path / "cache")
+
+
+def scan(ruleset, payload):
+    return sorted((ruleset.rules[ruleset.key_rule[key_id]]["name"], end) for key_id, end in
+                  ruleset.matcher.findall(payload))
+
+
+def test_round_trip(tmp_path):
+    rules, cache_dir = setup(tmp_path)
+    built = compile_rules(rules, regex_window=64, cache_dir=cache_dir)
+    loaded = compile_rules(rules, version=3, regex_window=64, cache_dir=cache_dir)
+    assert not built.from_cache and loaded.from_cache
+    assert loaded.version == 3 and loaded.source == rules
+    assert loaded.stream_tail == built.stream_tail
+    assert [rule["name"] for rule in loaded.rules] == ["literal", "sqli"]
+    assert loaded.rules[1]["id"] == 1042
+    assert loaded.rules[1]["regex"].search(b"UNION  select")
+    for payload in PAYLOADS:
+        assert scan(loaded, payload) == scan(built, payload)
+
+
+def test_cache_file_is_data_only(tmp_path):
+    rules, cache_dir = setup(tmp_path)
+    compile_rules(rules, cache_dir=cache_dir)
+    [path] = glob.glob(os.path.join(cache_dir, "ruleset-*"))
+    with open(path, "rb") as f:
+        assert f.read(1) == b"{" # a JSON header, not a pickle
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_writable_cache_is_ignored(tmp_path):
+    rules, cache_dir = setup(tmp_path)
+    compile_rules(rules, cache_dir=cache_dir)
+    [path] = glob.glob(os.path.join(cache_dir, "ruleset-*"))
+    os.chmod(path, 0o666)
+    assert not compile_rules(rules, cache_dir=cache_dir).from_cache
+
+
+def test_broken_cache_is_rebuilt(tmp_path):
+    rules, cache_dir = setup(tmp_path)
+    compile_rules(rules, cache_dir=cache_dir)
+    [path] = glob.glob(os.path.join(cache_dir, "ruleset-*"))
+    with open(path, "r+b") as f:
+        f.seek(-8, os.SEEK_END)
+        f.write(b"\xff" * 8) # transitions pointing out of the table
+    ruleset = compile_rules(rules, cache_dir=cache_dir)
+    assert not ruleset.from_cache
+    assert scan(ruleset, b"xxATTACK_TEST") == [("literal", 13)]
@@ -0,0 +1,63 @@
+import nfqueue_app
+from signature_engine import SignatureScanning
+
+OLD = """
+signatures:
+  - name: "passwd"
+    pattern: "/etc/passwd"
+    action: "drop"
+"""
+
+NEW = """
+signatures:
+  - name: "shadow"
+    pattern: "/etc/shadow"
+    action: "drop"
+  - name: "probe"
+    pattern: "PROBE_TEST"
+    action: "alert"
+"""
+
+
+def names(scanner, payload):
+    return [match.name for match in scanner.match_payload(payload)]
+
+
+def reload(scanner, monkeypatch):
+    events = []
+    monkeypatch.setattr(nfqueue_app.logger, "log_system_event",
+                        lambda message, level="INFO": events.append((level, message)))
+    nfqueue_app.reload_signatures(scanner, "test")
+    return events
+
+
+def test_reload_swaps_the_matcher(tmp_path, monkeypatch):
+    path = tmp_path / "rules.yaml"
+    path.write_text(OLD)
+    scanner = SignatureScanning(str(path))
+    matcher = scanner.matcher
+    assert names(scanner, b"GET /etc/passwd") == ["passwd"]
+
+    path.write_text(NEW)
+    assert scanner.file_changed()
+    [(level, message)] = reload(scanner, monkeypatch)
+    assert level == "INFO" and "1 -> 2 rules" in message
+    assert scanner.matcher is not matcher and scanner.ruleset.version == 1
+    assert names(scanner, b"GET /etc/passwd") == []
+    assert names(scanner, b"GET /etc/shadow PROBE_TEST") == ["shadow", "probe"]
+    assert not scanner.file_changed()
+
+
+def test_broken_reload_keeps_the_old_rules(tmp_path, monkeypatch):
+    path = tmp_path / "rules.yaml"
+    path.write_text(OLD)
+    scanner = SignatureScanning(str(path))
+    ruleset = scanner.ruleset
+
+    path.write_text("signatures:\n  - name: [broken\n")
+    [(level, message)] = reload(scanner, monkeypatch)
+    assert level == "ERROR" and "keeping the 1 current rules" in message
+    assert scanner.ruleset is ruleset and scanner.reload_errors == 1
+    assert names(scanner, b"GET /etc/passwd") == ["passwd"]
+    # the same broken file isn't retried at every check
+    assert not scanner.file_changed()
@@ -0,0 +1,94 @@
+import re
+
+import pytest
+
+from signature_engine import SignatureScanning, parse_rules, required_literal
+
+RULES = """
+signatures:
+  - name: "literal"
+    pattern: "ATTACK_TEST"
+    action: "drop"
+  - name: "sqli"
+    regex: "union\\\\s+(all\\\\s+)?select"
+    nocase: true
+    action: "alert"
+  - name: "no literal"
+    regex: "[0-9]{3}-[0-9]{4}"
+    action: "alert"
+"""
+
+
+@pytest.fixture
+def scanner(tmp_path):
+    path = tmp_path / "rules.yaml"
+    path.write_text(RULES)
+    return SignatureScanning(str(path))
+
+
+@pytest.mark.parametrize("regex, flags, literal", [
+    (rb"union\s+(all\s+)?select", 0, b"select"),
+    (rb"GET /admin\.php\?id=\d+", 0, b"get /admin.php?id="),
+    (rb"(?:cmd|powershell)\.exe", 0, b".exe"),
+    (rb"\x90{32}", 0, b"\x90" * 16),
+    (rb"^abc$", 0, b"abc"),
+    (rb"[0-9]{3}-[0-9]{4}", 0, b""),
+    (rb"a|b", 0, b""),
+    (rb"SeLeCt", re.IGNORECASE, b"select"),
+])
+def test_required_literal(regex, flags, literal):
+    assert required_literal(regex, flags) == literal
+
+
+def test_every_match_contains_the_literal():
+    # the prefilter must never hide a match
+    for regex in (rb"union\s+(all\s+)?select", rb"x(ab)+y", rb"id=\d+&user=\w*admin"):
+        literal = required_literal(regex)
+        for text in (b"UNION  ALL select", b"union select", b"xababy", b"id=42&user=superadmin"):
+            m = re.search(regex, text, re.IGNORECASE)
+            if m:
+                assert literal in m.group(0).lower()
+
+
+def test_regex_only_runs_when_its_literal_is_there(scanner):
+    ruleset = scanner.ruleset
+    sqli = next(i for i, rule in enumerate(ruleset.rules) if rule["name"] == "sqli")
+
+    assert scanner.match_payload(b"GET /index.html") == []
+    assert ruleset.evaluations[sqli] == 0
+
+    # the literal alone isn't a match, the regex has the final word
+    assert scanner.match_payload(b"please select one") == []
+    assert ruleset.evaluations[sqli] == 1
+
+    matches = scanner.match_payload(b"id=1 UNION   ALL SeLeCt password")
+    assert [match.name for match in matches] == ["sqli"]
+    assert matches[0].offset == 5
+
+
+def test_rules_without_a_literal_run_on_every_payload(scanner):
+    ruleset = scanner.ruleset
+    assert [ruleset.rules[i]["name"] for i in ruleset.always] == ["no literal"]
+    assert [match.name for match in scanner.match_payload(b"call 555-1234")] == ["no literal"]
+
+
+def test_case_sensitive_literal_and_offsets(scanner):
+    assert scanner.match_payload(b"attack_test") == []
+    matches = scanner.match_payload(b"xxATTACK_TEST and union select")
+    assert [(match.name, match.offset) for match in matches] == [("literal", 2), ("sqli", 18)]
+    assert matches[0].is_drop and not matches[1].is_drop
+
+
+def test_min_end_skips_matches_already_reported(scanner):
+    payload = b"ATTACK_TEST...."
+    assert scanner.match_payload(payload, min_end=len(b"ATTACK_TEST")) == []
+    assert len(scanner.match_payload(payload, min_end=len(b"ATTACK_TES"))) == 1
+
+
+def test_bad_rules_are_refused():
+    with pytest.raises(ValueError):
+        parse_rules({"signatures": [{"name": "x", "regex": "(", "action": "alert"}]})
+    with pytest.raises(ValueError):
+        parse_rules({"signatures": [{"name": "x", "pattern": "a", "regex": "a", "action": "alert"}]})
+    with pytest.raises(ValueError):
+        parse_rules({"signatures": [{"name": "x", "pattern": "a", "action": "block"}]})
@@ -0,0 +1,111 @@
+import pytest
+
+import nfqueue_app
+import replay
+from packet_parser import decode_packet
+from signature_engine import SignatureScanning
+from stream_reassembly import StreamReassembler
+
+RULES = """
+signatures:
+  - name: "passwd"
+    pattern: "/etc/passwd"
+    action: "drop"
+"""
+
+CLIENT = ("198.51.100.9", "10.0.0.1", 40000, 80)
+
+
+@pytest.fixture
+def scanner(tmp_path):
+    path = tmp_path / "rules.yaml"
+    path.write_text(RULES)
+    return SignatureScanning(str(path))
+
+
+def segment(seq, payload, flags=0x18):
+    return decode_packet(replay.build_tcp(*CLIENT, flags, payload, seq=seq), 1700000000.0)
+
+
+def scan(reassembler, scanner, seq, payload, accept=True):
+    data, min_end, seen = reassembler.feed(segment(seq, payload), scanner.stream_tail)
+    matches = scanner.match_payload(data, min_end, seen)
+    if accept:
+        reassembler.commit()
+    return [match.name for match in matches]
+
+
+def test_pattern_split_over_two_segments(scanner):
+    reassembler = StreamReassembler()
+    reassembler.open(segment(999, b"", flags=0x02))
+    assert scan(reassembler, scanner, 1000, b"GET /../../etc/pa") == []
+    assert scan(reassembler, scanner, 1017, b"sswd HTTP/1.1\r\n") == ["passwd"]
+    # the match is in the tail now, not reported again
+    assert scan(reassembler, scanner, 1032, b"\r\n") == []
+
+
+def test_retransmit_after_drop_is_scanned_with_the_tail(scanner):
+    reassembler = StreamReassembler()
+    reassembler.open(segment(999, b"", flags=0x02))
+    assert scan(reassembler, scanner, 1000, b"GET /../../etc/pa") == []
+    # dropped: the stream doesn't move on
+    assert scan(reassembler, scanner, 1017, b"sswd HTTP/1.1\r\n", accept=False) == ["passwd"]
+    # so the retransmission still comes after the same tail
+    assert scan(reassembler, scanner, 1017, b"sswd HTTP/1.1\r\n", accept=False) == ["passwd"]
+    assert reassembler.retransmits == 0
+
+
+def test_parked_segments_are_not_reported_twice(scanner):
+    reassembler = StreamReassembler()
+    reassembler.open(segment(999, b"", flags=0x02))
+    # ahead of a gap: scanned alone, the match is reported once
+    assert scan(reassembler, scanner, 1010, b"/etc/passwd ") == ["passwd"]
+    assert reassembler.out_of_order == 1
+    # the gap is filled: the parked bytes come along, but only new matches count
+    assert scan(reassembler, scanner, 1000, b"0123456789") == []
+    assert reassembler.stats()["bytes"] == scanner.stream_tail # parked bytes released, only the tail is kept
+
+
+def test_parked_segment_completes_a_split_pattern(scanner):
+    reassembler = StreamReassembler()
+    reassembler.open(segment(999, b"", flags=0x02))
+    assert scan(reassembler, scanner, 1010, b"sswd xx") == []
+    # the match spans the filled gap and the parked segment: new, reported
+    assert scan(reassembler, scanner, 1000, b"/../etc/pa") == ["passwd"]
+
+
+def test_skip_resyncs_the_stream(scanner):
+    reassembler = StreamReassembler()
+    reassembler.open(segment(999, b"", flags=0x02))
+    assert scan(reassembler, scanner, 1000, b"hello ") == []
+    reassembler.skip(segment(1006, b"not scanned"))
+    # no gap left behind: the next segments are in order again
+    assert scan(reassembler, scanner, 1017, b"/etc/pa") == []
+    assert scan(reassembler, scanner, 1024, b"sswd") == ["passwd"]
+    assert reassembler.out_of_order == 0
+
+
+def test_parked_bytes_are_given_up_past_the_flow_budget(scanner):
+    reassembler = StreamReassembler(max_flow_bytes=32)
+    reassembler.open(segment(999, b"", flags=0x02))
+    scan(reassembler, scanner, 1100, b"x" * 20)
+    scan(reassembler, scanner, 1200, b"y" * 20)
+    assert reassembler.gaps_given_up == 1
+    assert reassembler.total_bytes == 0
+    # the stream carries on after the segment that overflowed
+    assert scan(reassembler, scanner, 1220, b"/etc/passwd") == ["passwd"]
+    assert reassembler.in_order == 1
+
+
+def test_retransmitted_drop_is_dropped_again_without_a_flow_cache(scanner, monkeypatch):
+    monkeypatch.setattr(nfqueue_app, "blocklist", None)
+    reassembler = StreamReassembler()
+    detector = nfqueue_app.PortScanningDetector(15, 10)
+    metrics = nfqueue_app.ChainMetrics("INPUT", 0)
+    verdicts = []
+    for seq, flags, payload in ((999, 0x02, b""), (1000, 0x18, b"GET /../../etc/pa"),
+                                (1017, 0x18, b"sswd HTTP/1.1\r\n"), (1017, 0x18, b"sswd HTTP/1.1\r\n")):
+        packet = replay.ReplayPacket(seq, replay.build_tcp(*CLIENT, flags, payload, seq=seq), 1700000000.0)
+        nfqueue_app.process_packet(packet, True, detector, scanner, metrics=metrics, reassembler=reassembler)
+        verdicts.append(packet.verdict)
+    assert verdicts == ["ACCEPT", "ACCEPT", "DROP", "DROP"]
@@ -0,0 +1,82 @@
+import struct
+
+import pytest
+
+from collector import Collector
+from sketches import CountMinSketch, WindowSummary
+from summary_export import (MAGIC, VERSION, NodeSummary, SummaryFormatError, decode_summary,
+                            encode_summary)
+
+
+def summary(node="sensor-1", queue=100, window_start=1700000000.0, sources=None):
+    sources = sources or {"198.51.100.7": 500, "192.0.2.1": 20}
+    counts = CountMinSketch(64, 3)
+    for key, count in sources.items():
+        counts.add(key, count)
+    top = sorted(((key, count, 0) for key, count in sources.items()), key=lambda entry: entry[1], reverse=True)
+    table = WindowSummary("src", window_start, 10.0, counts, top)
+    return NodeSummary(node, "INPUT", queue, window_start, 10.0, {"src": table})
+
+
+def test_round_trip():
+    original = summary()
+    decoded = decode_summary(encode_summary(original))
+    assert (decoded.node, decoded.chain, decoded.queue) == ("sensor-1", "INPUT", 100)
+    assert (decoded.window_start, decoded.window) == (1700000000.0, 10.0)
+    table = decoded.tables["src"]
+    assert table.top == original.tables["src"].top
+    assert table.counts.cells == original.tables["src"].counts.cells
+    assert table.counts.total == 520
+    assert table.counts.estimate("198.51.100.7") >= 500
+
+
+def test_header_layout():
+    data = encode_summary(summary())
+    # "LKSM" | version | flags | tables | window_start | window | queue, big endian
+    assert data[:4] == MAGIC
+    assert struct.unpack("!4sBBHdfi", data[:24]) == (MAGIC, VERSION, 0, 1, 1700000000.0, 10.0, 100)
+    assert data[24:26] == struct.pack("!H", len("sensor-1")) and data[26:34] == b"sensor-1"
+
+
+def test_rejects_what_it_cannot_read():
+    data = encode_summary(summary())
+    with pytest.raises(SummaryFormatError):
+        decode_summary(b"XXXX" + data[4:])
+    with pytest.raises(SummaryFormatError):
+        decode_summary(data[:4] + bytes([VERSION + 1]) + data[5:])
+    for cut in (10, 30, len(data) - 1):
+        with pytest.raises(SummaryFormatError):
+            decode_summary(data[:cut])
+
+
+def test_rejects_corrupted_counters():
+    data = bytearray(encode_summary(summary()))
+    # first table: name, then total u64 | width u32 | depth u16 | top u16 | counters len u32 + zlib
+    table = 24 + 2 + len("sensor-1") + 2 + len("INPUT") + 1 + len("src")
+    width = table + 8
+    data[width:width + 4] = struct.pack("!I", 32) # the counters are for 64 wide
+    with pytest.raises(SummaryFormatError):
+        decode_summary(bytes(data))
+    data[width:width + 4] = struct.pack("!I", 64)
+    data[table + 16 + 4 + 2] ^= 0xFF # inside the zlib stream
+    with pytest.raises(SummaryFormatError):
+        decode_summary(bytes(data))
+
+
+def test_collector_merges_nodes_once():
+    collector = Collector(thresholds={"src": 800}, grace=0.0)
+    assert collector.add(encode_summary(summary("sensor-1"))) is not None
+    assert collector.add(encode_summary(summary("sensor-2"))) is not None
+    assert collector.add(encode_summary(summary("sensor-2"))) is None # resent
+    assert collector.add(b"garbage") is None
+    assert (collector.received, collector.duplicates, collector.rejected) == (2, 1, 1)
+
+    [report] = collector.finish_all()
+    assert report["senders"] == ["sensor-1/INPUT/q100", "sensor-2/INPUT/q100"]
+    assert report["tables"]["src"]["packets"] == 1040
+    assert report["tables"]["src"]["top"][0][0] == "198.51.100.7"
+    # 500 per node is under the threshold, 1000 over both isn't
+    assert [(name, key) for name, key, _estimate in report["alerts"]] == [("src", "198.51.100.7")]
+    # the window is closed, a late summary is ignored
+    assert collector.add(encode_summary(summary("sensor-3"))) is None
+    assert collector.late == 1
@@ -0,0 +1,105 @@
+import bisect
+import random
+from collections import deque
+
+from detectore_engine import PortScanningDetector
+from state import ExactWindowCounter, SlidingWindowCounter, new_window_counter
+
+
+class ReferenceDeque:
+    """The original per-packet flood counter the detectors started from."""
+
+    def __init__(self, window):
+        self.window = window
+        self.history = deque()
+
+    def add(self, timestamp):
+        while self.history and timestamp - self.history[0] > self.window:
+            self.history.popleft()
+        self.history.append(timestamp)
+        return len(self.history)
+
+
+def poisson(rate, count, seed, start=1000.0):
+    rng = random.Random(seed)
+    t = start
+    for _ in range(count):
+        t += rng.expovariate(rate)
+        yield t
+
+
+def bursts(size, every, count, start=1000.0):
+    # `size` packets 0.5 ms apart every `every` seconds
+    for burst in range(count):
+        for i in range(size):
+            yield start + burst * every + i * 0.0005
+
+
+TRAFFIC = {
+    "poisson_150pps": lambda: list(poisson(150, 5000, seed=1)),
+    "bursts_200_every_1.95s": lambda: list(bursts(200, 1.95, 30)),
+    "bursts_160_every_1.9s": lambda: list(bursts(160, 1.9, 30)),
+}
+
+
+def test_exact_counter_matches_the_reference_deque():
+    for name, make in TRAFFIC.items():
+        timestamps = make()
+        exact = ExactWindowCounter(2, timestamps[0])
+        reference = ReferenceDeque(2)
+        assert [exact.add(t) for t in timestamps] == [reference.add(t) for t in timestamps], name
+
+
+def test_default_counter_is_exact():
+    detector = PortScanningDetector(15, 10)
+    assert detector.counter_slices == 0
+    assert isinstance(new_window_counter(2, detector.counter_slices, 0.0), ExactWindowCounter)
+
+
+def test_default_flood_decisions_match_the_reference_deque():
+    for name, make in TRAFFIC.items():
+        timestamps = make()
+        detector = PortScanningDetector(15, 10)
+        reference = ReferenceDeque(detector.udp_flood_window)
+        decisions = [detector.analyze_udp("192.0.2.1", t, 53) for t in timestamps]
+        expected = [reference.add(t) > detector.udp_flood_threshold for t in timestamps]
+        expected[0] = False # the first packet only creates the window
+        assert decisions == expected, name
+
+
+def test_sliced_counter_error_is_bounded_by_one_slice():
+    window = 2.0
+    for slices in (4, 10):
+        width = window / slices
+        for name, make in TRAFFIC.items():
+            timestamps = make()
+            sliced = SlidingWindowCounter(window, slices, timestamps[0])
+            exact = ExactWindowCounter(window, timestamps[0])
+            for t in timestamps:
+                estimate = sliced.add(t)
+                count = exact.add(t)
+                # packets around the window edge, the only ones the slices can get wrong
+                edge = (bisect.bisect_right(timestamps, t - window + width)
+                        - bisect.bisect_right(timestamps, t - window - width))
+                assert abs(estimate - count) <= edge, (name, slices, t)
+
+
+def test_weighted_add_counts_for_the_sampled_packets():
+    exact = ExactWindowCounter(2, 0.0)
+    sliced = SlidingWindowCounter(2, 10, 0.0)
+    for i in range(10):
+        assert exact.add(i * 0.01, 4) == 4 * (i + 1)
+        assert sliced.add(i * 0.01, 4) == 4 * (i + 1)
+
+
+def test_source_sharded_detector_shares_the_flood_thresholds():
+    detector = PortScanningDetector(15, 10)
+    detector.share_flood_thresholds(4)
+    assert (detector.tcp_flood_threshold, detector.udp_flood_threshold, detector.icmp_flood_threshold) == (50, 75, 25)
+    assert detector.port_scanning_threshold == 20 # per (src, dst), whole in its shard
+    # a flood spread evenly over 4 source-split shards fires in each of them like the whole would
+    timestamps = list(bursts(320, 1.9, 5))
+    whole = PortScanningDetector(15, 10)
+    decisions = [whole.analyze_udp("192.0.2.1", t, 53) for t in timestamps]
+    shard = [detector.analyze_udp("192.0.2.1", t, 53) for t in timestamps[::4]]
+    assert any(decisions) and any(shard)